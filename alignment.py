@@ -0,0 +1,223 @@
+# alignment.py
+"""
+Offset alignment + interval merging for the v2 rerank stage.
+
+A candidate's postings (fp, pos, start_line, end_line) are joined with the
+input fingerprints on fp; every joined pair votes for the offset
+`posting.pos - input.pos`. The winning offset's pairs become the matched
+input/candidate line intervals.
+
+With numpy available the join is a sort/searchsorted over arrays and the
+offset histogram comes from np.unique, so no per-pair Python objects are
+created. The pure-Python path is kept as the reference implementation and
+as the fallback; both return identical results (ties between offsets go to
+the offset whose first pair comes first, as Counter.most_common does).
+"""
+from collections import Counter, defaultdict
+from dataclasses import dataclass, replace
+from itertools import accumulate
+from typing import List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # numpy 是可选依赖，缺失时退回纯 Python 实现
+    np = None
+
+from winnowing_utils import Fingerprint
+
+Interval = Tuple[int, int]
+
+def merge_intervals(intervals, epsilon=0):
+    if not intervals:
+        return []
+    intervals = sorted(intervals)
+    merged = []
+    for s, e in intervals:
+        # epsilon 允许合并有微小间隙的片段
+        if not merged or s > merged[-1][1] + epsilon + 1:
+            merged.append([s, e])
+        else:
+            merged[-1][1] = max(merged[-1][1], e)
+    return [(a, b) for a, b in merged]
+
+def merge_intervals_array(starts, ends, epsilon=0) -> List[Interval]:
+    """merge_intervals() over two parallel numpy arrays."""
+    if len(starts) == 0:
+        return []
+    order = np.lexsort((ends, starts))
+    s = starts[order]
+    e = ends[order]
+    run_max = np.maximum.accumulate(e)
+    # 新片段起点：start 超过此前所有片段的最大 end + epsilon + 1
+    breaks = np.flatnonzero(s[1:] > run_max[:-1] + epsilon + 1) + 1
+    first = np.concatenate(([0], breaks))
+    last = np.concatenate((breaks - 1, [len(s) - 1]))
+    return list(zip(s[first].tolist(), run_max[last].tolist()))
+
+@dataclass
+class Alignment:
+    offset: int
+    hit_fingerprints: int
+    in_merged: List[Interval]
+    db_merged: List[Interval]
+    input_idx: List[int]  # indices into the query fingerprints that voted for `offset`
+
+    def relined(self, fps: Sequence[Fingerprint], epsilon: int = 2) -> "Alignment":
+        """
+        Same alignment with in_merged rebuilt from `fps` line numbers. Uploads with
+        the same token stream share fp/pos sequences but not necessarily lines.
+        """
+        intervals = [(fps[i].start_line, fps[i].end_line) for i in self.input_idx]
+        return replace(self, in_merged=merge_intervals(intervals, epsilon=epsilon))
+
+    @property
+    def covered_lines(self) -> int:
+        return sum(e - s + 1 for s, e in self.in_merged)
+
+    @property
+    def max_continuous_lines(self) -> int:
+        return max([(e - s + 1) for s, e in self.in_merged]) if self.in_merged else 0
+
+    def evidence(self, limit: int = 10) -> List[dict]:
+        return [
+            {"input_lines": f"{s1}-{e1}", "match_lines": f"{s2}-{e2}"}
+            for (s1, e1), (s2, e2) in list(zip(self.in_merged, self.db_merged))[:limit]
+        ]
+
+class CoverageBound:
+    """
+    Upper bound of Alignment.covered_lines over the input fps, for a candidate
+    with at most `hits` matched fps: the `hits` widest fp spans, each widened by
+    the `epsilon` gap that merging may bridge. Used to prune before rerank.
+    """
+
+    def __init__(self, fps: Sequence[Fingerprint], epsilon: int = 2):
+        spans = sorted((f.end_line - f.start_line + 1 + epsilon for f in fps), reverse=True)
+        self._prefix = list(accumulate(spans))
+
+    def covered_lines(self, hits: int) -> int:
+        if hits <= 0 or not self._prefix:
+            return 0
+        return self._prefix[min(hits, len(self._prefix)) - 1]
+
+class QueryIndex:
+    """Input fingerprints of one upload, prepared once and aligned against many candidates."""
+
+    def __init__(self, fps: Sequence[Fingerprint]):
+        self.fps = list(fps)
+        self.by_fp = defaultdict(list)  # fp -> indices into self.fps
+        for i, f in enumerate(self.fps):
+            self.by_fp[f.fp].append(i)
+
+        if np is not None:
+            fp_arr = np.array([f.fp for f in self.fps], dtype=np.int64)
+            # 稳定排序：同一 fp 的多个输入位置保持原顺序，配对顺序与纯 Python 路径一致
+            self.order = np.argsort(fp_arr, kind="stable")
+            self.sorted_fp = fp_arr[self.order]
+            self.pos = np.array([f.pos for f in self.fps], dtype=np.int64)
+            self.start_line = np.array([f.start_line for f in self.fps], dtype=np.int64)
+            self.end_line = np.array([f.end_line for f in self.fps], dtype=np.int64)
+
+class PostingList:
+    """One candidate's postings as parallel columns (filled row by row from the shard queries)."""
+    __slots__ = ("fp", "pos", "start_line", "end_line")
+
+    def __init__(self):
+        self.fp = []
+        self.pos = []
+        self.start_line = []
+        self.end_line = []
+
+    def append(self, fp: int, pos: int, start_line: int, end_line: int) -> None:
+        self.fp.append(fp)
+        self.pos.append(pos)
+        self.start_line.append(start_line)
+        self.end_line.append(end_line)
+
+    def __len__(self) -> int:
+        return len(self.fp)
+
+def align(query: QueryIndex, postings: PostingList, min_hit: int = 1, epsilon: int = 2) -> Optional[Alignment]:
+    """Best-offset alignment of one candidate; None if nothing reaches min_hit."""
+    if np is not None:
+        return _align_numpy(query, postings, min_hit, epsilon)
+    return _align_python(query, postings, min_hit, epsilon)
+
+def _align_python(query: QueryIndex, postings: PostingList, min_hit: int, epsilon: int) -> Optional[Alignment]:
+    # offset alignment
+    fps = query.fps
+    offset_counter = Counter()
+    pairs = []
+    for i in range(len(postings)):
+        for qi in query.by_fp.get(postings.fp[i], []):
+            off = postings.pos[i] - fps[qi].pos
+            offset_counter[off] += 1
+            pairs.append((off, qi, i))
+
+    if not offset_counter:
+        return None
+
+    best_off, best_cnt = offset_counter.most_common(1)[0]
+    if best_cnt < min_hit:
+        return None
+
+    input_idx = []
+    in_intervals = []
+    db_intervals = []
+    for off, qi, i in pairs:
+        if off != best_off:
+            continue
+        input_idx.append(qi)
+        in_intervals.append((fps[qi].start_line, fps[qi].end_line))
+        db_intervals.append((postings.start_line[i], postings.end_line[i]))
+
+    return Alignment(
+        offset=best_off,
+        hit_fingerprints=best_cnt,
+        in_merged=merge_intervals(in_intervals, epsilon=epsilon),
+        db_merged=merge_intervals(db_intervals, epsilon=epsilon),
+        input_idx=input_idx,
+    )
+
+def _align_numpy(query: QueryIndex, postings: PostingList, min_hit: int, epsilon: int) -> Optional[Alignment]:
+    if not len(postings) or not len(query.fps):
+        return None
+    p_fp = np.asarray(postings.fp, dtype=np.int64)
+
+    # join on fp: 每个 posting 在排序后的输入指纹里占 [lo, hi)
+    lo = np.searchsorted(query.sorted_fp, p_fp, side="left")
+    hi = np.searchsorted(query.sorted_fp, p_fp, side="right")
+    n_match = hi - lo
+    total = int(n_match.sum())
+    if total == 0:
+        return None
+
+    # 展开成配对：posting 为主序、输入位置为次序
+    p_idx = np.repeat(np.arange(len(p_fp)), n_match)
+    starts = np.cumsum(n_match) - n_match
+    within = np.arange(total) - np.repeat(starts, n_match)
+    q_idx = query.order[np.repeat(lo, n_match) + within]
+
+    offsets = np.asarray(postings.pos, dtype=np.int64)[p_idx] - query.pos[q_idx]
+    uniq, first_seen, counts = np.unique(offsets, return_index=True, return_counts=True)
+    tied = np.flatnonzero(counts == counts.max())
+    best = tied[np.argmin(first_seen[tied])]
+    best_cnt = int(counts[best])
+    if best_cnt < min_hit:
+        return None
+    best_off = int(uniq[best])
+
+    sel = offsets == best_off
+    q_sel = q_idx[sel]
+    p_sel = p_idx[sel]
+    return Alignment(
+        offset=best_off,
+        hit_fingerprints=best_cnt,
+        in_merged=merge_intervals_array(query.start_line[q_sel], query.end_line[q_sel], epsilon),
+        db_merged=merge_intervals_array(
+            np.asarray(postings.start_line, dtype=np.int64)[p_sel],
+            np.asarray(postings.end_line, dtype=np.int64)[p_sel],
+            epsilon,
+        ),
+        input_idx=q_sel.tolist(),
+    )
@@ -0,0 +1,111 @@
+# batch_pairs.py
+"""
+In-batch cross-submission similarity: which files of one batch copy each
+other, computed from their winnowing fingerprints alone (no database, nothing
+indexed).
+
+1. A temporary inverted index fp -> [(file, occurrences)] is built over the
+   batch. Fingerprints present in more than `max_df` files are dropped as
+   shared template code (e.g. an exam's starter code).
+2. Candidate pairs accumulate sum(min(occ_a, occ_b)) over shared fps. That
+   is an upper bound of the aligned hit count, so pairs below `min_hit`, or
+   whose CoverageBound cannot reach `min_coverage` on either side, are
+   pruned before alignment.
+3. The remaining pairs go through the same offset alignment as the v2
+   rerank stage (alignment.align): file a is the query, file b's
+   fingerprints are the postings.
+
+coverage_a is the share of a's lines matched in b (in_merged), coverage_b
+the share of b's lines matched in a (db_merged); matrix[a][b] = coverage_a.
+"""
+import math
+from collections import Counter, defaultdict
+from typing import Dict, List, Sequence, Tuple
+
+from alignment import CoverageBound, PostingList, QueryIndex, align
+from winnowing_utils import Fingerprint
+
+def _covered(intervals) -> int:
+    return sum(e - s + 1 for s, e in intervals)
+
+def batch_max_df(n_files: int, ratio: float) -> int:
+    """Template cutoff: fps shared by more than this many files are ignored (never below 5)."""
+    return max(5, math.ceil(n_files * ratio))
+
+def cross_match(
+    files_fps: Sequence[Sequence[Fingerprint]],
+    total_lines: Sequence[int],
+    min_hit: int,
+    min_coverage: float,
+    max_df: int,
+    epsilon: int = 2,
+) -> Tuple[List[List[float]], List[dict]]:
+    """
+    Returns (matrix, pairs). matrix[a][b] is the covered share of file a's
+    lines in its best alignment with file b (0.0 when not aligned);
+    pairs lists every aligned pair reaching min_coverage on either side.
+    """
+    n = len(files_fps)
+    occurrences = [Counter(f.fp for f in fps) for fps in files_fps]
+    files_of_fp: Dict[int, List[int]] = defaultdict(list)
+    for i, occ in enumerate(occurrences):
+        for fp in occ:
+            files_of_fp[fp].append(i)
+    template = {fp for fp, files in files_of_fp.items() if len(files) > max_df}
+
+    # 候选对的命中上界：每个共享指纹取两边出现次数的较小值
+    hits: Dict[Tuple[int, int], int] = defaultdict(int)
+    for fp, files in files_of_fp.items():
+        if len(files) < 2 or fp in template:
+            continue
+        for x in range(len(files)):
+            a = files[x]
+            occ_a = occurrences[a][fp]
+            for b in files[x + 1:]:
+                hits[(a, b)] += min(occ_a, occurrences[b][fp])
+
+    kept = [[f for f in fps if f.fp not in template] for fps in files_fps]
+    bounds = [CoverageBound(fps, epsilon=epsilon) for fps in kept]
+
+    def reaches(i: int, covered: int) -> bool:
+        return (covered / total_lines[i] if total_lines[i] else 0.0) >= min_coverage
+
+    candidates = sorted(
+        (a, b) for (a, b), h in hits.items()
+        if h >= min_hit
+        and (reaches(a, bounds[a].covered_lines(h)) or reaches(b, bounds[b].covered_lines(h)))
+    )
+
+    queries = {}
+    postings = {}
+    matrix = [[0.0] * n for _ in range(n)]
+    pairs = []
+    for a, b in candidates:
+        if a not in queries:
+            queries[a] = QueryIndex(kept[a])
+        if b not in postings:
+            postings[b] = PostingList()
+            for f in kept[b]:
+                postings[b].append(f.fp, f.pos, f.start_line, f.end_line)
+        alignment = align(queries[a], postings[b], min_hit=min_hit, epsilon=epsilon)
+        if alignment is None:
+            continue
+        cov_a = alignment.covered_lines / total_lines[a] if total_lines[a] else 0.0
+        cov_b = _covered(alignment.db_merged) / total_lines[b] if total_lines[b] else 0.0
+        matrix[a][b] = round(cov_a, 4)
+        matrix[b][a] = round(cov_b, 4)
+        score = max(cov_a, cov_b)
+        if score < min_coverage:
+            continue
+        pairs.append((score, {
+            "file_a": a,
+            "file_b": b,
+            "coverage_a": f"{cov_a*100:.2f}%",
+            "coverage_b": f"{cov_b*100:.2f}%",
+            "hit_fingerprints": alignment.hit_fingerprints,
+            "max_continuous_lines": alignment.max_continuous_lines,
+            "evidence": alignment.evidence(limit=10),
+        }))
+
+    pairs.sort(key=lambda p: (-p[0], p[1]["file_a"], p[1]["file_b"]))
+    return matrix, [p for _, p in pairs]
@@ -0,0 +1,105 @@
+# batch_upload.py
+"""
+Expansion of a batch duplicate-check request into individual source files.
+
+A batch is any mix of plain uploads and .zip archives (a whole project).
+Archive members are filtered (directories, macOS metadata, hidden files and
+binary files are skipped) and the batch is capped by file count and total
+uncompressed size, checked against the zip directory before anything is
+extracted. Small files are read into memory. Files above stream_min_bytes are
+opened lazily and streamed (upload_stream.fingerprint_stream); zip members
+support the seek(0) that the encoding fallback needs.
+"""
+import posixpath
+import zipfile
+from dataclasses import dataclass
+from typing import BinaryIO, Callable, List, Optional, Sequence, Tuple
+
+BINARY_SNIFF_BYTES = 8192
+
+class BatchLimitError(ValueError):
+    """The batch exceeds the configured file count or total size."""
+
+@dataclass
+class BatchSource:
+    filename: str
+    data: Optional[bytes] = None                     # 小文件：整体读入
+    open: Optional[Callable[[], BinaryIO]] = None    # 大文件：流式读取
+    error: Optional[str] = None
+
+def _looks_binary(head: bytes) -> bool:
+    return b"\x00" in head[:BINARY_SNIFF_BYTES]
+
+def _skip_member(info: zipfile.ZipInfo) -> bool:
+    name = info.filename
+    if info.is_dir() or name.startswith("__MACOSX/"):
+        return True
+    return any(part.startswith(".") for part in name.split("/") if part)
+
+def _zip_sources(archive_name: str, zf: zipfile.ZipFile, stream_min_bytes: int) -> List[BatchSource]:
+    sources = []
+    for info in zf.infolist():
+        if _skip_member(info):
+            continue
+        filename = posixpath.join(archive_name, info.filename)
+        if info.file_size > stream_min_bytes:
+            with zf.open(info) as f:
+                if _looks_binary(f.read(BINARY_SNIFF_BYTES)):
+                    continue
+            sources.append(BatchSource(filename, open=lambda info=info: zf.open(info)))
+            continue
+        data = zf.read(info)
+        if not _looks_binary(data):
+            sources.append(BatchSource(filename, data=data))
+    return sources
+
+def expand_uploads(
+    uploads: Sequence[Tuple[str, BinaryIO, Optional[int]]],
+    max_files: int,
+    max_total_bytes: int,
+    stream_min_bytes: int,
+) -> List[BatchSource]:
+    """
+    uploads: [(filename, file object, size or None)]. Blocking (zip directory
+    reads, small-file reads); run it in a thread.
+    """
+    plan = []  # (filename, fileobj, size, ZipFile or None, error)
+    total_files = 0
+    total_bytes = 0
+    for filename, fileobj, size in uploads:
+        filename = filename or "upload"
+        if size is None:
+            fileobj.seek(0, 2)
+            size = fileobj.tell()
+        fileobj.seek(0)
+        if not filename.lower().endswith(".zip"):
+            total_files += 1
+            total_bytes += size
+            plan.append((filename, fileobj, size, None, None))
+            continue
+        try:
+            zf = zipfile.ZipFile(fileobj)
+        except zipfile.BadZipFile:
+            plan.append((filename, None, 0, None, "压缩包损坏或不是 zip 格式"))
+            continue
+        members = [info for info in zf.infolist() if not _skip_member(info)]
+        total_files += len(members)
+        total_bytes += sum(info.file_size for info in members)
+        plan.append((filename, fileobj, size, zf, None))
+
+    if total_files > max_files:
+        raise BatchLimitError(f"文件数 {total_files} 超过上限 {max_files}")
+    if total_bytes > max_total_bytes:
+        raise BatchLimitError(f"解压后总大小 {total_bytes} 字节超过上限 {max_total_bytes}")
+
+    sources = []
+    for filename, fileobj, size, zf, error in plan:
+        if error:
+            sources.append(BatchSource(filename, error=error))
+        elif zf is not None:
+            sources.extend(_zip_sources(filename, zf, stream_min_bytes))
+        elif size > stream_min_bytes:
+            sources.append(BatchSource(filename, open=lambda f=fileobj: f))
+        else:
+            sources.append(BatchSource(filename, data=fileobj.read()))
+    return sources
@@ -0,0 +1,208 @@
+# benchmarks/bench_e2e.py
+"""
+End-to-end latency/throughput of the duplicate-check endpoints against a
+local database stand-in (benchmarks.local_db, SQLite).
+
+1. A synthetic corpus (benchmarks.corpus) is stored as COMPLETED orders and
+   indexed through the service's own OrderIndexer (shard postings, manifests,
+   code_fingerprints), which is timed as well.
+2. The FastAPI app runs in-process (lifespan included) behind an ASGI client.
+   Every endpoint gets the same queries, whose copied-line share is known:
+   once one request at a time (latency) and once `--concurrency` at a time
+   (throughput).
+
+    python -m benchmarks.bench_e2e [--docs 300] [--queries 40] [--concurrency 8] [--endpoints v1,v2]
+
+Result/recall caches are disabled unless --warm-cache (each query then runs
+twice and only the second, cached pass is timed). Results go to
+benchmarks/results/e2e-<timestamp>.json (see benchmarks.compare).
+"""
+import argparse
+import asyncio
+import os
+import pathlib
+import statistics
+import tempfile
+import time
+
+from benchmarks import local_db
+from benchmarks.common import latency_summary, print_table, save_results
+from benchmarks.corpus import LANGUAGES, generate_corpus, generate_queries
+
+ENDPOINTS = {
+    "v1": "/api/duplicate-check",
+    "v2": "/api/duplicate-check-v2",
+}
+
+def configure_env(args, url: str) -> None:
+    """Service settings are read from the environment when config.py is imported."""
+    os.environ["DATABASE_URL"] = url
+    os.environ["INDEXER_ENABLED"] = "false"
+    os.environ["FP_POOL_WORKERS"] = str(args.fp_pool_workers)
+    if not args.warm_cache:
+        os.environ["RESULT_CACHE_SIZE"] = "0"
+        os.environ["RECALL_CACHE_MAX_ENTRIES"] = "0"
+
+async def seed(url: str, docs, scheme: str) -> dict:
+    """Store `docs` as orders and index them; returns timing of the indexing step."""
+    from tortoise import Tortoise, connections
+
+    from fingerprint_pool import FingerprintPool
+    from indexer import OrderIndexer
+    from models import CodeOrder, OrderStatus
+
+    await Tortoise.init(db_url=url, modules={"model": ["models"]})
+    try:
+        await Tortoise.generate_schemas(safe=True)
+        await local_db.create_posting_tables(connections.get("default"))
+        await CodeOrder.bulk_create(
+            [
+                CodeOrder(
+                    id=d.doc_id,
+                    project_name=f"bench-{d.doc_id}",
+                    source="benchmark",
+                    language=d.language,
+                    grade=1,
+                    function_descriptions_json="[]",
+                    status=OrderStatus.COMPLETED,
+                    generated_code=d.code,
+                )
+                for d in docs
+            ],
+            batch_size=200,
+        )
+        indexer = OrderIndexer(FingerprintPool(0, 0), scheme, batch_size=200)
+        t0 = time.perf_counter()
+        await indexer.enqueue([d.doc_id for d in docs])
+        while await indexer.run_once():
+            pass
+        elapsed = time.perf_counter() - t0
+    finally:
+        await Tortoise.close_connections()
+    return {
+        "name": "index/order_indexer",
+        "orders": len(docs),
+        "lines": sum(d.total_lines for d in docs),
+        "seconds": elapsed,
+        "orders_per_s": len(docs) / elapsed,
+    }
+
+def _rate(body: dict) -> float:
+    return float(body["duplicate_rate"].rstrip("%")) / 100
+
+async def run_endpoint(client, name: str, path: str, queries, concurrency: int, warm_cache: bool):
+    async def post(q):
+        t0 = time.perf_counter()
+        r = await client.post(path, files={"file": (q.filename, q.code.encode("utf-8"))})
+        elapsed = time.perf_counter() - t0
+        body = r.json()
+        if r.status_code != 200 or "error" in body:
+            raise RuntimeError(f"{path} {q.filename}: HTTP {r.status_code} {body}")
+        return elapsed, body
+
+    if warm_cache:
+        for q in queries:
+            await post(q)
+
+    sequential = []
+    errors = []
+    for q in queries:
+        elapsed, body = await post(q)
+        sequential.append(elapsed)
+        errors.append(abs(_rate(body) - q.copied_lines / q.total_lines))
+
+    sem = asyncio.Semaphore(concurrency)
+
+    async def bounded(q):
+        async with sem:
+            return (await post(q))[0]
+
+    t0 = time.perf_counter()
+    concurrent = await asyncio.gather(*[bounded(q) for q in queries])
+    wall = time.perf_counter() - t0
+
+    return [
+        {
+            "name": f"e2e/{name}/sequential",
+            **latency_summary(sequential),
+            "rps": len(queries) / sum(sequential),
+            "dup_rate_mae": statistics.fmean(errors),
+        },
+        {
+            "name": f"e2e/{name}/concurrency_{concurrency}",
+            **latency_summary(concurrent),
+            "rps": len(queries) / wall,
+        },
+    ]
+
+async def run_service(endpoints, queries, concurrency: int, warm_cache: bool):
+    import httpx
+
+    import main as service
+
+    app = service.app
+    results = []
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            for name in endpoints:
+                results.extend(await run_endpoint(client, name, ENDPOINTS[name], queries, concurrency, warm_cache))
+    return results
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--docs", type=int, default=300, help="入库订单数")
+    ap.add_argument("--lines", type=int, default=300, help="每个订单的行数")
+    ap.add_argument("--dup-rate", type=float, default=0.2, help="订单之间的复制比例")
+    ap.add_argument("--queries", type=int, default=40)
+    ap.add_argument("--query-lines", type=int, default=300)
+    ap.add_argument("--query-dup-rate", type=float, default=0.3, help="查询文件从订单复制的行比例")
+    ap.add_argument("--languages", default=",".join(LANGUAGES))
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--fp-pool-workers", type=int, default=0, help="指纹进程池进程数（FP_POOL_WORKERS）")
+    ap.add_argument("--warm-cache", action="store_true", help="启用结果/召回缓存，只计时第二遍")
+    ap.add_argument("--db", default=None, help="SQLite 文件路径，默认临时文件（结束后删除）")
+    ap.add_argument("--out", default=None, help="结果文件路径，默认 benchmarks/results/e2e-<时间>.json")
+    args = ap.parse_args()
+
+    endpoints = args.endpoints.split(",")
+    unknown = set(endpoints) - set(ENDPOINTS)
+    if unknown:
+        raise SystemExit(f"unknown endpoints: {', '.join(sorted(unknown))}")
+
+    languages = args.languages.split(",")
+    docs = generate_corpus(args.docs, args.lines, args.dup_rate, languages, args.seed)
+    queries = generate_queries(docs, args.queries, args.query_lines, args.query_dup_rate, args.seed + 1)
+
+    tmp = None
+    if args.db is None:
+        tmp = tempfile.TemporaryDirectory(prefix="bench_e2e_")
+        db_path = pathlib.Path(tmp.name) / "bench.sqlite3"
+    else:
+        db_path = pathlib.Path(args.db).resolve()
+        if db_path.exists():
+            raise SystemExit(f"{db_path} already exists")
+    local_db.install()
+    url = local_db.db_url(db_path)
+    configure_env(args, url)
+
+    from config import settings
+
+    try:
+        results = [asyncio.run(seed(url, docs, settings.FP_HASH_SCHEME))]
+        results.extend(asyncio.run(run_service(endpoints, queries, args.concurrency, args.warm_cache)))
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+
+    print_table(results[:1], ["seconds", "orders_per_s"])
+    print_table(results[1:], ["mean_ms", "p50_ms", "p90_ms", "p99_ms", "rps", "dup_rate_mae"])
+    params = {k: v for k, v in vars(args).items() if k not in ("out", "db")}
+    params["hash_scheme"] = settings.FP_HASH_SCHEME
+    path = save_results("e2e", params, results, args.out and pathlib.Path(args.out))
+    print(f"results: {path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+# benchmarks/bench_micro.py
+"""
+Microbenchmarks of the duplicate-check building blocks on a synthetic corpus
+(benchmarks.corpus):
+
+- tokenizer: normalize_to_tokens_with_lines vs tokenize_to_ids, per language
+  (fails if the two token streams differ);
+- winnow under each hash scheme (K/WINDOW from winnowing_utils), on token ids;
+- SimHashEngine.compute_simhash per chunk vs compute_simhash_many;
+- merge_intervals vs merge_intervals_array (numpy) on random intervals.
+
+    python -m benchmarks.bench_micro [--docs 40] [--lines 400] [--only winnow] [--out run.json]
+    python -m benchmarks.bench_micro --files *.py --only tokenize     # 用真实文件代替合成语料
+
+Results go to benchmarks/results/micro-<timestamp>.json (see benchmarks.compare).
+"""
+import argparse
+import pathlib
+import random
+
+from alignment import merge_intervals, merge_intervals_array, np
+from benchmarks.common import print_table, save_results, time_call
+from benchmarks.corpus import LANGUAGES, generate_corpus
+from fingerprint_utils import SimHashEngine, split_code_into_chunks
+from winnowing_utils import (
+    HASH_SCHEMES,
+    K,
+    WINDOW,
+    normalize_to_tokens_with_lines,
+    token_strings,
+    tokenize_to_ids,
+    winnow,
+)
+
+
+def read_text(path: pathlib.Path) -> str:
+    raw = path.read_bytes()
+    try:
+        return raw.decode("utf-8")
+    except UnicodeDecodeError:
+        return raw.decode("gbk", errors="replace")
+
+def bench_tokenizer(texts, repeat, min_seconds):
+    results = []
+    for language, code in texts.items():
+        ids = tokenize_to_ids(code)[0]
+        if token_strings(ids) != normalize_to_tokens_with_lines(code)[0]:
+            raise SystemExit(f"{language}: token streams differ -- tokenize_to_ids is not a drop-in replacement")
+        n_tokens = len(ids)
+        for fn in (normalize_to_tokens_with_lines, tokenize_to_ids):
+            t = time_call(lambda: fn(code), repeat, min_seconds)
+            results.append({
+                "name": f"tokenize/{fn.__name__}/{language}",
+                **t,
+                "chars": len(code),
+                "tokens": n_tokens,
+                "tokens_per_s": n_tokens / t["best_s"],
+            })
+    return results
+
+def bench_winnow(texts, repeat, min_seconds):
+    results = []
+    for language, code in texts.items():
+        ids, lines = tokenize_to_ids(code)
+        for scheme in HASH_SCHEMES:
+            n_fps = len(winnow(ids, lines, k=K, window=WINDOW, scheme=scheme))
+            t = time_call(lambda: winnow(ids, lines, k=K, window=WINDOW, scheme=scheme), repeat, min_seconds)
+            results.append({
+                "name": f"winnow/{scheme}/{language}",
+                **t,
+                "tokens": len(ids),
+                "fingerprints": n_fps,
+                "tokens_per_s": len(ids) / t["best_s"],
+            })
+    return results
+
+def bench_simhash(texts, repeat, min_seconds):
+    engine = SimHashEngine()
+    results = []
+    for language, code in texts.items():
+        chunks = split_code_into_chunks(code, window_size=10, step=5)
+        contents = [c["content"] for c in chunks]
+        single = time_call(lambda: [engine.compute_simhash(c) for c in contents], repeat, min_seconds)
+        many = time_call(lambda: engine.compute_simhash_many(chunks), repeat, min_seconds)
+        for name, t in (("compute_simhash", single), ("compute_simhash_many", many)):
+            results.append({
+                "name": f"simhash/{name}/{language}",
+                **t,
+                "chunks": len(chunks),
+                "chunks_per_s": len(chunks) / t["best_s"],
+            })
+    return results
+
+def bench_merge_intervals(repeat, min_seconds, seed):
+    rng = random.Random(seed)
+    results = []
+    for n in (100, 10_000, 200_000):
+        # 形状接近精排对齐结果：大量短区间、相互重叠
+        span = max(1000, n // 2)
+        intervals = []
+        for _ in range(n):
+            s = rng.randrange(span)
+            intervals.append((s, s + rng.randrange(1, 20)))
+        variants = [("merge_intervals", lambda: merge_intervals(intervals, epsilon=2))]
+        if np is not None:
+            starts = np.array([s for s, _ in intervals], dtype=np.int64)
+            ends = np.array([e for _, e in intervals], dtype=np.int64)
+            variants.append(("merge_intervals_array", lambda: merge_intervals_array(starts, ends, epsilon=2)))
+        for name, fn in variants:
+            t = time_call(fn, repeat, min_seconds)
+            results.append({"name": f"merge/{name}/{n}", **t, "intervals": n, "intervals_per_s": n / t["best_s"]})
+    return results
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--docs", type=int, default=40, help="文档总数（按语言轮流生成）")
+    ap.add_argument("--lines", type=int, default=400)
+    ap.add_argument("--dup-rate", type=float, default=0.2)
+    ap.add_argument("--languages", default=",".join(LANGUAGES))
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--min-seconds", type=float, default=0.2, help="每轮最少计时秒数")
+    ap.add_argument("--only", default="", help="只跑名字包含该子串的组: tokenize/winnow/simhash/merge")
+    ap.add_argument("--files", nargs="*", default=None, help="用这些文件（拼接为一份输入）代替合成语料")
+    ap.add_argument("--out", default=None, help="结果文件路径，默认 benchmarks/results/micro-<时间>.json")
+    args = ap.parse_args()
+
+    if args.files:
+        texts = {"files": "\n".join(read_text(pathlib.Path(p)) for p in args.files)}
+    else:
+        languages = args.languages.split(",")
+        docs = generate_corpus(args.docs, args.lines, args.dup_rate, languages, args.seed)
+        texts = {lang: "\n".join(d.code for d in docs if d.language == lang) for lang in languages}
+
+    groups = {
+        "tokenize": lambda: bench_tokenizer(texts, args.repeat, args.min_seconds),
+        "winnow": lambda: bench_winnow(texts, args.repeat, args.min_seconds),
+        "simhash": lambda: bench_simhash(texts, args.repeat, args.min_seconds),
+        "merge": lambda: bench_merge_intervals(args.repeat, args.min_seconds, args.seed),
+    }
+    results = []
+    for name, run in groups.items():
+        if args.only and args.only not in name:
+            continue
+        print(f"[{name}]")
+        rows = run()
+        print_table(rows, ["best_s", "median_s", next(k for k in rows[0] if k.endswith("_per_s"))])
+        results.extend(rows)
+
+    params = {k: v for k, v in vars(args).items() if k != "out"}
+    params.update(k=K, window=WINDOW)
+    path = save_results("micro", params, results, args.out and pathlib.Path(args.out))
+    print(f"results: {path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+# benchmarks/bench_storage.py
+"""
+Row storage (code_postings_XX) vs compressed blocks (code_posting_blocks_XX +
+code_order_lines, see posting_blocks.py) vs the memory-mapped local index
+(posting_index.py) on the local database stand-in.
+
+1. A synthetic corpus is indexed through OrderIndexer (row tables), then
+   converted by convert_posting_blocks.convert() and exported by
+   export_posting_index.export(), both timed.
+2. Size: pages per table and index from SQLite's dbstat (file bytes for the
+   local index), plus the encoded payload bytes, per posting.
+3. Latency: the same queries through /api/duplicate-check-v2 with each
+   backend (recall and rerank_fetch stage times from the debug block);
+   the reports of all backends must be identical to the rows backend's.
+
+    python -m benchmarks.bench_storage [--docs 300] [--queries 40]
+
+Results go to benchmarks/results/storage-<timestamp>.json (see benchmarks.compare).
+"""
+import argparse
+import asyncio
+import os
+import pathlib
+import statistics
+import tempfile
+import time
+
+from benchmarks import local_db
+from benchmarks.common import latency_summary, print_table, save_results
+from benchmarks.corpus import LANGUAGES, generate_corpus, generate_queries
+
+BACKENDS = ("rows", "blocks", "mmap")
+
+def configure_env(args, url: str, index_dir: pathlib.Path) -> None:
+    os.environ["DATABASE_URL"] = url
+    os.environ["INDEXER_ENABLED"] = "false"
+    os.environ["FP_POOL_WORKERS"] = "0"
+    os.environ["RESULT_CACHE_SIZE"] = "0"
+    os.environ["RECALL_CACHE_MAX_ENTRIES"] = "0"
+    os.environ["POSTING_INDEX_DIR"] = str(index_dir)
+
+def storage_group(name: str):
+    if "code_postings_" in name:
+        return "rows"
+    if "code_posting_blocks_" in name or "code_order_lines" in name:
+        return "blocks"
+    return None
+
+async def convert_and_measure(url: str) -> list:
+    from tortoise import Tortoise, connections
+
+    import convert_posting_blocks
+    import export_posting_index
+    from config import settings
+
+    await Tortoise.init(db_url=url, modules={"model": ["models"]})
+    try:
+        conn = connections.get("default")
+        await local_db.create_block_tables(conn)
+        from shard_router import router
+
+        t0 = time.perf_counter()
+        totals = await convert_posting_blocks.convert(list(router.shards), create=False)
+        elapsed = time.perf_counter() - t0
+        pages = await conn.execute_query_dict("SELECT name, COUNT(*) AS pages, SUM(pgsize) AS bytes FROM dbstat GROUP BY name")
+        t0 = time.perf_counter()
+        meta = await export_posting_index.export(settings.POSTING_INDEX_DIR)
+        export_elapsed = time.perf_counter() - t0
+    finally:
+        await Tortoise.close_connections()
+
+    size = {g: {"pages": 0, "bytes": 0} for g in BACKENDS}
+    size["mmap"]["bytes"] = sum(f.stat().st_size for f in pathlib.Path(settings.POSTING_INDEX_DIR).iterdir())
+    for r in pages:
+        group = storage_group(r["name"])
+        if group:
+            size[group]["pages"] += int(r["pages"])
+            size[group]["bytes"] += int(r["bytes"])
+    postings = totals["postings"]
+    return [
+        {"name": "convert/blocks", "seconds": elapsed, "postings_per_s": postings / elapsed},
+        {"name": "export/mmap", "seconds": export_elapsed, "postings_per_s": postings / export_elapsed},
+        {
+            "name": "storage/rows",
+            "postings": postings,
+            **size["rows"],
+            "bytes_per_posting": size["rows"]["bytes"] / postings,
+            # (fp, order_id, pos, start_line, end_line) 的定长部分
+            "payload_bytes_per_posting": 24.0,
+        },
+        {
+            "name": "storage/blocks",
+            "postings": postings,
+            **size["blocks"],
+            "bytes_per_posting": size["blocks"]["bytes"] / postings,
+            "payload_bytes_per_posting": (totals["bytes"] + totals["line_bytes"]) / postings,
+            "fps": totals["fps"],
+            "line_maps": totals["line_orders"],
+        },
+        {
+            "name": "storage/mmap",
+            "postings": meta["n_postings"],
+            **size["mmap"],
+            "bytes_per_posting": size["mmap"]["bytes"] / postings,
+            # 4 个 int32 列，加上每个指纹的 fp 与 offset
+            "payload_bytes_per_posting": (16 * meta["n_postings"] + 16 * meta["n_fps"]) / postings,
+            "fps": meta["n_fps"],
+        },
+    ]
+
+async def run_backends(queries) -> list:
+    import httpx
+
+    import main as service
+    from posting_backends import make_backend
+
+    app = service.app
+    results, reports = [], {}
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            for name in BACKENDS:
+                service.posting_backend = make_backend(name)
+                await service.posting_backend.load()
+                latencies, stages, bodies = [], {"recall": [], "rerank_fetch": []}, []
+                for q in queries:
+                    t0 = time.perf_counter()
+                    r = await client.post(
+                        "/api/duplicate-check-v2?debug=true", files={"file": (q.filename, q.code.encode("utf-8"))}
+                    )
+                    latencies.append(time.perf_counter() - t0)
+                    body = r.json()
+                    if r.status_code != 200 or "error" in body:
+                        raise RuntimeError(f"{name} {q.filename}: HTTP {r.status_code} {body}")
+                    debug = body.pop("debug")
+                    body.pop("process_time", None)
+                    bodies.append(body)
+                    for stage in stages:
+                        stages[stage].append(debug["stages_ms"].get(stage, 0.0))
+                reports[name] = bodies
+                results.append(
+                    {
+                        "name": f"e2e/v2/{name}",
+                        **latency_summary(latencies),
+                        "recall_ms": statistics.fmean(stages["recall"]),
+                        "rerank_fetch_ms": statistics.fmean(stages["rerank_fetch"]),
+                    }
+                )
+    for r, name in zip(results, BACKENDS):
+        r["identical_reports"] = int(reports[name] == reports["rows"])
+    return results
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--docs", type=int, default=300, help="入库订单数")
+    ap.add_argument("--lines", type=int, default=300, help="每个订单的行数")
+    ap.add_argument("--dup-rate", type=float, default=0.2, help="订单之间的复制比例")
+    ap.add_argument("--queries", type=int, default=40)
+    ap.add_argument("--query-lines", type=int, default=300)
+    ap.add_argument("--query-dup-rate", type=float, default=0.3, help="查询文件从订单复制的行比例")
+    ap.add_argument("--languages", default=",".join(LANGUAGES))
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--out", default=None, help="结果文件路径，默认 benchmarks/results/storage-<时间>.json")
+    args = ap.parse_args()
+
+    languages = args.languages.split(",")
+    docs = generate_corpus(args.docs, args.lines, args.dup_rate, languages, args.seed)
+    queries = generate_queries(docs, args.queries, args.query_lines, args.query_dup_rate, args.seed + 1)
+
+    tmp = tempfile.TemporaryDirectory(prefix="bench_storage_")
+    local_db.install()
+    url = local_db.db_url(pathlib.Path(tmp.name) / "bench.sqlite3")
+    configure_env(args, url, pathlib.Path(tmp.name) / "posting_index")
+
+    from benchmarks.bench_e2e import seed
+    from config import settings
+
+    try:
+        results = [asyncio.run(seed(url, docs, settings.FP_HASH_SCHEME))]
+        results.extend(asyncio.run(convert_and_measure(url)))
+        results.extend(asyncio.run(run_backends(queries)))
+    finally:
+        tmp.cleanup()
+
+    print_table(results[:3], ["seconds", "orders_per_s", "postings_per_s"])
+    print_table(results[3:6], ["postings", "pages", "bytes", "bytes_per_posting", "payload_bytes_per_posting"])
+    print_table(results[6:], ["mean_ms", "p50_ms", "p90_ms", "recall_ms", "rerank_fetch_ms", "identical_reports"])
+    params = {k: v for k, v in vars(args).items() if k != "out"}
+    params["hash_scheme"] = settings.FP_HASH_SCHEME
+    path = save_results("storage", params, results, args.out and pathlib.Path(args.out))
+    print(f"results: {path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# benchmarks/common.py
+"""
+Timing helpers and the JSON result format shared by the benchmark scripts.
+
+A result file is
+
+    {"suite": ..., "created_at": ..., "environment": {...}, "params": {...},
+     "results": [{"name": ..., <numeric metrics>}, ...]}
+
+and benchmarks.compare diffs two of them by result name.
+"""
+import datetime
+import json
+import os
+import pathlib
+import platform
+import statistics
+import subprocess
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+RESULTS_DIR = ROOT / "benchmarks" / "results"
+
+def time_call(fn: Callable[[], object], repeat: int = 5, min_seconds: float = 0.2) -> Dict[str, float]:
+    """
+    Run fn() in `repeat` rounds; each round loops until it has taken at least
+    min_seconds, so fast functions are not timed below clock resolution.
+    Returns per-call seconds (best/median of the rounds) and calls per round.
+    """
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_seconds or number >= 1 << 20:
+            break
+        number *= 2 if elapsed <= 0 else max(2, min(10, int(min_seconds / elapsed) + 1))
+    rounds = [elapsed / number]
+    for _ in range(repeat - 1):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        rounds.append((time.perf_counter() - t0) / number)
+    return {"best_s": min(rounds), "median_s": statistics.median(rounds), "calls": number}
+
+def latency_summary(samples: Sequence[float]) -> Dict[str, float]:
+    """Milliseconds: mean and p50/p90/p99 of a list of per-request seconds."""
+    ms = sorted(s * 1000 for s in samples)
+    if not ms:
+        return {}
+
+    def pct(p: float) -> float:
+        return ms[min(len(ms) - 1, int(round(p / 100 * (len(ms) - 1))))]
+
+    return {
+        "requests": len(ms),
+        "mean_ms": statistics.fmean(ms),
+        "p50_ms": pct(50),
+        "p90_ms": pct(90),
+        "p99_ms": pct(99),
+        "max_ms": ms[-1],
+    }
+
+def _git_revision() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, timeout=10
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+def environment() -> dict:
+    try:
+        import numpy
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": numpy_version,
+        "git_revision": _git_revision(),
+    }
+
+def save_results(suite: str, params: dict, results: List[dict], out: Optional[pathlib.Path] = None) -> pathlib.Path:
+    """Write a result file (default benchmarks/results/<suite>-<timestamp>.json) and return its path."""
+    created_at = datetime.datetime.now()
+    if out is None:
+        out = RESULTS_DIR / f"{suite}-{created_at.strftime('%Y%m%d_%H%M%S')}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    payload = {
+        "suite": suite,
+        "created_at": created_at.isoformat(timespec="seconds"),
+        "environment": environment(),
+        "params": params,
+        "results": results,
+    }
+    out.write_text(json.dumps(payload, indent=1, ensure_ascii=False), encoding="utf-8")
+    return out
+
+def _cell(v) -> str:
+    if v is None:
+        return "-"
+    if isinstance(v, float):
+        return f"{v:.6f}" if abs(v) < 1 else f"{v:,.1f}"
+    return f"{v:,}"
+
+def print_table(results: List[dict], columns: Sequence[str]) -> None:
+    width = max([len("name")] + [len(r["name"]) for r in results]) + 2
+    widths = [max(14, len(c) + 2) for c in columns]
+    print(f"{'name':<{width}}" + "".join(f"{c:>{w}}" for c, w in zip(columns, widths)))
+    for r in results:
+        print(f"{r['name']:<{width}}" + "".join(f"{_cell(r.get(c)):>{w}}" for c, w in zip(columns, widths)))
@@ -0,0 +1,58 @@
+# benchmarks/compare.py
+"""
+Compare two benchmark result files (bench_micro / bench_e2e JSON) by result
+name.
+
+    python -m benchmarks.compare baseline.json candidate.json [--metric best_s] [--threshold 0.05]
+
+For every result present in both runs, prints the metric in each and the
+ratio candidate / baseline. Metrics ending in _s or _ms are times (lower is
+better), everything else (rps, *_per_s) is a rate (higher is better); changes
+beyond --threshold are marked as faster/slower. Without --metric the first
+of best_s, p50_ms, seconds present in the result is used.
+"""
+import argparse
+import json
+import pathlib
+
+DEFAULT_METRICS = ("best_s", "p50_ms", "seconds")
+
+def lower_is_better(metric: str) -> bool:
+    return metric.endswith(("_s", "_ms")) and not metric.endswith("_per_s") or metric == "seconds"
+
+def load(path: str) -> dict:
+    data = json.loads(pathlib.Path(path).read_text(encoding="utf-8"))
+    return {r["name"]: r for r in data["results"]}
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("baseline")
+    ap.add_argument("candidate")
+    ap.add_argument("--metric", default=None)
+    ap.add_argument("--threshold", type=float, default=0.05, help="超过该相对变化才标记快/慢")
+    args = ap.parse_args()
+
+    base = load(args.baseline)
+    cand = load(args.candidate)
+    names = [n for n in base if n in cand]
+    if not names:
+        raise SystemExit("no common results")
+
+    width = max(len(n) for n in names) + 2
+    print(f"{'name':<{width}}{'metric':>10}{'baseline':>14}{'candidate':>14}{'ratio':>9}")
+    for name in names:
+        metric = args.metric or next((m for m in DEFAULT_METRICS if m in base[name]), None)
+        if metric is None or metric not in base[name] or metric not in cand[name]:
+            continue
+        old, new = base[name][metric], cand[name][metric]
+        ratio = new / old if old else float("inf")
+        better = ratio < 1 if lower_is_better(metric) else ratio > 1
+        mark = "" if abs(ratio - 1) <= args.threshold else "  faster" if better else "  SLOWER"
+        print(f"{name:<{width}}{metric:>10}{old:>14.6g}{new:>14.6g}{ratio:>9.3f}{mark}")
+    for name in base.keys() - cand.keys():
+        print(f"{name}: only in baseline")
+    for name in cand.keys() - base.keys():
+        print(f"{name}: only in candidate")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+# benchmarks/corpus.py
+"""
+Synthetic code corpus for the benchmarks: deterministic, multi-language, with
+a controllable duplication rate.
+
+Each document is a sequence of generated functions (Python, Java, C or
+JavaScript syntax) into which blocks of lines copied verbatim from earlier
+documents are spliced until `dup_rate` of its lines are copies. The copied
+line count is recorded per document, so end-to-end runs can report the
+expected duplicate rate next to the measured one.
+
+    python -m benchmarks.corpus out_dir --docs 200 --lines 300 --dup-rate 0.3 --seed 1
+
+writes one file per document plus manifest.json.
+"""
+import argparse
+import json
+import pathlib
+import random
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional, Sequence, Tuple
+
+LANGUAGES = ("python", "java", "c", "javascript")
+
+# 每种语言的语句模板；brace=None 表示靠缩进（Python）
+SYNTAX = {
+    "python": {
+        "ext": ".py",
+        "header": ["import math", "import sys", "from collections import defaultdict"],
+        "func": "def {name}({args}):",
+        "assign": "{v} = {expr}",
+        "loop": "for {i} in range({n}):",
+        "cond": "if {v} > {n}:",
+        "call": "{v} = {f}({args})",
+        "print": 'print("{text}", {v})',
+        "ret": "return {v}",
+        "comment": "# {text}",
+        "brace": None,
+    },
+    "java": {
+        "ext": ".java",
+        "header": ["import java.util.*;", "import java.io.*;"],
+        "func": "public static int {name}({typed_args}) {{",
+        "assign": "int {v} = {expr};",
+        "loop": "for (int {i} = 0; {i} < {n}; {i}++) {{",
+        "cond": "if ({v} > {n}) {{",
+        "call": "{v} = {f}({args});",
+        "print": 'System.out.println("{text}" + {v});',
+        "ret": "return {v};",
+        "comment": "// {text}",
+        "brace": "}",
+    },
+    "c": {
+        "ext": ".c",
+        "header": ["#include <stdio.h>", "#include <stdlib.h>", "#include <string.h>"],
+        "func": "int {name}({typed_args}) {{",
+        "assign": "int {v} = {expr};",
+        "loop": "for (int {i} = 0; {i} < {n}; {i}++) {{",
+        "cond": "if ({v} > {n}) {{",
+        "call": "{v} = {f}({args});",
+        "print": 'printf("{text} %d\\n", {v});',
+        "ret": "return {v};",
+        "comment": "/* {text} */",
+        "brace": "}",
+    },
+    "javascript": {
+        "ext": ".js",
+        "header": ["'use strict';", "const fs = require('fs');"],
+        "func": "function {name}({args}) {{",
+        "assign": "let {v} = {expr};",
+        "loop": "for (let {i} = 0; {i} < {n}; {i}++) {{",
+        "cond": "if ({v} > {n}) {{",
+        "call": "{v} = {f}({args});",
+        "print": 'console.log("{text}", {v});',
+        "ret": "return {v};",
+        "comment": "// {text}",
+        "brace": "}",
+    },
+}
+
+WORDS = (
+    "count total index value result buffer item node size offset score price "
+    "student course grade order user record cache queue stack left right temp "
+    "sum avg max min key data list map flag step"
+).split()
+OPS = ("+", "-", "*", "/", "%")
+COMMENT_WORDS = "check update compute handle load parse validate store sort merge".split()
+
+@dataclass
+class Document:
+    doc_id: int
+    language: str
+    code: str
+    # (来源文档 id, 该文档中的起始行, 本文档中的起始行, 行数)
+    copied: List[Tuple[int, int, int, int]] = field(default_factory=list)
+
+    @property
+    def total_lines(self) -> int:
+        return len(self.code.split("\n"))
+
+    @property
+    def copied_lines(self) -> int:
+        return sum(n for *_, n in self.copied)
+
+    @property
+    def filename(self) -> str:
+        return f"doc_{self.doc_id:05d}{SYNTAX[self.language]['ext']}"
+
+def _ident(rng: random.Random) -> str:
+    return f"{rng.choice(WORDS)}{rng.choice(WORDS).capitalize()}{rng.randrange(100)}"
+
+def _expr(rng: random.Random, names: Sequence[str]) -> str:
+    terms = [rng.choice(names) if names and rng.random() < 0.6 else str(rng.randrange(1, 1000))
+             for _ in range(rng.randint(1, 4))]
+    out = terms[0]
+    for t in terms[1:]:
+        out += f" {rng.choice(OPS)} {t}"
+    return out
+
+def generate_function(rng: random.Random, language: str) -> List[str]:
+    """One function of 6-40 lines in `language`."""
+    syn = SYNTAX[language]
+    params = [_ident(rng) for _ in range(rng.randint(1, 3))]
+    names = list(params)
+    lines = [syn["func"].format(
+        name=_ident(rng), args=", ".join(params), typed_args=", ".join(f"int {p}" for p in params)
+    )]
+    depth = 1
+    open_blocks = 0
+    for _ in range(rng.randint(4, 30)):
+        pad = "    " * depth
+        kind = rng.random()
+        if kind < 0.35:
+            v = _ident(rng)
+            lines.append(pad + syn["assign"].format(v=v, expr=_expr(rng, names)))
+            names.append(v)
+        elif kind < 0.45 and depth < 4:
+            lines.append(pad + syn["loop"].format(i=rng.choice("ijk"), n=_expr(rng, names)))
+            depth += 1
+            open_blocks += 1
+        elif kind < 0.55 and depth < 4:
+            lines.append(pad + syn["cond"].format(v=rng.choice(names), n=rng.randrange(100)))
+            depth += 1
+            open_blocks += 1
+        elif kind < 0.65 and open_blocks:
+            depth -= 1
+            open_blocks -= 1
+            if syn["brace"]:
+                lines.append("    " * depth + syn["brace"])
+        elif kind < 0.75:
+            lines.append(pad + syn["call"].format(
+                v=rng.choice(names), f=_ident(rng), args=", ".join(rng.sample(names, min(2, len(names))))
+            ))
+        elif kind < 0.85:
+            lines.append(pad + syn["print"].format(text=rng.choice(COMMENT_WORDS), v=rng.choice(names)))
+        else:
+            lines.append(pad + syn["comment"].format(text=" ".join(rng.sample(COMMENT_WORDS, 3))))
+    while open_blocks:
+        depth -= 1
+        open_blocks -= 1
+        if syn["brace"]:
+            lines.append("    " * depth + syn["brace"])
+    lines.append("    " + syn["ret"].format(v=rng.choice(names)))
+    if syn["brace"]:
+        lines.append(syn["brace"])
+    lines.append("")
+    return lines
+
+def generate_source(rng: random.Random, language: str, n_lines: int) -> List[str]:
+    """Fresh (non-copied) code of exactly n_lines lines."""
+    lines = list(SYNTAX[language]["header"]) + [""]
+    while len(lines) < n_lines:
+        lines.extend(generate_function(rng, language))
+    return lines[:n_lines]
+
+def mix_document(
+    rng: random.Random,
+    doc_id: int,
+    language: str,
+    n_lines: int,
+    dup_rate: float,
+    donors: Sequence[Document],
+    block_lines: Tuple[int, int] = (15, 60),
+) -> Document:
+    """
+    A document of n_lines lines of which about dup_rate are copied, in blocks
+    of block_lines lines, from random donors (same language when possible).
+    """
+    same = [d for d in donors if d.language == language] or list(donors)
+    target = round(n_lines * dup_rate) if same else 0
+    blocks = []
+    copied_total = 0
+    while copied_total < target:
+        donor = rng.choice(same)
+        donor_lines = donor.code.split("\n")
+        size = min(rng.randint(*block_lines), target - copied_total, len(donor_lines))
+        if size <= 0:
+            break
+        start = rng.randrange(len(donor_lines) - size + 1)
+        blocks.append((donor.doc_id, start + 1, donor_lines[start:start + size]))
+        copied_total += size
+
+    fresh = generate_source(rng, language, n_lines - copied_total)
+    # 复制块插在随机位置（按新代码的行号切开，块之间不重叠）
+    cuts = sorted(rng.randrange(len(fresh) + 1) for _ in blocks)
+    lines: List[str] = []
+    copied = []
+    prev = 0
+    for cut, (donor_id, donor_start, block) in zip(cuts, blocks):
+        lines.extend(fresh[prev:cut])
+        copied.append((donor_id, donor_start, len(lines) + 1, len(block)))
+        lines.extend(block)
+        prev = cut
+    lines.extend(fresh[prev:])
+    return Document(doc_id, language, "\n".join(lines), copied)
+
+def generate_corpus(
+    n_docs: int,
+    lines_per_doc: int = 300,
+    dup_rate: float = 0.2,
+    languages: Sequence[str] = LANGUAGES,
+    seed: int = 0,
+    first_id: int = 1,
+) -> List[Document]:
+    """n_docs documents; each copies dup_rate of its lines from the documents before it."""
+    rng = random.Random(seed)
+    docs: List[Document] = []
+    for i in range(n_docs):
+        language = languages[i % len(languages)]
+        docs.append(mix_document(rng, first_id + i, language, lines_per_doc, dup_rate, docs))
+    return docs
+
+def generate_queries(
+    corpus: Sequence[Document],
+    n_queries: int,
+    lines: int = 300,
+    dup_rate: float = 0.3,
+    seed: int = 1,
+    languages: Optional[Sequence[str]] = None,
+) -> List[Document]:
+    """Uploads to check against `corpus`: dup_rate of each query's lines are copied from it."""
+    rng = random.Random(seed)
+    languages = languages or sorted({d.language for d in corpus}) or list(LANGUAGES)
+    return [
+        mix_document(rng, -(i + 1), languages[i % len(languages)], lines, dup_rate, corpus)
+        for i in range(n_queries)
+    ]
+
+def write_corpus(docs: Sequence[Document], out_dir: pathlib.Path) -> None:
+    out_dir.mkdir(parents=True, exist_ok=True)
+    manifest = []
+    for d in docs:
+        (out_dir / d.filename).write_text(d.code, encoding="utf-8")
+        entry = asdict(d)
+        del entry["code"]
+        entry.update(filename=d.filename, total_lines=d.total_lines, copied_lines=d.copied_lines)
+        manifest.append(entry)
+    (out_dir / "manifest.json").write_text(json.dumps(manifest, indent=1), encoding="utf-8")
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("out_dir", type=pathlib.Path)
+    ap.add_argument("--docs", type=int, default=200)
+    ap.add_argument("--lines", type=int, default=300, help="每个文档的行数")
+    ap.add_argument("--dup-rate", type=float, default=0.2, help="每个文档从之前文档复制的行比例")
+    ap.add_argument("--languages", default=",".join(LANGUAGES))
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+
+    docs = generate_corpus(args.docs, args.lines, args.dup_rate, args.languages.split(","), args.seed)
+    write_corpus(docs, args.out_dir)
+    print(f"{len(docs)} documents, {sum(d.total_lines for d in docs):,} lines -> {args.out_dir}")
+
+if __name__ == "__main__":
+    main()
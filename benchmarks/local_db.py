@@ -0,0 +1,87 @@
+# benchmarks/local_db.py
+"""
+Local database stand-in for the end-to-end benchmarks: SQLite behind the
+service's own Tortoise setup, so main.py, posting_writer and the indexer run
+unchanged without a MySQL server.
+
+The service's raw SQL uses MySQL's `%s` placeholders; the client below
+rewrites them to SQLite's `?`. install() registers it as the `benchsqlite`
+URL scheme, i.e. DATABASE_URL=benchsqlite:///tmp/bench.sqlite3.
+create_posting_tables() creates what posting_schema.sql creates on MySQL
+(the POSTING_SHARDS shard tables and stop_fingerprints), create_block_tables()
+what convert_posting_blocks.py creates.
+
+Absolute numbers are SQLite's, not MySQL's; use the stand-in to compare
+runs of the service code against each other.
+"""
+from urllib import parse as urlparse
+
+from tortoise.backends.base.client import NestedTransactionContext, TransactionContext
+from tortoise.backends.base.config_generator import DB_LOOKUP
+from tortoise.backends.sqlite.client import SqliteClient, SqliteTransactionContext, SqliteTransactionWrapper
+
+SCHEME = "benchsqlite"
+
+def _qmark(query: str) -> str:
+    return query.replace("%s", "?")
+
+class _QmarkMixin:
+    async def execute_insert(self, query: str, values: list) -> int:
+        return await super().execute_insert(_qmark(query), values)
+
+    async def execute_many(self, query: str, values: list) -> None:
+        await super().execute_many(_qmark(query), values)
+
+    async def execute_query(self, query: str, values=None):
+        return await super().execute_query(_qmark(query), values)
+
+    async def execute_query_dict(self, query: str, values=None):
+        return await super().execute_query_dict(_qmark(query), values)
+
+class LocalSqliteClient(_QmarkMixin, SqliteClient):
+    def _in_transaction(self) -> TransactionContext:
+        return SqliteTransactionContext(LocalSqliteTransactionWrapper(self), self._lock)
+
+class LocalSqliteTransactionWrapper(_QmarkMixin, SqliteTransactionWrapper):
+    def _in_transaction(self) -> TransactionContext:
+        return NestedTransactionContext(LocalSqliteTransactionWrapper(self))
+
+# Tortoise 按 engine 模块的 client_class 创建连接
+client_class = LocalSqliteClient
+
+def install() -> None:
+    """Make `benchsqlite://<path>` URLs resolve to LocalSqliteClient."""
+    if SCHEME not in DB_LOOKUP:
+        urlparse.uses_netloc.append(SCHEME)
+        DB_LOOKUP[SCHEME] = {**DB_LOOKUP["sqlite"], "engine": __name__}
+
+def db_url(path) -> str:
+    return f"{SCHEME}://{path}"
+
+async def create_posting_tables(conn, router=None) -> None:
+    """Posting tables of `router` (default: the configured layout); config is imported lazily, see bench_e2e."""
+    if router is None:
+        from shard_router import router
+    statements = ["CREATE TABLE IF NOT EXISTS stop_fingerprints (fp BIGINT NOT NULL PRIMARY KEY, df INT NOT NULL)"]
+    for tbl in router.tables():
+        statements.append(
+            f"CREATE TABLE IF NOT EXISTS {tbl} (fp BIGINT NOT NULL, order_id INT NOT NULL, pos INT NOT NULL, "
+            f"start_line INT NOT NULL, end_line INT NOT NULL, PRIMARY KEY (fp, order_id, pos))"
+        )
+        statements.append(f"CREATE INDEX IF NOT EXISTS idx_{tbl}_order_pos ON {tbl} (order_id, pos)")
+    await conn.execute_script(";\n".join(statements) + ";")
+
+async def create_block_tables(conn, router=None) -> None:
+    from posting_backends import BLOCK_TABLE_PREFIX, LINES_TABLE
+    if router is None:
+        from shard_router import router
+    statements = [
+        f"CREATE TABLE IF NOT EXISTS {LINES_TABLE} (order_id INT NOT NULL PRIMARY KEY, "
+        f"n_positions INT NOT NULL, data BLOB NOT NULL)"
+    ]
+    for shard in router.shards:
+        statements.append(
+            f"CREATE TABLE IF NOT EXISTS {router.table(shard, BLOCK_TABLE_PREFIX)} (fp BIGINT NOT NULL PRIMARY KEY, "
+            f"n_orders INT NOT NULL, n_postings INT NOT NULL, data BLOB NOT NULL)"
+        )
+    await conn.execute_script(";\n".join(statements) + ";")
@@ -0,0 +1,68 @@
+# build_stop_fingerprints.py
+"""
+离线统计每个指纹的文档频率 (DF = 命中的不同 order 数)，把 DF >= 阈值的指纹写入
+stop_fingerprints。查重服务启动时载入这张表，在查询任何分片之前剔除这些模板指纹。
+
+    python build_stop_fingerprints.py [--min-df 500] [--concurrency 8]
+
+跑完后需要重启查重服务（或等下次启动）才会生效。
+"""
+import argparse
+import asyncio
+import time
+
+from tortoise import Tortoise, run_async
+from tortoise.transactions import in_transaction
+
+from config import settings
+from shard_router import check_layout, router
+from winnowing_utils import to_uint64
+
+INSERT_BATCH = 1000
+
+def chunked(lst, n):
+    for i in range(0, len(lst), n):
+        yield lst[i:i+n]
+
+async def init():
+    await Tortoise.init(db_url=settings.DATABASE_URL, modules={"model": ["models"]})
+    await check_layout()
+
+async def scan_shard(shard: int, min_df: int, sem: asyncio.Semaphore):
+    # 同一个 fp 只会落在一个分片里，所以每个分片独立统计即是全局 DF
+    async with sem:
+        async with in_transaction() as conn:
+            rows = await conn.execute_query_dict(
+                f"SELECT fp, COUNT(DISTINCT order_id) AS df FROM {router.table(shard)} "
+                f"GROUP BY fp HAVING df >= %s",
+                [min_df],
+            )
+    print(f"shard {shard:02x}: {len(rows)} stop fingerprints")
+    return [(to_uint64(int(r["fp"])), int(r["df"])) for r in rows]
+
+async def build(min_df: int, concurrency: int):
+    await init()
+    t0 = time.time()
+    sem = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*[scan_shard(s, min_df, sem) for s in router.shards])
+    stop_rows = [row for res in results for row in res]
+
+    # 整表替换放在一个事务里，服务端加载时不会读到半张表
+    async with in_transaction() as conn:
+        await conn.execute_query("DELETE FROM stop_fingerprints")
+        for part in chunked(stop_rows, INSERT_BATCH):
+            values = []
+            for fp, df in part:
+                values.extend([fp, df])
+            sql = "INSERT INTO stop_fingerprints (fp, df) VALUES " + ",".join(["(%s,%s)"] * len(part))
+            await conn.execute_query(sql, values)
+
+    await Tortoise.close_connections()
+    print(f"done: {len(stop_rows)} stop fingerprints (df >= {min_df}) in {time.time() - t0:.1f}s")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Fill stop_fingerprints from the sharded posting tables")
+    ap.add_argument("--min-df", type=int, default=settings.STOP_FP_MIN_DF)
+    ap.add_argument("--concurrency", type=int, default=8)
+    args = ap.parse_args()
+    run_async(build(args.min_df, args.concurrency))
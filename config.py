@@ -21,6 +21,79 @@ class Settings(BaseSettings):
     LOG_FILENAME: str = f"./logs/ai_interaction_log_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
     MODEL: str = os.getenv("MODEL", "gemini-3-pro-preview")  # Default model
 
+    # --- 查重指纹 ---
+    # k-gram 哈希方案（见 winnowing_utils.HASH_SCHEMES）。服务端和重建脚本必须一致，
+    # 切换后需要用 rebuild_postings_sharded.py 全量重建分片索引
+    FP_HASH_SCHEME: str = os.getenv("FP_HASH_SCHEME", "blake2b-v1")
+
+    # --- v1 SimHash 内存索引 ---
+    # 启动时把 code_fingerprints 全量载入内存（多索引哈希），/api/duplicate-check 不再逐块查库
+    SIMHASH_MEMORY_INDEX: bool = os.getenv("SIMHASH_MEMORY_INDEX", "true")
+    # 定期增量加载新写入的 code_fingerprints 行（秒）
+    SIMHASH_INDEX_REFRESH_SECONDS: int = os.getenv("SIMHASH_INDEX_REFRESH_SECONDS", "60")
+
+    # --- 指纹计算进程池 ---
+    # 进程数，0 表示不启用进程池（全部在事件循环内计算）
+    FP_POOL_WORKERS: int = os.getenv("FP_POOL_WORKERS", "2")
+    # 小于该字符数的文件直接在事件循环内计算，省去进程间传输
+    FP_INLINE_MAX_CHARS: int = os.getenv("FP_INLINE_MAX_CHARS", "20000")
+    # 同时在进程池中排队/执行的任务上限，0 表示 2 * FP_POOL_WORKERS
+    FP_POOL_MAX_PENDING: int = os.getenv("FP_POOL_MAX_PENDING", "0")
+    # 等待进程池空位的最长时间（秒），超时返回 503
+    FP_POOL_QUEUE_TIMEOUT: float = os.getenv("FP_POOL_QUEUE_TIMEOUT", "30")
+
+    # --- 停用指纹（模板代码） ---
+    # build_stop_fingerprints.py 的 DF 阈值：命中不少于该数量订单的指纹视为模板指纹
+    STOP_FP_MIN_DF: int = os.getenv("STOP_FP_MIN_DF", "500")
+    # drop: 查询前直接剔除；recall: 只在召回阶段剔除，精排对齐仍使用；off: 不使用（其他值启动时报错）
+    STOP_FP_MODE: str = os.getenv("STOP_FP_MODE", "drop")
+
+    # --- 上传处理 ---
+    # 超过该字节数的上传按块流式解码/分词/winnowing，内存与文件大小无关；小文件仍整体读入
+    STREAM_UPLOAD_MIN_BYTES: int = os.getenv("STREAM_UPLOAD_MIN_BYTES", "4194304")
+    # 批量查重（/api/duplicate-check-v2/batch）：文件数上限（zip 内的文件逐个计数）与解压后总大小上限
+    BATCH_MAX_FILES: int = os.getenv("BATCH_MAX_FILES", "500")
+    BATCH_MAX_TOTAL_BYTES: int = os.getenv("BATCH_MAX_TOTAL_BYTES", "268435456")
+    # 批内两两比对（mode=pairs/both）：出现在超过该比例文件中的指纹视为公共模板（如题目给的框架代码）
+    BATCH_PAIR_MAX_DF_RATIO: float = os.getenv("BATCH_PAIR_MAX_DF_RATIO", "0.5")
+
+    # --- 分片倒排索引 ---
+    # code_postings_XX 分片表个数（2 的幂，最多 256），按指纹低位路由。服务端和所有脚本必须一致；
+    # 改动前先用 reshard_postings.py 拆分好新分片表并切换
+    POSTING_SHARDS: int = os.getenv("POSTING_SHARDS", "64")
+    # 召回/精排读取的存储格式（见 posting_backends.py）：rows 为 code_postings_XX 行存储；
+    # blocks 为 convert_posting_blocks.py 转换出的压缩指纹块快照，转换之后的变更从分片表补上；
+    # mmap 为 export_posting_index.py 导出的本地索引文件（单机部署，需要 numpy），导出之后的变更从分片表补上
+    POSTING_BACKEND: str = os.getenv("POSTING_BACKEND", "rows")
+    # mmap 后端的索引目录；mmap / blocks 没有新请求触发时多久检查一次索引版本号 / 新快照（秒）
+    POSTING_INDEX_DIR: str = os.getenv("POSTING_INDEX_DIR", str(BASE_DIR / "data" / "posting_index"))
+    POSTING_INDEX_SYNC_SECONDS: float = os.getenv("POSTING_INDEX_SYNC_SECONDS", "30")
+    # 按 code_doc_stats.updated_at 增量扫描变更时回退的秒数：updated_at 由应用写入，
+    # 长事务或服务器间时钟偏差会让时间戳较早的行晚于已扫到的行提交
+    CHANGE_SCAN_LAG_SECONDS: float = os.getenv("CHANGE_SCAN_LAG_SECONDS", "300")
+
+    # --- v2 查重结果缓存 ---
+    # 按归一化 token 序列 + top_n + exclude_order_ids 缓存召回/精排结果，0 表示关闭
+    RESULT_CACHE_SIZE: int = os.getenv("RESULT_CACHE_SIZE", "512")
+    RESULT_CACHE_TTL_SECONDS: float = os.getenv("RESULT_CACHE_TTL_SECONDS", "600")
+    # 多久重新读取一次 index_state 中的索引版本号（秒）；版本号变化后旧缓存全部失效
+    INDEX_GENERATION_POLL_SECONDS: float = os.getenv("INDEX_GENERATION_POLL_SECONDS", "5")
+    # 召回缓存：热门指纹的 order_id -> 命中数 摘要，按条目数（每个 order 一条）限制内存，0 表示关闭
+    RECALL_CACHE_MAX_ENTRIES: int = os.getenv("RECALL_CACHE_MAX_ENTRIES", "2000000")
+    # 内存中的 code_doc_stats（候选按文档指纹数归一化排序）增量刷新间隔（秒）
+    DOC_STATS_REFRESH_SECONDS: int = os.getenv("DOC_STATS_REFRESH_SECONDS", "300")
+
+    # --- 增量索引（订单 COMPLETED 后自动写入查重索引） ---
+    # 多进程部署时只在一个进程里开启
+    INDEXER_ENABLED: bool = os.getenv("INDEXER_ENABLED", "true")
+    # 轮询 code_orders.updated_at 的间隔（秒）；/api/index-orders 入队会立即唤醒
+    INDEXER_POLL_SECONDS: float = os.getenv("INDEXER_POLL_SECONDS", "30")
+    # 每批写入的订单数、同时计算指纹的订单数
+    INDEXER_BATCH_SIZE: int = os.getenv("INDEXER_BATCH_SIZE", "50")
+    INDEXER_CONCURRENCY: int = os.getenv("INDEXER_CONCURRENCY", "4")
+    # 单个订单失败多少次后标记为 FAILED
+    INDEXER_MAX_ATTEMPTS: int = os.getenv("INDEXER_MAX_ATTEMPTS", "3")
+
 settings = Settings()
 (BASE_DIR / 'data').mkdir(parents=True, exist_ok=True)
 (BASE_DIR / 'logs').mkdir(parents=True, exist_ok=True)
\ No newline at end of file
@@ -0,0 +1,204 @@
+# convert_posting_blocks.py
+"""
+把 code_postings_XX 行存储转换为压缩块格式（posting_blocks.py），供 POSTING_BACKEND=blocks 使用：
+  code_posting_blocks_XX  每个指纹一行：(order_id, pos) 列表，delta + varint 编码
+  code_order_lines        每个订单一行：pos -> (start_line, end_line)
+
+    python convert_posting_blocks.py [--shards 0,1,2] [--no-lines] [--batch-rows 20000] [--order-batch 500]
+
+每个分片按主键顺序分批读取（--batch-rows 行一批），同一指纹的行凑齐后编码，每批在一个事务里
+替换块表中对应的指纹区间：转换过程中按 blocks 查询的服务读到的每个指纹要么是旧块要么是新块。
+行号表按 order_id 区间（--order-batch 个 id）从所有分片读取后整段替换。
+开始前记下 postings 的索引版本号和 code_doc_stats.updated_at 的最大值（watermark），完成后写入
+index_state（name='posting_blocks' / 'posting_blocks_watermark'）并递增索引版本号：服务把
+watermark 之后新索引、重新索引的订单从分片表读进覆盖层，删除的订单被屏蔽（见 posting_backends）。
+转换过程中重新索引的订单，块和行号表可能来自不同时刻，它们的 updated_at 不早于 watermark，
+查询时同样由覆盖层代替。可以重复运行（全量刷新快照）。
+"""
+import argparse
+import asyncio
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence
+
+from tortoise import Tortoise, run_async
+from tortoise.functions import Max
+from tortoise.transactions import in_transaction
+
+from config import settings
+from index_generation import read_generation
+from models import CodeDocStat, CodeOrder
+from posting_backends import BLOCK_TABLE_PREFIX, LINES_TABLE, record_blocks_snapshot
+from posting_blocks import encode_block, encode_line_map
+from posting_writer import chunked
+from shard_router import check_layout, router
+
+BATCH_ROWS = 20000
+ORDER_BATCH = 500
+INSERT_ROWS = 200  # 每条多行 INSERT 的块数（块可能很大）
+
+async def init():
+    await Tortoise.init(db_url=settings.DATABASE_URL, modules={"model": ["models"]})
+    await Tortoise.generate_schemas(safe=True)
+    await check_layout()
+
+async def create_tables(shards: Sequence[int]) -> None:
+    async with in_transaction() as conn:
+        for shard in shards:
+            await conn.execute_query(
+                f"CREATE TABLE IF NOT EXISTS {router.table(shard, BLOCK_TABLE_PREFIX)} ("
+                "fp BIGINT UNSIGNED NOT NULL, n_orders INT NOT NULL, n_postings INT NOT NULL, "
+                "data MEDIUMBLOB NOT NULL, PRIMARY KEY (fp)) ENGINE=InnoDB"
+            )
+        await conn.execute_query(
+            f"CREATE TABLE IF NOT EXISTS {LINES_TABLE} ("
+            "order_id INT NOT NULL, n_positions INT NOT NULL, data MEDIUMBLOB NOT NULL, "
+            "PRIMARY KEY (order_id)) ENGINE=InnoDB"
+        )
+
+def encode_blocks(rows: List[tuple]) -> List[tuple]:
+    """按 fp 排好序的 (fp, order_id, pos) -> [(fp, n_orders, n_postings, data)]"""
+    by_fp: Dict[int, list] = defaultdict(list)
+    for fp, oid, pos in rows:
+        by_fp[fp].append((oid, pos))
+    return [
+        (fp, len({oid for oid, _ in postings}), len(postings), encode_block(postings))
+        for fp, postings in by_fp.items()
+    ]
+
+async def convert_shard(shard: int, batch_rows: int) -> Dict[str, int]:
+    src = router.table(shard)
+    dst = router.table(shard, BLOCK_TABLE_PREFIX)
+    stats = {"fps": 0, "postings": 0, "bytes": 0}
+    last_fp: Optional[int] = None
+    while True:
+        async with in_transaction() as conn:
+            where, params = ("WHERE fp > %s ", [last_fp]) if last_fp is not None else ("", [])
+            rows = await conn.execute_query_dict(
+                f"SELECT fp, order_id, pos FROM {src} {where}ORDER BY fp, order_id, pos LIMIT {int(batch_rows)}",
+                params,
+            )
+            rows = [(int(r["fp"]), int(r["order_id"]), int(r["pos"])) for r in rows]
+            upto = None
+            if len(rows) == batch_rows:
+                # 最后一个指纹的行可能没读全：留给下一批；整批只有一个指纹（超热门指纹）时单独读完它
+                upto = rows[-1][0]
+                if rows[0][0] == upto:
+                    rows = await conn.execute_query_dict(
+                        f"SELECT fp, order_id, pos FROM {src} WHERE fp = %s ORDER BY order_id, pos", [upto]
+                    )
+                    rows = [(int(r["fp"]), int(r["order_id"]), int(r["pos"])) for r in rows]
+                else:
+                    rows = [r for r in rows if r[0] != upto]
+                    upto = rows[-1][0]
+            blocks = encode_blocks(rows)
+
+            conds, params = [], []
+            if last_fp is not None:
+                conds.append("fp > %s")
+                params.append(last_fp)
+            if upto is not None:
+                conds.append("fp <= %s")
+                params.append(upto)
+            await conn.execute_query(f"DELETE FROM {dst}" + (" WHERE " + " AND ".join(conds) if conds else ""), params)
+            for part in chunked(blocks, INSERT_ROWS):
+                values = [v for block in part for v in block]
+                sql = f"INSERT INTO {dst} (fp, n_orders, n_postings, data) VALUES " + ",".join(
+                    ["(%s,%s,%s,%s)"] * len(part)
+                )
+                await conn.execute_query(sql, values)
+        stats["fps"] += len(blocks)
+        stats["postings"] += len(rows)
+        stats["bytes"] += sum(len(b[3]) for b in blocks)
+        if upto is None:
+            return stats
+        last_fp = upto
+
+async def convert_lines(order_batch: int, concurrency: int) -> Dict[str, int]:
+    max_id = await CodeOrder.all().order_by("-id").first().values_list("id", flat=True) or 0
+    sem = asyncio.Semaphore(concurrency)
+    stats = {"orders": 0, "positions": 0, "bytes": 0}
+
+    async def read_shard(shard, lo, hi):
+        async with sem:
+            async with in_transaction() as conn:
+                return await conn.execute_query_dict(
+                    f"SELECT order_id, pos, start_line, end_line FROM {router.table(shard)} "
+                    f"WHERE order_id >= %s AND order_id < %s",
+                    [lo, hi],
+                )
+
+    for lo in range(0, max_id + 1, order_batch):
+        hi = lo + order_batch
+        by_order = defaultdict(list)
+        for rows in await asyncio.gather(*[read_shard(s, lo, hi) for s in router.shards]):
+            for r in rows:
+                by_order[int(r["order_id"])].append((int(r["pos"]), int(r["start_line"]), int(r["end_line"])))
+        maps = [(oid, len(set(rows)), encode_line_map(rows)) for oid, rows in sorted(by_order.items())]
+        async with in_transaction() as conn:
+            await conn.execute_query(f"DELETE FROM {LINES_TABLE} WHERE order_id >= %s AND order_id < %s", [lo, hi])
+            for part in chunked(maps, INSERT_ROWS):
+                values = [v for m in part for v in m]
+                sql = f"INSERT INTO {LINES_TABLE} (order_id, n_positions, data) VALUES " + ",".join(
+                    ["(%s,%s,%s)"] * len(part)
+                )
+                await conn.execute_query(sql, values)
+        stats["orders"] += len(maps)
+        stats["positions"] += sum(m[1] for m in maps)
+        stats["bytes"] += sum(len(m[2]) for m in maps)
+    return stats
+
+async def convert(
+    shards: Sequence[int],
+    lines: bool = True,
+    batch_rows: int = BATCH_ROWS,
+    order_batch: int = ORDER_BATCH,
+    concurrency: int = 4,
+    create: bool = True,
+) -> dict:
+    generation = await read_generation()
+    watermark = await CodeDocStat.all().annotate(m=Max("updated_at")).first().values_list("m", flat=True)
+    if create:
+        await create_tables(shards)
+    t0 = time.time()
+    sem = asyncio.Semaphore(concurrency)
+    totals = defaultdict(int)
+
+    async def one(shard):
+        async with sem:
+            stats = await convert_shard(shard, batch_rows)
+        print(
+            f"shard {shard:02x}: {stats['fps']} fps, {stats['postings']} postings, "
+            f"{stats['bytes']} bytes ({time.time() - t0:.1f}s)"
+        )
+        return stats
+
+    for stats in await asyncio.gather(*[one(s) for s in shards]):
+        for k, v in stats.items():
+            totals[k] += v
+    if lines:
+        line_stats = await convert_lines(order_batch, concurrency)
+        print(f"line maps: {line_stats}")
+        totals.update({f"line_{k}": v for k, v in line_stats.items()})
+    # 只转换了部分分片时不更新快照版本号
+    if lines and set(shards) == set(router.shards):
+        await record_blocks_snapshot(generation, watermark)
+    print(f"done in {time.time() - t0:.1f}s, snapshot of generation {generation} (watermark {watermark}): {dict(totals)}")
+    return dict(totals)
+
+async def main(args):
+    await init()
+    try:
+        shards = [int(s, 0) for s in args.shards.split(",")] if args.shards else list(router.shards)
+        await convert(shards, not args.no_lines, args.batch_rows, args.order_batch, args.concurrency)
+    finally:
+        await Tortoise.close_connections()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="把分片倒排索引转换为压缩块格式")
+    parser.add_argument("--shards", default="", help="只转换这些分片（逗号分隔，默认全部）")
+    parser.add_argument("--no-lines", action="store_true", help="不重建 code_order_lines")
+    parser.add_argument("--batch-rows", type=int, default=BATCH_ROWS)
+    parser.add_argument("--order-batch", type=int, default=ORDER_BATCH, help="行号表每次处理的 order_id 区间长度")
+    parser.add_argument("--concurrency", type=int, default=4)
+    run_async(main(parser.parse_args()))
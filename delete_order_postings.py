@@ -1,19 +1,100 @@
 # delete_order_postings.py
-import sys
+"""
+批量删除/重建订单的查重索引（客户取消订单时批量清理）。
+
+    python delete_order_postings.py 123 456 789
+    python delete_order_postings.py --file cancelled_ids.txt           # 每行一个或逗号分隔
+    python delete_order_postings.py --file ids.txt --reindex           # 重新计算并写入，而不是删除
+
+删除时每个分片最多一条 `order_id IN (...)`（按 1000 个一批），并且只碰订单分片清单
+(code_doc_stats.shard_mask) 里记录的分片；没有清单的旧订单才会扫全部分片。
+同时删除这些订单的 code_fingerprints（v1 SimHash）行和分片清单。
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 from tortoise import Tortoise, run_async
 from tortoise.transactions import in_transaction
 from config import settings
+from models import CodeFingerprint, CodeOrder, OrderStatus
+from index_generation import bump_generation
+from fingerprint_pool import posting_rows
+from posting_writer import DELETE_BATCH, ShardedPostingWriter, chunked, delete_orders, load_shard_masks
+from shard_router import check_layout
+from winnowing_utils import K, WINDOW
 
-def tbl(i: int) -> str:
-    return f"code_postings_{i:02x}"
+MAX_FPS_PER_DOC = 10000
 
-async def main(order_id: int):
-    await Tortoise.init(db_url=settings.DATABASE_URL, modules={"model": ["models"]})
+def read_ids(args):
+    text = " ".join(args.order_ids)
+    if args.file:
+        with open(args.file, encoding="utf-8") as f:
+            text += " " + f.read()
+    return sorted({int(x) for x in re.split(r"[\s,]+", text) if x.isdigit()})
+
+async def purge(order_ids, concurrency: int):
+    summary = await delete_orders(order_ids, concurrency=concurrency)
     async with in_transaction() as conn:
-        for i in range(64):
-            await conn.execute_query(f"DELETE FROM {tbl(i)} WHERE order_id=%s", [order_id])
-    await Tortoise.close_connections()
-    print(f"deleted postings for order_id={order_id}")
+        for sub in chunked(order_ids, DELETE_BATCH):
+            await CodeFingerprint.filter(order_id__in=sub).using_db(conn).delete()
+        await bump_generation(conn=conn)
+    print(
+        f"deleted postings for {summary['orders']} orders: {summary['statements']} DELETE statements "
+        f"on {summary['shards_touched']} shards ({summary['without_manifest']} orders without shard manifest)"
+    )
+
+async def reindex(order_ids, concurrency: int, workers: int):
+    writer = ShardedPostingWriter(concurrency=concurrency)
+    masks = await load_shard_masks(order_ids)
+    found = set()
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        for sub in chunked(order_ids, DELETE_BATCH):
+            orders = await CodeOrder.filter(id__in=sub, status=OrderStatus.COMPLETED).values_list("id", "generated_code")
+            results = await asyncio.gather(*[
+                loop.run_in_executor(
+                    pool, posting_rows, code or "", K, WINDOW, settings.FP_HASH_SCHEME, MAX_FPS_PER_DOC
+                )
+                for _, code in orders
+            ])
+            for (oid, _), (rows, token_count) in zip(orders, results):
+                writer.add_order(oid, rows, token_count, old_mask=masks.get(oid))
+                found.add(oid)
+            await writer.flush_full()
+    await writer.flush_all()
+    async with in_transaction() as conn:
+        await writer.save_doc_stats(conn=conn)
+        await bump_generation(conn=conn)
+    skipped = len(order_ids) - len(found)
+    print(f"reindexed {len(found)} orders, {writer.rows_written} postings ({skipped} not COMPLETED, skipped)")
+
+async def main(args):
+    order_ids = read_ids(args)
+    if not order_ids:
+        print("no order ids given")
+        return
+    await Tortoise.init(db_url=settings.DATABASE_URL, modules={"model": ["models"]})
+    t0 = time.time()
+    try:
+        await check_layout()
+        if args.reindex:
+            await reindex(order_ids, args.concurrency, args.workers)
+        else:
+            await purge(order_ids, args.concurrency)
+    finally:
+        await Tortoise.close_connections()
+    print(f"done in {time.time() - t0:.1f}s")
 
 if __name__ == "__main__":
-    run_async(main(int(sys.argv[1])))
\ No newline at end of file
+    ap = argparse.ArgumentParser(description="Bulk delete (or reindex) orders from the sharded posting tables")
+    ap.add_argument("order_ids", nargs="*", help="order ids (space or comma separated)")
+    ap.add_argument("--file", help="file with order ids, one per line or comma separated")
+    ap.add_argument("--reindex", action="store_true", help="re-fingerprint the orders instead of deleting them")
+    ap.add_argument("--concurrency", type=int, default=8, help="shards processed concurrently (DB connections)")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="fingerprinting processes for --reindex")
+    run_async(main(ap.parse_args()))
@@ -0,0 +1,123 @@
+# export_posting_index.py
+"""
+把分片倒排索引 code_postings_XX 导出为只读的本地索引文件（格式见 posting_index.py），
+供 POSTING_BACKEND=mmap 使用：服务启动时内存映射，召回/精排用二分查找代替分片表查询。
+
+    python export_posting_index.py [--out data/posting_index] [--batch-rows 50000] [--concurrency 4]
+
+开始前记下 code_doc_stats.updated_at 的最大值（watermark）和当时更早的订单列表；之后新索引、
+重新索引或删除的订单由服务从分片表读取，覆盖快照中的旧数据（增量覆盖层），快照本身不再变化。
+覆盖层随快照之后的变更增长，定期（例如每天）重新导出即可：每个分片按主键顺序分批读取，
+排好序后追加写入临时目录，全部完成后替换 --out 目录，服务在下一次刷新覆盖层时切换到新快照。
+导出期间服务和增量索引照常运行。
+"""
+import argparse
+import asyncio
+import pathlib
+import time
+from typing import Optional
+
+from tortoise import Tortoise, run_async
+from tortoise.functions import Max
+from tortoise.transactions import in_transaction
+
+from config import settings
+from index_generation import read_generation
+from models import CodeDocStat
+from posting_index import PostingArrays, PostingIndexWriter, as_uint64, np, publish, require_numpy
+from posting_writer import chunked
+from shard_router import check_layout, router
+from winnowing_utils import K, WINDOW
+
+BATCH_ROWS = 50000
+LOAD_PAGE = 50000
+
+async def init():
+    await Tortoise.init(db_url=settings.DATABASE_URL, modules={"model": ["models"]})
+    await check_layout()
+
+async def read_base_orders(watermark) -> list:
+    """updated_at 早于 watermark 的订单（快照里的数据对它们是最新的）"""
+    orders, last_id = [], 0
+    if watermark is None:
+        return orders
+    while True:
+        ids = await (
+            CodeDocStat.filter(order_id__gt=last_id, updated_at__lt=watermark)
+            .order_by("order_id").limit(LOAD_PAGE).values_list("order_id", flat=True)
+        )
+        if not ids:
+            return orders
+        orders.extend(ids)
+        last_id = ids[-1]
+
+async def read_shard(shard: int, batch_rows: int) -> PostingArrays:
+    tbl = router.table(shard)
+    parts = []
+    last: Optional[tuple] = None
+    while True:
+        where, params = ("WHERE (fp, order_id, pos) > (%s, %s, %s) ", list(last)) if last else ("", [])
+        async with in_transaction() as conn:
+            rows = await conn.execute_query_dict(
+                f"SELECT fp, order_id, pos, start_line, end_line FROM {tbl} {where}"
+                f"ORDER BY fp, order_id, pos LIMIT {int(batch_rows)}",
+                params,
+            )
+        if rows:
+            parts.append((
+                as_uint64([int(r["fp"]) for r in rows]),
+                *[np.array([int(r[c]) for r in rows], dtype=np.int64) for c in ("order_id", "pos", "start_line", "end_line")],
+            ))
+            last = (int(rows[-1]["fp"]), int(rows[-1]["order_id"]), int(rows[-1]["pos"]))
+        if len(rows) < batch_rows:
+            break
+    if not parts:
+        return PostingArrays.empty()
+    # MySQL 按无符号 fp 排序，其他库可能按有符号：统一在内存里按 uint64 重排
+    return PostingArrays.from_postings(*[np.concatenate(cols) for cols in zip(*parts)])
+
+async def export(out: str, batch_rows: int = BATCH_ROWS, concurrency: int = 4) -> dict:
+    require_numpy()
+    out_path = pathlib.Path(out)
+    tmp_path = out_path.with_name(out_path.name + f".tmp-{int(time.time())}")
+    generation = await read_generation()
+    watermark = await CodeDocStat.all().annotate(m=Max("updated_at")).first().values_list("m", flat=True)
+    base_orders = await read_base_orders(watermark)
+    print(f"watermark {watermark}, {len(base_orders)} orders before it, generation {generation}")
+
+    t0 = time.time()
+    writer = PostingIndexWriter(tmp_path, router.count)
+    # 每组 --concurrency 个分片并发读取，按分片顺序写入
+    for group in chunked(list(router.shards), concurrency):
+        sections = await asyncio.gather(*[read_shard(s, batch_rows) for s in group])
+        for shard, arrays in zip(group, sections):
+            writer.write_section(shard, arrays)
+            print(f"shard {shard:02x}: {len(arrays.fps)} fps, {arrays.n_postings} postings ({time.time() - t0:.1f}s)")
+    meta = writer.close(
+        base_orders,
+        watermark=watermark.isoformat() if watermark else None,
+        generation=generation,
+        hash_scheme=settings.FP_HASH_SCHEME,
+        k=K,
+        window=WINDOW,
+    )
+    publish(tmp_path, out_path)
+    print(
+        f"done in {time.time() - t0:.1f}s: {meta['n_fps']} fps, {meta['n_postings']} postings, "
+        f"{meta['n_orders']} orders -> {out_path}"
+    )
+    return meta
+
+async def main(args):
+    await init()
+    try:
+        await export(args.out, args.batch_rows, args.concurrency)
+    finally:
+        await Tortoise.close_connections()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="导出本地只读倒排索引（POSTING_BACKEND=mmap）")
+    parser.add_argument("--out", default=settings.POSTING_INDEX_DIR, help="索引目录（整体替换）")
+    parser.add_argument("--batch-rows", type=int, default=BATCH_ROWS, help="每个分片每批读取的行数")
+    parser.add_argument("--concurrency", type=int, default=4, help="同时读取的分片数")
+    run_async(main(parser.parse_args()))
@@ -0,0 +1,187 @@
+# fingerprint_pool.py
+"""
+Process-pool execution stage for the CPU-bound fingerprinting work
+(tokenize + winnow for v2, chunk + SimHash for v1), so a large upload does not
+block the event loop and stall every other in-flight request.
+
+Small inputs run inline: shipping them to a worker costs more than the work.
+At most `max_pending` jobs are in flight; further requests wait for a slot
+(back-pressure) and fail with PoolSaturatedError after `queue_timeout` seconds.
+
+Streamed uploads (run_stream) take a slot like any other job: the event loop
+reads and decodes the upload and sends the text in pieces through a bounded
+manager queue to a worker, which runs the stateful tokenize/winnow (or
+SimHash) stream over them.
+
+Worker functions live in this module and only import the pure algorithm
+modules, so spawned workers start quickly.
+"""
+import asyncio
+import hashlib
+import multiprocessing
+import queue
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from fingerprint_utils import SimHashEngine, split_code_into_chunks
+from winnowing_utils import Fingerprint, tokenize_to_ids, winnow
+
+STREAM_QUEUE_PIECES = 4  # 每个流在队列里最多积压的文本段数
+STREAM_PIECE_CHARS = 1 << 20  # 送往 worker 的每段文本大小（字符）
+STREAM_PUT_TIMEOUT = 1.0  # 队列满时每隔多久检查一次 worker 是否已退出
+
+class PoolSaturatedError(RuntimeError):
+    """No pool slot became free within the queue timeout."""
+
+class StreamAborted(Exception):
+    """The loop stopped feeding a stream (decode error, client gone)."""
+
+# ---- worker functions (must be top-level to be picklable) ----
+
+def fingerprint_code(code: str, k: int, window: int, scheme: str) -> Tuple[List[Fingerprint], str]:
+    """Winnowing fingerprints plus a digest of the normalized token stream (result-cache key)."""
+    fps, token_digest, _ = fingerprint_code_timed(code, k, window, scheme)
+    return fps, token_digest
+
+def fingerprint_code_timed(
+    code: str, k: int, window: int, scheme: str
+) -> Tuple[List[Fingerprint], str, Dict[str, float]]:
+    """fingerprint_code() plus the seconds spent in each step, measured where it ran (possibly a worker)."""
+    t0 = time.perf_counter()
+    tokens, token_lines = tokenize_to_ids(code)
+    token_digest = hashlib.blake2b(tokens.tobytes(), digest_size=16).hexdigest()
+    t1 = time.perf_counter()
+    fps = winnow(tokens, token_lines, k=k, window=window, scheme=scheme)
+    return fps, token_digest, {"tokenize": t1 - t0, "winnow": time.perf_counter() - t1}
+
+def posting_rows(code: str, k: int, window: int, scheme: str, max_fps: int) -> Tuple[List[Tuple[int, int, int, int]], int]:
+    """
+    (fp, pos, start_line, end_line) rows for indexing one order, uniformly sampled
+    down to max_fps, plus the order's token count.
+    """
+    tokens, token_lines = tokenize_to_ids(code)
+    fps = winnow(tokens, token_lines, k=k, window=window, scheme=scheme)
+    if len(fps) > max_fps:
+        step = max(1, len(fps) // max_fps)
+        fps = fps[::step][:max_fps]
+    return [(f.fp, f.pos, f.start_line, f.end_line) for f in fps], len(tokens)
+
+def simhash_code_chunks(code: str, window_size: int = 10, step: int = 5) -> Tuple[list, List[int]]:
+    chunks = split_code_into_chunks(code, window_size=window_size, step=step)
+    return chunks, SimHashEngine().compute_simhash_many(chunks)
+
+def _queued_pieces(pieces) -> Iterator[str]:
+    while True:
+        piece = pieces.get()
+        if piece is None:
+            return
+        if piece is False:
+            raise StreamAborted()
+        yield piece
+
+def run_queued(fn, pieces, *args):
+    """Worker side of run_stream: fn(text pieces, *args), the pieces read from the queue until None."""
+    return fn(_queued_pieces(pieces), *args)
+
+class FingerprintPool:
+    def __init__(self, workers: int, inline_max_chars: int, max_pending: int = 0, queue_timeout: float = 30.0):
+        self.workers = workers
+        self.inline_max_chars = inline_max_chars
+        self.max_pending = max_pending or workers * 2
+        self.queue_timeout = queue_timeout
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._manager = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._manager_lock: Optional[asyncio.Lock] = None
+
+    def start(self) -> None:
+        if self.workers <= 0 or self._executor is not None:
+            return
+        # spawn：不继承父进程的事件循环/数据库连接
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._manager_lock = asyncio.Lock()
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+    async def _acquire(self) -> None:
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise PoolSaturatedError(f"fingerprint pool saturated ({self.max_pending} jobs in flight)")
+
+    async def run(self, size: int, fn, *args):
+        """Run fn(*args) inline when `size` is small or the pool is off, else on the pool."""
+        if self._executor is None or size <= self.inline_max_chars:
+            return fn(*args)
+
+        await self._acquire()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, fn, *args)
+        finally:
+            self._slots.release()
+
+    async def run_stream(self, pieces: Iterable[str], fn, *args):
+        """
+        fn(pieces, *args) on the pool for input that the loop reads piece by
+        piece (a large upload): `pieces` is iterated here, batched to about
+        STREAM_PIECE_CHARS and handed to the worker through a bounded queue.
+        An exception raised by `pieces` (e.g. UnicodeDecodeError) aborts the
+        worker and propagates. With the pool off, runs in a thread.
+        """
+        if self._executor is None:
+            return await asyncio.to_thread(fn, pieces, *args)
+
+        await self._acquire()
+        try:
+            loop = asyncio.get_running_loop()
+            q = await self._stream_queue()
+            future = loop.run_in_executor(self._executor, run_queued, fn, q, *args)
+            try:
+                buf, size = [], 0
+                for piece in pieces:
+                    buf.append(piece)
+                    size += len(piece)
+                    if size >= STREAM_PIECE_CHARS:
+                        if not await self._put(q, "".join(buf), future):
+                            break
+                        buf, size = [], 0
+                else:
+                    if not buf or await self._put(q, "".join(buf), future):
+                        await self._put(q, None, future)
+            except BaseException:
+                future.add_done_callback(lambda f: f.cancelled() or f.exception())
+                await self._put(q, False, future)
+                raise
+            return await future
+        finally:
+            self._slots.release()
+
+    async def _stream_queue(self):
+        # 流式任务的文本经 manager 队列送给 worker（普通 Queue 不能作为任务参数传递）；
+        # manager 进程与 worker 一样，第一次用到时才启动
+        async with self._manager_lock:
+            if self._manager is None:
+                self._manager = await asyncio.to_thread(multiprocessing.get_context("spawn").Manager)
+        return self._manager.Queue(STREAM_QUEUE_PIECES)
+
+    async def _put(self, q, item, future) -> bool:
+        """Put item on the stream queue; False if the worker has already finished (it failed)."""
+        loop = asyncio.get_running_loop()
+        while not future.done():
+            try:
+                await loop.run_in_executor(None, q.put, item, True, STREAM_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
@@ -1,6 +1,13 @@
 # fingerprint_utils.py
 import re
 import hashlib
+from collections import deque
+from typing import Iterable, Iterator, List, Sequence
+
+try:
+    import numpy as np
+except ImportError:  # numpy 是可选依赖，缺失时退回纯 Python 实现
+    np = None
 
 class SimHashEngine:
     def __init__(self, width=64):
@@ -46,13 +53,7 @@ class SimHashEngine:
     def _hash_func(self, x):
         return int(hashlib.md5(x.encode('utf-8')).hexdigest(), 16)
 
-    def compute_simhash(self, content: str) -> str:
-        """计算文本的 SimHash，返回 64位 二进制字符串"""
-        tokens = self._clean_code(content)
-        if not tokens:
-            return "0" * self.width
-            
-        features = self._get_features(tokens)
+    def _simhash_python(self, features) -> int:
         v = [0] * self.width
         
         for feature in features:
@@ -68,10 +69,59 @@ class SimHashEngine:
         for i in range(self.width):
             if v[i] > 0:
                 fingerprint |= (1 << i)
-        
-        # 返回二进制字符串，补齐64位
+        return fingerprint
+
+    def _simhash_numpy(self, feature_lists) -> List[int]:
+        """
+        一次性处理多个块的特征：所有特征的 MD5 低 64 位拆成 (n, 64) 的 0/1 矩阵，
+        按块 reduceat 求和后与半数比较，结果与 _simhash_python 逐位一致。
+        """
+        counts = [len(f) for f in feature_lists]
+        digests = b"".join(
+            hashlib.md5(f.encode('utf-8')).digest()[8:]  # int(hexdigest) 的低 64 位
+            for features in feature_lists
+            for f in features
+        )
+        low64 = np.frombuffer(digests, dtype=">u8").astype("<u8")
+        bits = np.unpackbits(low64.view(np.uint8).reshape(-1, 8), axis=1, bitorder="little")  # 第 i 列 = 第 i 位
+
+        offsets = np.zeros(len(counts), dtype=np.int64)
+        np.cumsum(counts[:-1], out=offsets[1:])
+        ones = np.add.reduceat(bits, offsets, axis=0, dtype=np.int64)
+        # v[i] = ones - zeros > 0  <=>  2 * ones > n
+        selected = (2 * ones > np.asarray(counts, dtype=np.int64)[:, None]).astype(np.uint8)
+        packed = np.packbits(selected, axis=1, bitorder="little").view("<u8").ravel()
+        return [int(x) for x in packed]
+
+    def compute_simhash_many(self, chunks: Sequence[str]) -> List[int]:
+        """
+        批量计算多个代码块的 SimHash，返回整数指纹（低位在前，与 compute_simhash 的二进制串一致）。
+        chunks 可以是字符串，也可以是 split_code_into_chunks 返回的 dict。
+        """
+        feature_lists = []
+        for chunk in chunks:
+            content = chunk["content"] if isinstance(chunk, dict) else chunk
+            tokens = self._clean_code(content)
+            feature_lists.append(self._get_features(tokens) if tokens else [])
+
+        if np is None or self.width != 64:
+            return [self._simhash_python(f) if f else 0 for f in feature_lists]
+
+        out = [0] * len(feature_lists)
+        nonempty = [i for i, f in enumerate(feature_lists) if f]
+        if nonempty:
+            for i, fp in zip(nonempty, self._simhash_numpy([feature_lists[i] for i in nonempty])):
+                out[i] = fp
+        return out
+
+    def to_binary(self, fingerprint: int) -> str:
+        """整数指纹 -> 补齐 width 位的二进制字符串（库中存储格式）"""
         return bin(fingerprint)[2:].zfill(self.width)
 
+    def compute_simhash(self, content: str) -> str:
+        """计算文本的 SimHash，返回 64位 二进制字符串"""
+        return self.to_binary(self.compute_simhash_many([content])[0])
+
     def hamming_distance(self, hash1_bin: str, hash2_bin: str) -> int:
         """计算两个二进制字符串的海明距离"""
         x = int(hash1_bin, 2) ^ int(hash2_bin, 2)
@@ -104,4 +154,46 @@ def split_code_into_chunks(code: str, window_size=10, step=5):
         
         if end == total_lines: break
         
-    return chunks
\ No newline at end of file
+    return chunks
+def iter_code_chunks(lines: Iterable[str], window_size=10, step=5) -> Iterator[dict]:
+    """
+    split_code_into_chunks() over a stream of lines (code.split('\\n') order);
+    only the current window of lines is kept.
+    """
+    window = deque()  # lines[start:start + window_size]
+    start = 0
+    total = 0
+    last_end = -1
+    for line in lines:
+        window.append(line)
+        total += 1
+        if total == start + window_size:
+            # 完整窗口：是否是最后一块要等读完才知道，先产出，结束时再补尾部的短块
+            chunk = _make_chunk(window, start, total)
+            if chunk:
+                yield chunk
+            last_end = total
+            for _ in range(min(step, len(window))):
+                window.popleft()
+            start += step
+
+    if last_end == total:
+        return
+    # 剩余的起点与 split_code_into_chunks 相同：窗口不满，遇到 end == total 结束
+    while start < total:
+        end = min(start + window_size, total)
+        chunk = _make_chunk(list(window)[:end - start], start, end)
+        if chunk:
+            yield chunk
+        if end == total:
+            break
+        for _ in range(min(step, len(window))):
+            window.popleft()
+        start += step
+
+def _make_chunk(lines, start, end):
+    chunk_content = '\n'.join(lines)
+    # 忽略过短的块
+    if len(chunk_content.strip()) < 50:
+        return None
+    return {"start_line": start + 1, "end_line": end, "content": chunk_content}
@@ -0,0 +1,49 @@
+# index_generation.py
+"""
+Index-generation counter (index_state table).
+
+Every writer that inserts or deletes postings bumps the counter in the same
+transaction as its writes. The service reads it through IndexGeneration,
+which re-reads at most every `poll_seconds`, and uses the value to invalidate
+cached results computed against an older index.
+"""
+import time
+
+from tortoise.expressions import F
+
+from models import IndexState
+
+POSTINGS = "postings"
+
+async def bump_generation(name: str = POSTINGS, conn=None) -> int:
+    """+1 and return the new generation (run it inside the writer's transaction)."""
+    updated = await IndexState.filter(name=name).using_db(conn).update(generation=F("generation") + 1)
+    if not updated:
+        await IndexState.get_or_create(name=name, defaults={"generation": 1}, using_db=conn)
+    return int(await IndexState.filter(name=name).using_db(conn).first().values_list("generation", flat=True))
+
+async def read_generation(name: str = POSTINGS) -> int:
+    row = await IndexState.filter(name=name).first().values_list("generation", flat=True)
+    return int(row) if row is not None else 0
+
+class IndexGeneration:
+    def __init__(self, name: str = POSTINGS, poll_seconds: float = 5.0):
+        self.name = name
+        self.poll_seconds = poll_seconds
+        self.value = 0
+        self._checked_at = float("-inf")
+
+    def observe(self, value: int) -> None:
+        """Adopt a generation this process just wrote, without waiting for the next poll."""
+        if value > self.value:
+            self.value = value
+
+    async def current(self) -> int:
+        now = time.monotonic()
+        if now - self._checked_at >= self.poll_seconds:
+            try:
+                self.value = await read_generation(self.name)
+            except Exception as e:
+                print(f"索引版本号读取失败，沿用 {self.value}: {e}")
+            self._checked_at = now
+        return self.value
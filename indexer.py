@@ -0,0 +1,262 @@
+# indexer.py
+"""
+In-service incremental indexing of orders that reach COMPLETED.
+
+Orders enter the durable queue (index_jobs table) from two sources:
+- POST /api/index-orders, called when an order completes;
+- a poller scanning code_orders by updated_at past the newest version
+  already queued (the watermark is derived from index_jobs, so it survives
+  restarts; on an empty queue it starts at "now" and older orders are left
+  to rebuild_postings_sharded.py / rebuild_index.py).
+
+A job is (re)queued only if the order has no job yet or was updated after
+the version its job recorded, so DONE orders are not indexed again.
+
+The worker takes PENDING jobs in batches, fingerprints the orders on the
+shared FingerprintPool (bounded by `concurrency`), writes the whole batch's
+postings through ShardedPostingWriter and its SimHash rows to
+code_fingerprints, then marks the jobs DONE and bumps the index generation
+in one transaction. Each batch gets its own writer, so a failed batch leaves
+nothing buffered; a job retried after a failure deletes the order on every
+shard, since the failed attempt may have written shards outside its old
+manifest. `on_indexed(generation, fps)` lets the service refresh
+its caches/indexes right away (fps is None when an order was re-indexed and
+its previous fingerprints are unknown). The in-memory SimHash index
+replaces the rows of re-indexed orders on that refresh; orders purged by
+delete_order_postings.py drop out on its next periodic sync.
+"""
+import asyncio
+from typing import Awaitable, Callable, Iterable, List, Optional, Tuple
+
+from tortoise import timezone
+from tortoise.expressions import Q
+from tortoise.functions import Max
+from tortoise.transactions import in_transaction
+
+from fingerprint_pool import FingerprintPool, posting_rows, simhash_code_chunks
+from fingerprint_utils import SimHashEngine
+from index_generation import bump_generation
+from models import CodeFingerprint, CodeOrder, IndexJob, IndexJobStatus, OrderStatus
+from posting_writer import ShardedPostingWriter, load_shard_masks
+from winnowing_utils import K, WINDOW
+
+MAX_FPS_PER_DOC = 10000
+POLL_LIMIT = 1000
+
+class OrderIndexer:
+    def __init__(
+        self,
+        fp_pool: FingerprintPool,
+        scheme: str,
+        batch_size: int = 50,
+        concurrency: int = 4,
+        poll_seconds: float = 30.0,
+        max_attempts: int = 3,
+        on_indexed: Optional[Callable[[int, Optional[List[int]]], Awaitable[None]]] = None,
+    ):
+        self.fp_pool = fp_pool
+        self.scheme = scheme
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max_attempts
+        self.on_indexed = on_indexed
+        self.engine = SimHashEngine()
+        # 轮询游标 (updated_at, id)：同一时间戳的订单可能跨页，只按时间戳翻页会漏掉
+        self.watermark = None
+        self.watermark_id = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.indexed_orders = 0
+        self.failed_orders = 0
+
+    # ---- 入队 ----
+
+    async def _enqueue_versions(self, versions: Iterable[Tuple[int, object]]) -> int:
+        """versions: [(order_id, order.updated_at)]；只为没有任务或之后又被更新的订单入队"""
+        versions = dict(versions)
+        if not versions:
+            return 0
+        jobs = {
+            oid: updated_at
+            for oid, updated_at in await IndexJob.filter(order_id__in=list(versions)).values_list(
+                "order_id", "order_updated_at"
+            )
+        }
+        new_ids = [oid for oid in versions if oid not in jobs]
+        changed_ids = [oid for oid, v in versions.items() if oid in jobs and jobs[oid] != v]
+        if new_ids:
+            await IndexJob.bulk_create(
+                [IndexJob(order_id=oid, order_updated_at=versions[oid]) for oid in new_ids], batch_size=500
+            )
+        for oid in changed_ids:
+            await IndexJob.filter(order_id=oid).update(
+                status=IndexJobStatus.PENDING, attempts=0, error=None, order_updated_at=versions[oid]
+            )
+        queued = len(new_ids) + len(changed_ids)
+        if queued:
+            self._wakeup.set()
+        return queued
+
+    async def enqueue(self, order_ids: Iterable[int]) -> int:
+        rows = await CodeOrder.filter(id__in=list(order_ids), status=OrderStatus.COMPLETED).values_list(
+            "id", "updated_at"
+        )
+        return await self._enqueue_versions(rows)
+
+    async def poll_completed(self) -> int:
+        if self.watermark is None:
+            latest = await IndexJob.all().annotate(m=Max("order_updated_at")).first().values_list("m", flat=True)
+            self.watermark = latest or timezone.now()
+            self.watermark_id = 0  # 与 watermark 同时间戳的订单再看一遍，已入队的不会重复入队
+        queued = 0
+        while True:
+            rows = await CodeOrder.filter(
+                Q(updated_at__gt=self.watermark) | Q(updated_at=self.watermark, id__gt=self.watermark_id),
+                status=OrderStatus.COMPLETED,
+            ).order_by("updated_at", "id").limit(POLL_LIMIT).values_list("id", "updated_at")
+            if not rows:
+                return queued
+            queued += await self._enqueue_versions(rows)
+            self.watermark_id, self.watermark = rows[-1]
+            if len(rows) < POLL_LIMIT:
+                return queued
+
+    # ---- 处理 ----
+
+    async def _fingerprint(self, code: str, sem: asyncio.Semaphore):
+        async with sem:
+            postings = await self.fp_pool.run(len(code), posting_rows, code, K, WINDOW, self.scheme, MAX_FPS_PER_DOC)
+            chunks, chunk_fps = await self.fp_pool.run(len(code), simhash_code_chunks, code, 10, 5)
+        return postings, chunks, chunk_fps
+
+    def _simhash_rows(self, order_id: int, chunks, chunk_fps) -> List[CodeFingerprint]:
+        # 与 rebuild_index.py 相同的行格式
+        result = []
+        for chunk, f_int in zip(chunks, chunk_fps):
+            f_val = self.engine.to_binary(f_int)
+            parts = self.engine.split_fingerprint_to_parts(f_val)
+            result.append(CodeFingerprint(
+                order_id=order_id,
+                fingerprint=f_val,
+                part_1=parts[0],
+                part_2=parts[1],
+                part_3=parts[2],
+                part_4=parts[3],
+                start_line=chunk['start_line'],
+                end_line=chunk['end_line'],
+            ))
+        return result
+
+    async def _fail(self, order_ids: List[int], error: str) -> None:
+        for oid in order_ids:
+            job = await IndexJob.get_or_none(order_id=oid)
+            if job is None:
+                continue
+            job.attempts += 1
+            job.error = error[:2000]
+            if job.attempts >= self.max_attempts:
+                job.status = IndexJobStatus.FAILED
+                self.failed_orders += 1
+            await job.save()
+
+    async def run_once(self) -> int:
+        """Process one batch of PENDING jobs; returns how many jobs were taken (0 = queue empty)."""
+        jobs = await IndexJob.filter(status=IndexJobStatus.PENDING).order_by("created_at").limit(
+            self.batch_size
+        ).values_list("order_id", "order_updated_at", "attempts")
+        if not jobs:
+            return 0
+        versions = {oid: updated_at for oid, updated_at, _ in jobs}
+        # 上次写入失败的订单可能已有部分分片写入了新 postings，清单不可信：所有分片都删一遍
+        retried = {oid for oid, _, attempts in jobs if attempts}
+        orders = await CodeOrder.filter(id__in=list(versions), status=OrderStatus.COMPLETED).values_list(
+            "id", "generated_code"
+        )
+        # 入队后状态又变了的订单：任务作废
+        gone = set(versions) - {oid for oid, _ in orders}
+        if gone:
+            await IndexJob.filter(order_id__in=list(gone)).delete()
+
+        sem = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(
+            *[self._fingerprint(code or "", sem) for _, code in orders], return_exceptions=True
+        )
+
+        # 已有 code_doc_stats 行（旧 postings）的订单是重新索引
+        masks = await load_shard_masks([oid for oid, _ in orders])
+        # 每批用新的 writer：失败的批次不会把缓冲的 postings/清单带到下一批
+        writer = ShardedPostingWriter(concurrency=self.concurrency)
+        ok_ids = []
+        touched_fps = []
+        simhash_rows = []
+        for (oid, _), res in zip(orders, results):
+            if isinstance(res, Exception):
+                await self._fail([oid], f"fingerprint: {res}")
+                continue
+            (rows, token_count), chunks, chunk_fps = res
+            writer.add_order(oid, rows, token_count, old_mask=None if oid in retried else masks.get(oid))
+            touched_fps.extend(r[0] for r in rows)
+            simhash_rows.extend(self._simhash_rows(oid, chunks, chunk_fps))
+            ok_ids.append(oid)
+        if not ok_ids:
+            return len(jobs)
+
+        try:
+            await writer.flush_all()
+            async with in_transaction() as conn:
+                await writer.save_doc_stats(conn=conn)
+                await CodeFingerprint.filter(order_id__in=ok_ids).using_db(conn).delete()
+                if simhash_rows:
+                    await CodeFingerprint.bulk_create(simhash_rows, batch_size=500, using_db=conn)
+                for oid in ok_ids:
+                    # 只有处理期间订单没有被再次更新的任务才标记 DONE
+                    await IndexJob.filter(order_id=oid, order_updated_at=versions[oid]).using_db(conn).update(
+                        status=IndexJobStatus.DONE, error=None
+                    )
+                generation = await bump_generation(conn=conn)
+        except Exception as e:
+            await self._fail(ok_ids, f"write: {e}")
+            raise
+
+        self.indexed_orders += len(ok_ids)
+        print(f"增量索引: {len(ok_ids)} 个订单, {len(touched_fps)} 条 postings")
+        if self.on_indexed:
+            # 重新索引时旧指纹未知，回调里传 None 让缓存整体失效
+            reindexed = any(oid in masks or oid in retried for oid in ok_ids)
+            await self.on_indexed(generation, None if reindexed else touched_fps)
+        return len(jobs)
+
+    async def run_forever(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.poll_completed()
+                while await self.run_once():
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"增量索引失败: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run_forever())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def stats(self) -> dict:
+        counts = {s.value: await IndexJob.filter(status=s).count() for s in IndexJobStatus}
+        return {
+            "jobs": counts,
+            "indexed_orders": self.indexed_orders,
+            "failed_orders": self.failed_orders,
+            "watermark": self.watermark.isoformat() if self.watermark else None,
+        }
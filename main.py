@@ -1,275 +1,720 @@
 import time
 import asyncio
 import uvicorn
-from fastapi import FastAPI, UploadFile, File
+from fastapi import FastAPI, UploadFile, File, Response
+from fastapi.responses import JSONResponse, PlainTextResponse
 from tortoise.contrib.fastapi import register_tortoise
-from tortoise.expressions import Q
-from typing import Optional
-from winnowing_utils import normalize_to_tokens_with_lines, winnow, shard_of_fp
+from typing import List, Optional
+from shard_router import check_layout, router as shard_router
 # 导入你项目中的模块
 # 确保 models.py, config.py, fingerprint_utils.py 在同一目录下
 from models import CodeOrder, CodeFingerprint
-from fingerprint_utils import SimHashEngine, split_code_into_chunks
+from fingerprint_utils import SimHashEngine
+from simhash_index import SimHashIndex
+from alignment import CoverageBound, QueryIndex, align, merge_intervals
+from fingerprint_pool import FingerprintPool, PoolSaturatedError, fingerprint_code_timed, simhash_code_chunks
+from upload_stream import fingerprint_upload, sample_fps, simhash_upload
+from batch_upload import BatchLimitError, expand_uploads
+from batch_pairs import batch_max_df, cross_match
+from winnowing_utils import HASH_SCHEMES, K, WINDOW
+from stop_fingerprints import STOP_FP_MODES, StopFingerprints
+from doc_stats import DocStats
+from result_cache import ResultCache
+from recall_cache import RecallCache
+from index_generation import IndexGeneration, read_generation
+from indexer import OrderIndexer
+from posting_backends import make_backend
+from metrics import current_trace, registry as metrics_registry, request_trace
 from config import settings
 
 app = FastAPI(title="Code Duplicate Checker")
 engine = SimHashEngine()
+simhash_index = SimHashIndex()
+stop_fps = StopFingerprints()
+doc_stats = DocStats()
+fp_pool = FingerprintPool(
+    workers=settings.FP_POOL_WORKERS,
+    inline_max_chars=settings.FP_INLINE_MAX_CHARS,
+    max_pending=settings.FP_POOL_MAX_PENDING,
+    queue_timeout=settings.FP_POOL_QUEUE_TIMEOUT,
+)
+result_cache = ResultCache(settings.RESULT_CACHE_SIZE, settings.RESULT_CACHE_TTL_SECONDS)
+recall_cache = RecallCache(settings.RECALL_CACHE_MAX_ENTRIES)
+index_generation = IndexGeneration(poll_seconds=settings.INDEX_GENERATION_POLL_SECONDS)
+posting_backend = make_backend(settings.POSTING_BACKEND)
+
+async def on_orders_indexed(generation, fps):
+    """增量索引写完一批订单：本进程的缓存/内存索引立即跟上，不等下一次轮询"""
+    index_generation.observe(generation)
+    if fps is None:
+        recall_cache.sync(generation)
+    else:
+        recall_cache.advance(generation, fps)
+    if simhash_index.ready:
+        await simhash_index.refresh()
+    if doc_stats.ready:
+        await doc_stats.refresh()
+    await sync_posting_backend(generation)
+
+order_indexer = OrderIndexer(
+    fp_pool,
+    scheme=settings.FP_HASH_SCHEME,
+    batch_size=settings.INDEXER_BATCH_SIZE,
+    concurrency=settings.INDEXER_CONCURRENCY,
+    poll_seconds=settings.INDEXER_POLL_SECONDS,
+    max_attempts=settings.INDEXER_MAX_ATTEMPTS,
+    on_indexed=on_orders_indexed,
+)
 
+SIMHASH_MAX_DISTANCE = 3  # 海明距离 <= 3 视为高度相似
 
-# main.py 里新增 imports
-from collections import Counter, defaultdict
-from tortoise.transactions import in_transaction
 
-from winnowing_utils import normalize_to_tokens_with_lines, winnow
+# main.py 里新增 imports
+from collections import defaultdict
 
 MAX_QUERY_FPS = 10000
-RECALL_BATCH = 300
 TOP_N = 80
 MIN_HIT = 6
 MIN_COVERAGE = 0.06
-K = 20
-WINDOW = 5
-
-def table_for_shard(shard: int) -> str:
-    return f"code_postings_{shard:02x}"
-
-def merge_intervals(intervals, epsilon=0):
-    if not intervals:
-        return []
-    intervals = sorted(intervals)
-    merged = []
-    for s, e in intervals:
-        # epsilon 允许合并有微小间隙的片段
-        if not merged or s > merged[-1][1] + epsilon + 1:
-            merged.append([s, e])
-        else:
-            merged[-1][1] = max(merged[-1][1], e)
-    return [(a, b) for a, b in merged]
+BATCH_MODES = ("index", "pairs", "both")
+BATCH_PAIR_LIMIT = 200  # 批内比对最多返回多少个文件对
 
 def chunked(lst, n):
     for i in range(0, len(lst), n):
         yield lst[i:i+n]
 
-@app.post("/api/duplicate-check-v2")
-async def duplicate_check_v2(
-    file: UploadFile = File(...),
-    top_n: int = TOP_N,
-    exclude_order_ids: Optional[str] = None,  # 例如 "12,34,56"
-):
-    exclude_set = set()
-    if exclude_order_ids:
-        exclude_set = {int(x) for x in exclude_order_ids.split(",") if x.strip().isdigit()}
-    
-    # 升级：增加多编码支持
-    content_bytes = await file.read()
-    try:
-        code = content_bytes.decode("utf-8")
-    except UnicodeDecodeError:
-        try:
-            code = content_bytes.decode("gbk")
-        except:
-            return {"error": "文件编码不支持，请使用 UTF-8 或 GBK"}
-            
-    total_lines = len(code.splitlines())
+def is_large_upload(file: UploadFile) -> bool:
+    """超过 STREAM_UPLOAD_MIN_BYTES 的上传走流式路径（size 未知时也按大文件处理）"""
+    return file.size is None or file.size > settings.STREAM_UPLOAD_MIN_BYTES
 
-    tokens, token_lines = normalize_to_tokens_with_lines(code)
-    in_fps = winnow(tokens, token_lines, k=K, window=WINDOW)
-    if not in_fps:
-        return {"filename": file.filename, "total_lines": total_lines, "duplicate_rate": "0.00%", "details": []}
-
-    # Cap query fps
-    if len(in_fps) > MAX_QUERY_FPS:
-        step = max(1, len(in_fps) // MAX_QUERY_FPS)
-        in_fps = in_fps[::step][:MAX_QUERY_FPS]
-
-    fp_values = [f.fp for f in in_fps]
-
-    # Build input index: fp -> list of Fingerprint
-    in_by_fp = defaultdict(list)
-    for f in in_fps:
-        in_by_fp[f.fp].append(f)
-
-    # group fps by shard
-    fps_by_shard = defaultdict(list)
-    for fp in fp_values:
-        fps_by_shard[shard_of_fp(fp)].append(fp)
-
-    # 1) 升级：并行化召回 (Recall) 过程
-    async def query_shard_recall(shard, shard_fps):
-        tbl = table_for_shard(shard)
-        shard_hits = defaultdict(int)
-        async with in_transaction() as conn:
-            for sub in chunked(shard_fps, RECALL_BATCH):
-                ph = ",".join(["%s"] * len(sub))
-                sql = f"SELECT order_id, COUNT(*) AS hit FROM {tbl} WHERE fp IN ({ph}) GROUP BY order_id"
-                rows = await conn.execute_query_dict(sql, sub)
-                for r in rows:
-                    oid = int(r["order_id"])
-                    if oid not in exclude_set:
-                        shard_hits[oid] += int(r["hit"])
-        return shard_hits
-
-    tasks = [query_shard_recall(s, f) for s, f in fps_by_shard.items()]
-    shard_results = await asyncio.gather(*tasks)
-    
+def empty_v2_report(filename, total_lines):
+    return {"filename": filename, "total_lines": total_lines, "duplicate_rate": "0.00%", "details": []}
+
+def coverage_reaches(covered_lines, total_lines):
+    return (covered_lines / total_lines if total_lines else 0.0) >= MIN_COVERAGE
+
+def parse_order_ids(text):
+    return {int(x) for x in text.split(",") if x.strip().isdigit()} if text else set()
+
+class V2Query:
+    """一个文件的查询指纹：分片分组（精排用）、召回用指纹（recall 模式剔除模板指纹）和对齐索引"""
+
+    def __init__(self, in_fps):
+        self.fps = in_fps
+        self.index = QueryIndex(in_fps)
+        self.fps_by_shard = defaultdict(list)
+        for f in in_fps:
+            self.fps_by_shard[shard_router.shard_of(f.fp)].append(f.fp)
+
+        # recall 模式：模板指纹不参与召回计数，但保留给精排对齐
+        self.recall_fps_by_shard = self.fps_by_shard
+        if settings.STOP_FP_MODE == "recall" and len(stop_fps):
+            self.recall_fps_by_shard = defaultdict(list)
+            for f in in_fps:
+                if f.fp not in stop_fps:
+                    self.recall_fps_by_shard[shard_router.shard_of(f.fp)].append(f.fp)
+
+    def recall_fps(self):
+        # 与 SQL 的 fp IN (...) 一致：同一指纹只计一次
+        return [fp for shard_fps in self.recall_fps_by_shard.values() for fp in dict.fromkeys(shard_fps)]
+
+async def fetch_recall_summaries(fps):
+    """
+    fp -> (order_ids, counts)。热门指纹的摘要取自 recall_cache，其余每个分片一次
+    posting_backend 查询；批量查重时所有文件的指纹先去重，每个指纹在每个分片上只查一次。
+    """
+    summaries = {}
+    missing_by_shard = defaultdict(list)
+    for fp in dict.fromkeys(fps):
+        summary = recall_cache.get(fp) if recall_cache.enabled else None
+        if summary is None:
+            missing_by_shard[shard_router.shard_of(fp)].append(fp)
+        else:
+            summaries[fp] = summary
+
+    trace = current_trace()
+    trace.count("recall_cache_hits", len(summaries))
+    trace.count("recall_shards", len(missing_by_shard))
+    fetched_generation = recall_cache.generation
+    # 升级：并行化召回 (Recall) 过程
+    tasks = [posting_backend.recall_shard(s, f) for s, f in missing_by_shard.items()]
+    for res in await asyncio.gather(*tasks):
+        recall_cache.put_many(res, fetched_generation)
+        for fp, counts in res.items():
+            summaries[fp] = (list(counts.keys()), list(counts.values()))
+    return summaries
+
+async def fetch_recall_hits(fps):
+    """
+    order_id -> 命中数，每个分片一次按 order_id 聚合的查询。召回缓存关闭时单个文件走这里：
+    不需要逐指纹的摘要（没有缓存要填，也不用分给多个文件），库里只返回每个订单一行
+    """
+    by_shard = defaultdict(list)
+    for fp in fps:
+        by_shard[shard_router.shard_of(fp)].append(fp)
+    current_trace().count("recall_shards", len(by_shard))
     hits = defaultdict(int)
-    for res in shard_results:
+    for res in await asyncio.gather(*[posting_backend.recall_orders(s, f) for s, f in by_shard.items()]):
         for oid, count in res.items():
             hits[oid] += count
+    return hits
+
+def summary_hits(query, summaries):
+    """一个文件在召回摘要中的 order_id -> 命中数"""
+    hits = defaultdict(int)
+    for fp in query.recall_fps():
+        for oid, count in zip(*summaries[fp]):
+            hits[oid] += count
+    return hits
+
+def select_candidates(query, hits, top_n, exclude_set, total_lines):
+    """由召回命中数为一个文件选出精排候选，返回 (rerank_ids, max_pruned_hits)"""
+    for oid in exclude_set:
+        hits.pop(oid, None)
+    trace = current_trace()
+    trace.count("recall_candidates", len(hits))
+
+    # 剪枝：召回命中数是精排命中数的上界（recall 模式剔除了模板指纹，不是上界，不剪）。
+    # 达不到 MIN_HIT，或按最宽的 hits 个输入片段估算也达不到 MIN_COVERAGE 的候选不进精排
+    max_pruned_hits = 0
+    if query.recall_fps_by_shard is query.fps_by_shard:
+        bound = CoverageBound(query.fps, epsilon=2)
+        for oid, h in list(hits.items()):
+            if h < MIN_HIT or not coverage_reaches(bound.covered_lines(h), total_lines):
+                del hits[oid]
+                if h >= MIN_HIT:
+                    max_pruned_hits = max(max_pruned_hits, h)
+    trace.count("pruned_candidates", len(hits))
 
     if not hits:
-        return {"filename": file.filename, "total_lines": total_lines, "duplicate_rate": "0.00%", "details": []}
+        return [], max_pruned_hits
 
-    # Pick top candidates
-    candidates = [
-        oid for oid, _ in sorted(hits.items(), key=lambda x: x[1], reverse=True)
-    ][:top_n]
+    # Pick top candidates：按 hits / min(输入指纹数, 候选文档指纹数) 排序，
+    # 小文档被整段抄袭时不会被大文档的绝对命中数挤出 top_n（命中数、order_id 依次决胜）
+    n_query = sum(len(set(f)) for f in query.recall_fps_by_shard.values())
 
-    details = []
-    suspicious_input_intervals = []
+    def score(oid):
+        doc_fps = doc_stats.get(oid) or n_query
+        return hits[oid] / max(1, min(n_query, doc_fps))
 
-    # 2) rerank + evidence per candidate
-    for oid in candidates:
-        if oid in exclude_set:
-            continue
-        
-        # 升级：对于单个候选者，也可以并行查询其指纹分布
-        postings = []
-        async def query_shard_postings(shard, shard_fps):
-            tbl = table_for_shard(shard)
-            async with in_transaction() as conn:
-                shard_postings = []
-                for sub in chunked(shard_fps, RECALL_BATCH):
-                    ph = ",".join(["%s"] * len(sub))
-                    sql = f"SELECT fp, pos, start_line, end_line FROM {tbl} WHERE order_id=%s AND fp IN ({ph})"
-                    rows = await conn.execute_query_dict(sql, [oid] + sub)
-                    shard_postings.extend(rows)
-                return shard_postings
-
-        posting_tasks = [query_shard_postings(s, f) for s, f in fps_by_shard.items()]
-        posting_results = await asyncio.gather(*posting_tasks)
-        for res in posting_results:
-            postings.extend(res)
-
-        if len(postings) < MIN_HIT:
-            continue
+    candidates = sorted(hits, key=lambda oid: (-score(oid), -hits[oid], oid))[:top_n]
+    rerank_ids = [oid for oid in candidates if oid not in exclude_set]
+    trace.count("rerank_candidates", len(rerank_ids))
+    return rerank_ids, max_pruned_hits
 
-        # offset alignment
-        offset_counter = Counter()
-        pairs = []
-        for p in postings:
-            fp = int(p["fp"])
-            for inf in in_by_fp.get(fp, []):
-                off = int(p["pos"]) - inf.pos
-                offset_counter[off] += 1
-                pairs.append((off, inf, p))
-
-        if not offset_counter:
-            continue
+def align_candidates(query, rerank_ids, postings_by_order):
+    """按订单在内存中做偏移对齐"""
+    aligned = []
+    for oid in rerank_ids:
+        postings = postings_by_order.get(oid)
 
-        best_off, best_cnt = offset_counter.most_common(1)[0]
-        if best_cnt < MIN_HIT:
+        if postings is None or len(postings) < MIN_HIT:
             continue
 
-        in_intervals = []
-        db_intervals = []
-        for off, inf, p in pairs:
-            if off != best_off:
-                continue
-            in_intervals.append((inf.start_line, inf.end_line))
-            db_intervals.append((int(p["start_line"]), int(p["end_line"])))
+        # offset alignment（向量化，见 alignment.py）
+        alignment = align(query.index, postings, min_hit=MIN_HIT, epsilon=2)
+        if alignment is not None:
+            aligned.append((oid, alignment))
+    current_trace().count("aligned_candidates", len(aligned))
+    return aligned
 
-        in_merged = merge_intervals(in_intervals, epsilon=2)
-        db_merged = merge_intervals(db_intervals, epsilon=2)
+async def recall_and_rerank_many(fps_list, top_n, exclude_set, total_lines_list):
+    """
+    多个文件一起召回 + 精排：召回阶段所有文件的指纹去重后共用一轮分片查询，
+    命中按文件分回各自选候选；精排的分片查询按文件合并。每个文件的结果与单独调用
+    recall_and_rerank 相同。
+    """
+    trace = current_trace()
+    queries = [V2Query(fps) for fps in fps_list]
+    with trace.stage("recall"):
+        if len(queries) == 1 and not recall_cache.enabled:
+            hits_list = [await fetch_recall_hits(queries[0].recall_fps())]
+        else:
+            summaries = await fetch_recall_summaries(fp for q in queries for fp in q.recall_fps())
+            hits_list = [summary_hits(q, summaries) for q in queries]
+    with trace.stage("select"):
+        selected = [
+            select_candidates(q, hits, top_n, exclude_set, total_lines)
+            for q, hits, total_lines in zip(queries, hits_list, total_lines_list)
+        ]
+    with trace.stage("rerank_fetch"):
+        postings = await posting_backend.fetch_postings(
+            [(rerank_ids, q.fps_by_shard) for q, (rerank_ids, _) in zip(queries, selected)]
+        )
+    with trace.stage("align"):
+        aligned = [
+            align_candidates(q, rerank_ids, p) for q, (rerank_ids, _), p in zip(queries, selected, postings)
+        ]
+
+    project_names = {}
+    ids = list({oid for file_aligned in aligned for oid, _ in file_aligned})
+    if ids:
+        with trace.stage("project_names"):
+            project_names = dict(await CodeOrder.filter(id__in=ids).values_list("id", "project_name"))
+    return [
+        ([(oid, project_names.get(oid), alignment) for oid, alignment in file_aligned], max_pruned_hits)
+        for file_aligned, (_, max_pruned_hits) in zip(aligned, selected)
+    ]
+
+async def recall_and_rerank(in_fps, top_n, exclude_set, total_lines):
+    """
+    召回 + 精排（查库部分）。返回 ([(order_id, project_name, Alignment), ...], max_pruned_hits)。
+    结果只依赖输入指纹序列，唯一和行号有关的是覆盖率剪枝：max_pruned_hits 是因覆盖率上界
+    不足而被剪掉的候选的最大命中数，缓存命中时据此判断换了行号后结果是否仍然成立。
+    """
+    return (await recall_and_rerank_many([in_fps], top_n, exclude_set, [total_lines]))[0]
 
-        covered = sum(e - s + 1 for s, e in in_merged)
-        coverage = covered / total_lines if total_lines else 0.0
+def summarize_v2_matches(total_lines, matches):
+    """覆盖率过滤后的明细（未截断）与所有匹配合并后的重复行数"""
+    details = []
+    suspicious_input_intervals = []
+    for oid, project_name, alignment in matches:
+        coverage = alignment.covered_lines / total_lines if total_lines else 0.0
         if coverage < MIN_COVERAGE:
             continue
 
-        order = await CodeOrder.get(id=oid)
-        suspicious_input_intervals.extend(in_merged)
-        
-        # 计算最长连续匹配
-        max_span = max([(e - s + 1) for s, e in in_merged]) if in_merged else 0
-
+        suspicious_input_intervals.extend(alignment.in_merged)
         details.append({
             "match_order_id": oid,
-            "match_project": order.project_name,
-            "hit_fingerprints": int(best_cnt),
+            "match_project": project_name,
+            "hit_fingerprints": alignment.hit_fingerprints,
             "coverage": f"{coverage*100:.2f}%",
-            "max_continuous_lines": max_span,
-            "evidence": [
-                {"input_lines": f"{s1}-{e1}", "match_lines": f"{s2}-{e2}"}
-                for (s1, e1), (s2, e2) in list(zip(in_merged, db_merged))[:10]
-            ],
+            "max_continuous_lines": alignment.max_continuous_lines,
+            "evidence": alignment.evidence(limit=10),
         })
 
     merged_all = merge_intervals(suspicious_input_intervals, epsilon=0)
     covered_all = sum(e - s + 1 for s, e in merged_all)
+    return details, covered_all
+
+def build_v2_report(filename, total_lines, matches):
+    """覆盖率过滤 + 汇总重复率；matches 为 recall_and_rerank 的结果（行号已对应本次上传）"""
+    details, covered_all = summarize_v2_matches(total_lines, matches)
     dup_rate = covered_all / total_lines if total_lines else 0.0
 
     return {
-        "filename": file.filename,
+        "filename": filename,
         "total_lines": total_lines,
         "duplicate_rate": f"{dup_rate*100:.2f}%",
         "details": sorted(details, key=lambda x: x.get("max_continuous_lines", 0), reverse=True)[:20],
     }
 
-@app.post("/api/duplicate-check")
-async def check_duplicate(file: UploadFile = File(...)):
+def query_fps(in_fps):
+    """模板指纹剔除（drop 模式）+ 查询指纹数上限（与流式路径相同的采样规则）"""
+    if settings.STOP_FP_MODE == "drop":
+        in_fps = stop_fps.without_stop(in_fps)
+    return sample_fps(in_fps, MAX_QUERY_FPS)
+
+async def v2_fps_from_bytes(content_bytes):
+    """返回 (查询指纹, token 摘要, 行数)；UTF-8 / GBK 都解不开时抛 UnicodeDecodeError"""
+    trace = current_trace()
+    with trace.stage("decode"):
+        # 升级：增加多编码支持
+        try:
+            code = content_bytes.decode("utf-8")
+        except UnicodeDecodeError:
+            code = content_bytes.decode("gbk")
+        total_lines = len(code.splitlines())
+
+    # 分词 + winnowing 是 CPU 密集型，大文件交给进程池，避免阻塞事件循环
+    t0 = time.perf_counter()
+    in_fps, token_digest, timings = await fp_pool.run(
+        len(code), fingerprint_code_timed, code, K, WINDOW, settings.FP_HASH_SCHEME
+    )
+    # 进程池排队 + 进程间传输的时间单独记为 pool_wait
+    trace.add_time("pool_wait", max(0.0, time.perf_counter() - t0 - sum(timings.values())))
+    for name, seconds in timings.items():
+        trace.add_time(name, seconds)
+    trace.count("input_fps", len(in_fps))
+    fps = query_fps(in_fps)
+    trace.count("query_fps", len(fps))
+    return fps, token_digest, total_lines
+
+async def v2_fps_from_stream(fileobj):
+    """大文件：边读边解码、分词、winnowing，不在内存里保留全文和完整 token/指纹序列"""
+    trace = current_trace()
+    with trace.stage("fingerprint_stream"):
+        # 文件在事件循环里分段读取、解码，分词/winnowing 在进程池里做，与其他任务共用 fp_pool 的名额
+        result = await fingerprint_upload(
+            fp_pool, fileobj, K, WINDOW, settings.FP_HASH_SCHEME, MAX_QUERY_FPS,
+            stop_fps.df if settings.STOP_FP_MODE == "drop" else None,
+        )
+    trace.count("query_fps", len(result[0]))
+    return result
+
+async def sync_posting_backend(generation):
+    try:
+        await posting_backend.sync(generation)
+    except Exception as e:
+        print(f"倒排索引后端 {posting_backend.name} 同步失败: {e}")
+
+async def v2_cache_generation():
+    generation = await index_generation.current() if (result_cache.enabled or recall_cache.enabled) else 0
+    if posting_backend.needs_sync and generation:
+        # 先让本地索引跟上这个版本号，再按它读写缓存
+        await sync_posting_backend(generation)
+    recall_cache.sync(generation)
+    return generation
+
+def cached_v2_matches(cache_key, generation, in_fps, total_lines):
     """
-    上传代码文件，返回查重报告。
+    结果缓存：同一 token 序列（含仅改了格式/注释的副本）的指纹序列相同，
+    命中时跳过召回和精排，只按本次上传的行号重算输入侧区间；不可用时返回 None
     """
-    start_time = time.time()
-    content_bytes = await file.read()
-    
+    cached = result_cache.get(cache_key, generation) if result_cache.enabled else None
+    if cached is None:
+        return None
+    matches, max_pruned_hits = cached
+    # 本次的行号下，被剪掉的候选可能够得着覆盖率阈值：缓存不适用，重新计算
+    if max_pruned_hits and coverage_reaches(CoverageBound(in_fps).covered_lines(max_pruned_hits), total_lines):
+        return None
+    return [(oid, name, alignment.relined(in_fps)) for oid, name, alignment in matches]
+
+async def run_duplicate_check_v2(file, top_n, exclude_order_ids):
+    trace = current_trace()
+    exclude_set = parse_order_ids(exclude_order_ids)
+
     try:
-        code_content = content_bytes.decode('utf-8')
+        if is_large_upload(file):
+            in_fps, token_digest, total_lines = await v2_fps_from_stream(file.file)
+        else:
+            with trace.stage("read"):
+                content_bytes = await file.read()
+            in_fps, token_digest, total_lines = await v2_fps_from_bytes(content_bytes)
     except UnicodeDecodeError:
-        return {"error": "文件编码格式错误，请上传 UTF-8 文本文件"}
+        return {"error": "文件编码不支持，请使用 UTF-8 或 GBK"}
+    if not in_fps:
+        return empty_v2_report(file.filename, total_lines)
 
-    # 1. 将上传的代码切片
-    input_chunks = split_code_into_chunks(code_content, window_size=10, step=5)
-    
-    report = []
-    total_suspicious_lines = set()
-    
-    # 2. 逐个块进行比对
-    for chunk in input_chunks:
-        chunk_hash = engine.compute_simhash(chunk['content'])
-        
-        # 切分指纹用于索引查询
-        parts = engine.split_fingerprint_to_parts(chunk_hash)
-        
-        # 【核心优化】利用数据库索引快速筛选候选集
-        # 查找任意一段指纹(part_1...part_4)相同的记录
-        candidates = await CodeFingerprint.filter(
-            Q(part_1=parts[0]) | 
-            Q(part_2=parts[1]) | 
-            Q(part_3=parts[2]) | 
-            Q(part_4=parts[3])
-        ).values(
-            'fingerprint', 
-            'order_id', 
-            'order__project_name', 
-            'start_line', 
-            'end_line'
+    cache_key = (token_digest, top_n, tuple(sorted(exclude_set)))
+    with trace.stage("cache"):
+        generation = await v2_cache_generation()
+        matches = cached_v2_matches(cache_key, generation, in_fps, total_lines)
+    if matches is None:
+        matches, max_pruned_hits = await recall_and_rerank(in_fps, top_n, exclude_set, total_lines)
+        result_cache.put(cache_key, generation, (matches, max_pruned_hits))
+
+    with trace.stage("report"):
+        return build_v2_report(file.filename, total_lines, matches)
+
+@app.post("/api/duplicate-check-v2")
+async def duplicate_check_v2(
+    response: Response,
+    file: UploadFile = File(...),
+    top_n: int = TOP_N,
+    exclude_order_ids: Optional[str] = None,  # 例如 "12,34,56"
+    debug: bool = False,  # 返回 debug 块：各阶段耗时、指纹/候选数、每个分片的查询耗时和行数
+):
+    with request_trace("v2") as trace:
+        return trace.respond(response, await run_duplicate_check_v2(file, top_n, exclude_order_ids), debug)
+
+async def check_batch_against_index(sources, fingerprinted, top_n, exclude_set):
+    """批量文件对历史订单查重：每个文件的报告、项目整体重复率和被最多文件命中的订单"""
+    trace = current_trace()
+    matches_by_file = {}
+    pending = []  # 需要查库的文件下标
+    with trace.stage("cache"):
+        generation = await v2_cache_generation()
+        for i, res in enumerate(fingerprinted):
+            if isinstance(res, str) or not res[0]:
+                continue
+            in_fps, token_digest, total_lines = res
+            cache_key = (token_digest, top_n, tuple(sorted(exclude_set)))
+            matches = cached_v2_matches(cache_key, generation, in_fps, total_lines)
+            if matches is None:
+                pending.append(i)
+            else:
+                matches_by_file[i] = matches
+
+    if pending:
+        results = await recall_and_rerank_many(
+            [fingerprinted[i][0] for i in pending], top_n, exclude_set, [fingerprinted[i][2] for i in pending]
         )
-        
+        for i, (matches, max_pruned_hits) in zip(pending, results):
+            cache_key = (fingerprinted[i][1], top_n, tuple(sorted(exclude_set)))
+            result_cache.put(cache_key, generation, (matches, max_pruned_hits))
+            matches_by_file[i] = matches
+
+    with trace.stage("report"):
+        return summarize_batch(sources, fingerprinted, matches_by_file)
+
+def summarize_batch(sources, fingerprinted, matches_by_file):
+    reports = []
+    project_lines = 0
+    project_covered = 0
+    by_order = {}  # order_id -> 项目级汇总
+    for i, (src, res) in enumerate(zip(sources, fingerprinted)):
+        if isinstance(res, str):
+            reports.append({"filename": src.filename, "error": res})
+            continue
+        total_lines = res[2]
+        project_lines += total_lines
+        if i not in matches_by_file:
+            reports.append(empty_v2_report(src.filename, total_lines))
+            continue
+        matches = matches_by_file[i]
+        reports.append(build_v2_report(src.filename, total_lines, matches))
+        details, covered = summarize_v2_matches(total_lines, matches)
+        project_covered += covered
+        for d in details:
+            agg = by_order.setdefault(d["match_order_id"], {
+                "match_order_id": d["match_order_id"],
+                "match_project": d["match_project"],
+                "files": 0,
+                "hit_fingerprints": 0,
+            })
+            agg["files"] += 1
+            agg["hit_fingerprints"] += d["hit_fingerprints"]
+
+    dup_rate = project_covered / project_lines if project_lines else 0.0
+    return {
+        "total_lines": project_lines,
+        "duplicate_lines": project_covered,
+        "duplicate_rate": f"{dup_rate*100:.2f}%",
+        "matched_orders": sorted(
+            by_order.values(), key=lambda x: (-x["files"], -x["hit_fingerprints"], x["match_order_id"])
+        )[:20],
+        "files": reports,
+    }
+
+def batch_pairwise(sources, fingerprinted):
+    """批内两两比对（不查库）：相似度矩阵 + 达到覆盖率阈值的文件对及证据"""
+    ok = [i for i, res in enumerate(fingerprinted) if not isinstance(res, str)]
+    names = [sources[i].filename for i in ok]
+    matrix, pairs = cross_match(
+        [fingerprinted[i][0] for i in ok],
+        [fingerprinted[i][2] for i in ok],
+        min_hit=MIN_HIT,
+        min_coverage=MIN_COVERAGE,
+        max_df=batch_max_df(len(ok), settings.BATCH_PAIR_MAX_DF_RATIO),
+    )
+    for p in pairs:
+        p["file_a"] = names[p["file_a"]]
+        p["file_b"] = names[p["file_b"]]
+    return {"files": names, "matrix": matrix, "pairs": pairs[:BATCH_PAIR_LIMIT]}
+
+async def run_duplicate_check_v2_batch(files, top_n, exclude_order_ids, mode):
+    start_time = time.time()
+    trace = current_trace()
+    if mode not in BATCH_MODES:
+        return {"error": f"mode 只能是 {', '.join(BATCH_MODES)}"}
+    exclude_set = parse_order_ids(exclude_order_ids)
+    try:
+        with trace.stage("expand"):
+            sources = await asyncio.to_thread(
+                expand_uploads,
+                [(f.filename, f.file, f.size) for f in files],
+                settings.BATCH_MAX_FILES,
+                settings.BATCH_MAX_TOTAL_BYTES,
+                settings.STREAM_UPLOAD_MIN_BYTES,
+            )
+    except BatchLimitError as e:
+        return {"error": str(e)}
+    trace.count("files", len(sources))
+
+    # 同时占用的进程池任务数不超过 max_pending，避免一个大项目把其它请求挤到排队超时
+    sem = asyncio.Semaphore(fp_pool.max_pending)
+
+    async def fingerprint_source(src):
+        if src.error:
+            return src.error
+        async with sem:
+            try:
+                if src.data is not None:
+                    return await v2_fps_from_bytes(src.data)
+                with src.open() as f:
+                    return await v2_fps_from_stream(f)
+            except UnicodeDecodeError:
+                return "文件编码不支持，请使用 UTF-8 或 GBK"
+
+    # decode / tokenize / winnow 按文件累加（并行执行，可能超过 fingerprint 的墙钟时间）
+    with trace.stage("fingerprint"):
+        fingerprinted = await asyncio.gather(*[fingerprint_source(src) for src in sources])
+
+    result = {"total_files": len(sources)}
+    if mode == "pairs":
+        result["files"] = [
+            {"filename": src.filename, "error": res} if isinstance(res, str)
+            else {"filename": src.filename, "total_lines": res[2]}
+            for src, res in zip(sources, fingerprinted)
+        ]
+    else:
+        result.update(await check_batch_against_index(sources, fingerprinted, top_n, exclude_set))
+    if mode != "index":
+        with trace.stage("pairwise"):
+            result["pairwise"] = await asyncio.to_thread(batch_pairwise, sources, fingerprinted)
+    result["process_time"] = f"{time.time() - start_time:.2f}s"
+    return result
+
+@app.post("/api/duplicate-check-v2/batch")
+async def duplicate_check_v2_batch(
+    response: Response,
+    files: List[UploadFile] = File(...),
+    top_n: int = TOP_N,
+    exclude_order_ids: Optional[str] = None,
+    mode: str = "index",  # index: 对历史订单查重；pairs: 只做批内两两比对（不查库）；both: 两者都做
+    debug: bool = False,
+):
+    """
+    整个项目一次查重：多个文件和/或 zip 压缩包。所有文件并行计算指纹，召回时所有文件的指纹
+    去重后每个分片只查一次，命中按文件分回；返回每个文件的报告和项目整体重复率（按行数加权）。
+    pairs / both 模式另外在内存里建临时倒排索引，给出批内文件两两之间的相似度矩阵和证据。
+    """
+    with request_trace("v2_batch") as trace:
+        result = await run_duplicate_check_v2_batch(files, top_n, exclude_order_ids, mode)
+        return trace.respond(response, result, debug)
+
+@app.get("/api/duplicate-check-v2/cache-stats")
+async def duplicate_check_v2_cache_stats():
+    return {
+        "generation": index_generation.value,
+        **result_cache.stats(),
+        "recall_cache": recall_cache.stats(),
+        "posting_backend": posting_backend.stats(),
+    }
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """各接口的请求/阶段耗时、指纹与候选数、分片查询耗时与行数（Prometheus 文本格式）"""
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.post("/api/index-orders")
+async def index_orders(order_ids: str):
+    """
+    通知查重服务这些订单已完成（例如 "12,34,56"），异步写入查重索引。
+    已索引且之后未更新的订单不会重复处理。
+    """
+    ids = {int(x) for x in order_ids.split(",") if x.strip().isdigit()}
+    if not ids:
+        return {"error": "order_ids 不能为空"}
+    queued = await order_indexer.enqueue(ids)
+    return {"requested": len(ids), "queued": queued}
+
+@app.get("/api/index-orders/stats")
+async def index_orders_stats():
+    return await order_indexer.stats()
+
+async def match_chunks_in_memory(chunk_fps):
+    """
+    用内存多索引哈希一次性匹配整个文件的所有块，项目名按订单去重后一次查出。
+    返回与 match_chunks_in_db 相同的 [(best_match | None, min_dist), ...]。
+    """
+    trace = current_trace()
+    with trace.stage("match"):
+        matches = simhash_index.search_many(chunk_fps, max_distance=SIMHASH_MAX_DISTANCE)
+    order_ids = {m.order_id for m in matches if m}
+    with trace.stage("project_names"):
+        project_names = dict(await CodeOrder.filter(id__in=order_ids).values_list("id", "project_name")) if order_ids else {}
+
+    results = []
+    for m in matches:
+        if m is None:
+            results.append((None, 100))
+            continue
+        results.append(({
+            "order_id": m.order_id,
+            "order__project_name": project_names.get(m.order_id),
+            "start_line": m.start_line,
+            "end_line": m.end_line,
+        }, m.distance))
+    return results
+
+SIMHASH_PART_COLUMNS = ("part_1", "part_2", "part_3", "part_4")
+SIMHASH_PART_BATCH = 500  # 每条 IN 查询最多带多少个段值
+
+async def match_chunks_in_db(chunk_fps):
+    """
+    内存索引未就绪时的回退路径：整个文件的候选集按段批量查询（每段若干条 IN 查询），
+    再在本地按段值分发回各个块；项目名按订单去重后一次查出。
+    """
+    chunk_hashes = [engine.to_binary(fp) for fp in chunk_fps]
+    chunk_parts = [engine.split_fingerprint_to_parts(h) for h in chunk_hashes]
+
+    # 1. 收集所有块的段值，按段批量取候选行（同一行可能被多个段命中，按 id 去重）
+    rows_by_id = {}
+    for col_idx, col in enumerate(SIMHASH_PART_COLUMNS):
+        values = sorted({parts[col_idx] for parts in chunk_parts})
+        for sub in chunked(values, SIMHASH_PART_BATCH):
+            rows = await CodeFingerprint.filter(**{f"{col}__in": sub}).values(
+                'id', 'fingerprint', 'order_id', 'start_line', 'end_line', *SIMHASH_PART_COLUMNS
+            )
+            for r in rows:
+                rows_by_id[r['id']] = r
+
+    # 2. 本地建 段值 -> 候选行 的映射
+    rows_by_part = [defaultdict(list) for _ in SIMHASH_PART_COLUMNS]
+    for row_id in sorted(rows_by_id):
+        r = rows_by_id[row_id]
+        for col_idx, col in enumerate(SIMHASH_PART_COLUMNS):
+            rows_by_part[col_idx][r[col]].append(r)
+
+    # 3. 每个块在自己的候选集中精算海明距离
+    results = []
+    for chunk_hash, parts in zip(chunk_hashes, chunk_parts):
+        candidates = {}
+        for col_idx, part in enumerate(parts):
+            for r in rows_by_part[col_idx].get(part, ()):
+                candidates[r['id']] = r
+
         best_match = None
         min_dist = 100
-        
-        # 在候选集中精算海明距离
-        for db_fp in candidates:
+        for row_id in sorted(candidates):
+            db_fp = candidates[row_id]
             dist = engine.hamming_distance(chunk_hash, db_fp['fingerprint'])
             
             # 阈值判定：海明距离 <= 3 视为高度相似
-            if dist <= 3:
+            if dist <= SIMHASH_MAX_DISTANCE:
                 if dist < min_dist:
                     min_dist = dist
                     best_match = db_fp
-        
+        results.append((best_match, min_dist))
+
+    # 4. 只为最终命中的订单取项目名
+    order_ids = {m['order_id'] for m, _ in results if m}
+    project_names = dict(await CodeOrder.filter(id__in=order_ids).values_list("id", "project_name")) if order_ids else {}
+    for m, _ in results:
+        if m:
+            m['order__project_name'] = project_names.get(m['order_id'])
+    return results
+
+async def run_duplicate_check(file):
+    start_time = time.time()
+    trace = current_trace()
+    if is_large_upload(file):
+        # 大文件流式切块，按批计算 SimHash，只保留每块的行号和指纹
+        try:
+            with trace.stage("simhash_stream"):
+                input_chunks, chunk_fps, total_lines = await simhash_upload(fp_pool, file.file, 10, 5)
+        except UnicodeDecodeError:
+            return {"error": "文件编码格式错误，请上传 UTF-8 文本文件"}
+    else:
+        with trace.stage("read"):
+            content_bytes = await file.read()
+
+        try:
+            with trace.stage("decode"):
+                code_content = content_bytes.decode('utf-8')
+        except UnicodeDecodeError:
+            return {"error": "文件编码格式错误，请上传 UTF-8 文本文件"}
+
+        # 1. 将上传的代码切片，SimHash 整个文件一次批量算完（大文件在进程池中计算）
+        with trace.stage("simhash"):
+            input_chunks, chunk_fps = await fp_pool.run(len(code_content), simhash_code_chunks, code_content, 10, 5)
+        total_lines = len(code_content.split('\n'))
+    trace.count("chunks", len(chunk_fps))
+    
+    report = []
+    total_suspicious_lines = set()
+    
+    # 2. 逐个块进行比对
+    if simhash_index.ready:
+        best_matches = await match_chunks_in_memory(chunk_fps)
+    else:
+        with trace.stage("match_db"):  # 含项目名查询
+            best_matches = await match_chunks_in_db(chunk_fps)
+    trace.count("matched_chunks", sum(1 for m, _ in best_matches if m))
+
+    for chunk, (best_match, min_dist) in zip(input_chunks, best_matches):
         if best_match:
             # 记录重复详情
             match_info = {
@@ -286,7 +731,6 @@ async def check_duplicate(file: UploadFile = File(...)):
                 total_suspicious_lines.add(i)
 
     # 3. 计算统计数据
-    total_lines = len(code_content.split('\n'))
     duplicate_rate = len(total_suspicious_lines) / total_lines if total_lines > 0 else 0
 
     return {
@@ -297,6 +741,14 @@ async def check_duplicate(file: UploadFile = File(...)):
         "details": report[:50] # 只返回前50条详情
     }
 
+@app.post("/api/duplicate-check")
+async def check_duplicate(response: Response, file: UploadFile = File(...), debug: bool = False):
+    """
+    上传代码文件，返回查重报告。
+    """
+    with request_trace("v1") as trace:
+        return trace.respond(response, await run_duplicate_check(file), debug)
+
 # 注册 Tortoise ORM
 register_tortoise(
     app,
@@ -306,6 +758,124 @@ register_tortoise(
     add_exception_handlers=True,
 )
 
+async def refresh_simhash_index_periodically():
+    while True:
+        await asyncio.sleep(settings.SIMHASH_INDEX_REFRESH_SECONDS)
+        try:
+            # 索引版本号变化（删除/重新索引订单）时顺带清掉内存里已不存在的指纹
+            await simhash_index.sync(await read_generation())
+        except Exception as e:
+            print(f"SimHash 内存索引刷新失败: {e}")
+
+@app.exception_handler(PoolSaturatedError)
+async def pool_saturated_handler(request, exc):
+    return JSONResponse(status_code=503, content={"error": "查重服务繁忙，请稍后重试"})
+
+@app.on_event("startup")
+async def check_hash_scheme():
+    # 否则每个请求、每个增量索引任务都在 winnow 时才报错
+    if settings.FP_HASH_SCHEME not in HASH_SCHEMES:
+        raise ValueError(
+            f"unknown FP_HASH_SCHEME {settings.FP_HASH_SCHEME!r}, expected one of {', '.join(HASH_SCHEMES)}"
+        )
+
+@app.on_event("startup")
+async def start_fp_pool():
+    fp_pool.start()
+
+@app.on_event("shutdown")
+async def stop_fp_pool():
+    fp_pool.shutdown()
+
+# 放在 register_tortoise 之后注册，保证启动时数据库连接已初始化
+@app.on_event("startup")
+async def load_stop_fingerprints():
+    if settings.STOP_FP_MODE not in STOP_FP_MODES:
+        raise ValueError(f"unknown STOP_FP_MODE {settings.STOP_FP_MODE!r}, expected one of {', '.join(STOP_FP_MODES)}")
+    if settings.STOP_FP_MODE == "off":
+        return
+    try:
+        await stop_fps.load()
+    except Exception as e:
+        print(f"停用指纹加载失败，按空表处理: {e}")
+
+async def refresh_doc_stats_periodically():
+    while True:
+        await asyncio.sleep(settings.DOC_STATS_REFRESH_SECONDS)
+        try:
+            await doc_stats.refresh()
+        except Exception as e:
+            print(f"文档统计刷新失败: {e}")
+
+@app.on_event("startup")
+async def check_shard_layout():
+    # 按错误的布局写入会把 postings 写进另一组分片表，查询也会漏掉迁走的行：拒绝启动
+    await check_layout()
+
+async def sync_posting_backend_periodically():
+    while True:
+        await asyncio.sleep(settings.POSTING_INDEX_SYNC_SECONDS)
+        try:
+            generation = await read_generation()
+        except Exception as e:
+            print(f"索引版本号读取失败: {e}")
+            continue
+        await sync_posting_backend(generation)
+
+@app.on_event("startup")
+async def load_posting_backend():
+    global posting_backend
+    try:
+        await posting_backend.load()
+    except Exception as e:
+        # 快照不可用（目录不存在、哈希方案不一致、缺 numpy 等）：行存储始终是最新的，退回它
+        print(f"倒排索引后端 {posting_backend.name} 加载失败，改用 rows: {e}")
+        posting_backend = make_backend("rows")
+    if posting_backend.needs_sync:
+        app.state.posting_sync_task = asyncio.create_task(sync_posting_backend_periodically())
+
+@app.on_event("shutdown")
+async def stop_posting_backend_sync():
+    task = getattr(app.state, "posting_sync_task", None)
+    if task:
+        task.cancel()
+
+@app.on_event("startup")
+async def load_doc_stats():
+    try:
+        await doc_stats.load()
+    except Exception as e:
+        print(f"文档统计加载失败，按输入指纹数归一化: {e}")
+    app.state.doc_stats_refresh_task = asyncio.create_task(refresh_doc_stats_periodically())
+
+@app.on_event("shutdown")
+async def stop_doc_stats_refresh():
+    task = getattr(app.state, "doc_stats_refresh_task", None)
+    if task:
+        task.cancel()
+
+@app.on_event("startup")
+async def load_simhash_index():
+    if not settings.SIMHASH_MEMORY_INDEX:
+        return
+    await simhash_index.load(await read_generation())
+    app.state.simhash_refresh_task = asyncio.create_task(refresh_simhash_index_periodically())
+
+@app.on_event("shutdown")
+async def stop_simhash_refresh():
+    task = getattr(app.state, "simhash_refresh_task", None)
+    if task:
+        task.cancel()
+
+@app.on_event("startup")
+async def start_order_indexer():
+    if settings.INDEXER_ENABLED:
+        order_indexer.start()
+
+@app.on_event("shutdown")
+async def stop_order_indexer():
+    order_indexer.stop()
+
 # --- 这里是关键：添加启动入口 ---
 if __name__ == "__main__":
     # 使用 uvicorn 启动应用
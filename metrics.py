@@ -0,0 +1,232 @@
+# metrics.py
+"""
+Hot-path instrumentation for the duplicate-check endpoints.
+
+A RequestTrace collects, for one request, stage timings
+(`with current_trace().stage("recall"):`), counts (fingerprints, candidates
+before/after pruning) and per-shard query latency and row counts. It lives in
+a context variable, so the recall/rerank code records into it without an
+extra parameter, also from inside asyncio.gather tasks (they inherit the
+context). Outside a request (scripts, the indexer) current_trace() is a no-op.
+
+When the request ends the trace is
+- sent back as a Server-Timing header (one entry per stage, plus total);
+- optionally added to the response as a `debug` block;
+- folded into the process-wide MetricsRegistry, rendered in the Prometheus
+  text format by GET /metrics.
+
+Histograms are labelled by endpoint and stage/count name only; the per-shard
+breakdown goes to counters (rows, queries, seconds per shard) to keep the
+number of series bounded.
+"""
+import contextvars
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ROW_BUCKETS = (0, 10, 100, 1_000, 10_000, 100_000, 1_000_000)
+COUNT_BUCKETS = (0, 1, 10, 100, 1_000, 10_000, 100_000, 1_000_000)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+# name -> (type, help, buckets)
+FAMILIES = {
+    "dupcheck_requests_total": ("counter", "Duplicate-check requests by endpoint and outcome.", None),
+    "dupcheck_request_seconds": ("histogram", "Duplicate-check request latency.", TIME_BUCKETS),
+    "dupcheck_stage_seconds": ("histogram", "Time spent per request in each stage.", TIME_BUCKETS),
+    "dupcheck_items": ("histogram", "Per-request sizes: fingerprints, candidates before/after pruning.", COUNT_BUCKETS),
+    "dupcheck_shard_query_seconds": ("histogram", "Latency of one shard's queries within a request.", TIME_BUCKETS),
+    "dupcheck_shard_query_rows": ("histogram", "Rows returned by one shard's queries within a request.", ROW_BUCKETS),
+    "dupcheck_shard_queries_total": ("counter", "Shard query batches by kind and shard.", None),
+    "dupcheck_shard_rows_total": ("counter", "Rows read by kind and shard.", None),
+    "dupcheck_shard_seconds_total": ("counter", "Seconds spent querying by kind and shard.", None),
+}
+
+def _labels(**labels: object) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+def _format_value(v: float) -> str:
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+class MetricsRegistry:
+    def __init__(self):
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = defaultdict(dict)
+        self._counters: Dict[str, Dict[Labels, float]] = defaultdict(lambda: defaultdict(float))
+
+    def observe(self, name: str, value: float, **labels: object) -> None:
+        series = self._histograms[name]
+        key = _labels(**labels)
+        hist = series.get(key)
+        if hist is None:
+            hist = series[key] = Histogram(FAMILIES[name][2])
+        hist.observe(value)
+
+    def inc(self, name: str, amount: float = 1, **labels: object) -> None:
+        self._counters[name][_labels(**labels)] += amount
+
+    def record(self, trace: "RequestTrace") -> None:
+        endpoint = trace.endpoint
+        self.inc("dupcheck_requests_total", endpoint=endpoint, status=trace.status)
+        self.observe("dupcheck_request_seconds", trace.total_seconds, endpoint=endpoint)
+        for stage, seconds in trace.stages.items():
+            self.observe("dupcheck_stage_seconds", seconds, endpoint=endpoint, stage=stage)
+        for item, n in trace.counts.items():
+            self.observe("dupcheck_items", n, endpoint=endpoint, item=item)
+        for kind, shard, seconds, rows in trace.shard_queries:
+            self.observe("dupcheck_shard_query_seconds", seconds, endpoint=endpoint, kind=kind)
+            self.observe("dupcheck_shard_query_rows", rows, endpoint=endpoint, kind=kind)
+            self.inc("dupcheck_shard_queries_total", kind=kind, shard=shard)
+            self.inc("dupcheck_shard_rows_total", rows, kind=kind, shard=shard)
+            self.inc("dupcheck_shard_seconds_total", seconds, kind=kind, shard=shard)
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)."""
+        lines: List[str] = []
+        for name, (kind, help_text, _) in FAMILIES.items():
+            if kind == "counter":
+                series = self._counters.get(name)
+                if not series:
+                    continue
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                for labels in sorted(series):
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(series[labels])}")
+                continue
+            series = self._histograms.get(name)
+            if not series:
+                continue
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            for labels in sorted(series):
+                hist = series[labels]
+                cumulative = 0
+                for upper, n in zip(hist.buckets, hist.counts):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{_format_labels(labels, ('le', repr(float(upper))))} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {hist.count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(hist.sum)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+class RequestTrace:
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.total_seconds = 0.0
+        self.status = "ok"
+        self.stages: Dict[str, float] = {}  # 同名阶段（如批量里每个文件的 decode）累加
+        self.counts: Dict[str, int] = {}
+        self.shard_queries: List[Tuple[str, int, float, int]] = []  # (kind, shard, seconds, rows)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - t0)
+
+    def add_time(self, name: str, seconds: float) -> None:
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, name: str, n: int) -> None:
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def shard_query(self, kind: str, shard: int, seconds: float, rows: int) -> None:
+        self.shard_queries.append((kind, shard, seconds, rows))
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+        entries.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(entries)
+
+    def debug(self) -> dict:
+        shards = {}
+        for kind, shard, seconds, rows in self.shard_queries:
+            s = shards.setdefault(kind, {"shards": 0, "rows": 0, "max_ms": 0.0, "slowest_shard": None, "per_shard": []})
+            s["shards"] += 1
+            s["rows"] += rows
+            if seconds * 1000 >= s["max_ms"]:
+                s["max_ms"] = round(seconds * 1000, 2)
+                s["slowest_shard"] = shard
+            s["per_shard"].append({"shard": shard, "ms": round(seconds * 1000, 2), "rows": rows})
+        return {
+            "total_ms": round(self.elapsed() * 1000, 2),
+            "stages_ms": {name: round(seconds * 1000, 2) for name, seconds in self.stages.items()},
+            "counts": dict(self.counts),
+            "shard_queries": shards,
+        }
+
+    def respond(self, response, result, debug: bool = False):
+        """Attach Server-Timing (and the debug block when asked) to an endpoint's result."""
+        if isinstance(result, dict) and "error" in result:
+            self.status = "error"
+        response.headers["Server-Timing"] = self.server_timing()
+        if debug and isinstance(result, dict):
+            result["debug"] = self.debug()
+        return result
+
+class _NullTrace(RequestTrace):
+    """Trace used outside a request: records nothing."""
+
+    def stage(self, name: str):
+        return nullcontext()
+
+    def add_time(self, name: str, seconds: float) -> None:
+        pass
+
+    def count(self, name: str, n: int) -> None:
+        pass
+
+    def shard_query(self, kind: str, shard: int, seconds: float, rows: int) -> None:
+        pass
+
+_NULL_TRACE = _NullTrace("none")
+_current: contextvars.ContextVar[RequestTrace] = contextvars.ContextVar("request_trace", default=_NULL_TRACE)
+
+registry = MetricsRegistry()
+
+def current_trace() -> RequestTrace:
+    return _current.get()
+
+@contextmanager
+def request_trace(endpoint: str, metrics: MetricsRegistry = registry) -> Iterator[RequestTrace]:
+    """Bind a new trace for the duration of a request; record it into `metrics` on exit."""
+    trace = RequestTrace(endpoint)
+    token = _current.set(trace)
+    try:
+        yield trace
+    except BaseException:
+        trace.status = "exception"
+        raise
+    finally:
+        _current.reset(token)
+        trace.total_seconds = trace.elapsed()
+        metrics.record(trace)
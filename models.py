@@ -117,8 +117,58 @@ class CodeDocStat(models.Model):
     order = fields.OneToOneField("model.CodeOrder", related_name="doc_stat", pk=True)
     fp_count = fields.IntField()
     token_count = fields.IntField()
+    # 该订单的 postings 落在哪些分片：bit i 表示有 fp & 63 == i 的 postings，与分片数无关，见 shard_router.py（按 int64 存，读出后 to_uint64）
+    shard_mask = fields.BigIntField(default=0)
     updated_at = fields.DatetimeField(auto_now=True)
 
     class Meta:
         table = "code_doc_stats"
-        indexes = (("fp_count",),)
\ No newline at end of file
+        indexes = (("fp_count",), ("updated_at",))
+
+class IndexState(models.Model):
+    """
+    索引版本号：写入/删除 postings 的脚本在同一事务内 +1，查重服务据此让结果缓存失效
+    """
+    name = fields.CharField(max_length=50, pk=True)
+    generation = fields.BigIntField(default=0)
+    updated_at = fields.DatetimeField(auto_now=True)
+
+    class Meta:
+        table = "index_state"
+
+class RebuildProgress(models.Model):
+    """
+    重建/索引任务的断点：last_order_id 之前（含）的订单已全部提交
+    """
+    name = fields.CharField(max_length=50, pk=True)
+    last_order_id = fields.IntField(default=0)
+    updated_at = fields.DatetimeField(auto_now=True)
+
+    class Meta:
+        table = "rebuild_progress"
+
+class IndexJobStatus(str, enum.Enum):
+    PENDING = "PENDING"   # 等待写入查重索引
+    DONE = "DONE"         # 已写入（order_updated_at 对应的版本）
+    FAILED = "FAILED"     # 超过重试次数
+
+class IndexJob(models.Model):
+    """
+    增量索引队列：订单进入 COMPLETED 后入队，由服务内的 OrderIndexer 写入分片倒排表和 code_fingerprints。
+    记录落库，服务重启后继续处理 PENDING；DONE 且订单未再更新的不会重复索引。
+    """
+    order = fields.OneToOneField("model.CodeOrder", related_name="index_job", pk=True)
+    status = fields.CharEnumField(IndexJobStatus, default=IndexJobStatus.PENDING, max_length=20)
+    attempts = fields.IntField(default=0)
+    error = fields.TextField(null=True)
+    # 入队时订单的 updated_at，订单之后再被更新会重新入队
+    order_updated_at = fields.DatetimeField(null=True)
+    created_at = fields.DatetimeField(auto_now_add=True)
+    updated_at = fields.DatetimeField(auto_now=True)
+
+    class Meta:
+        table = "index_jobs"
+        indexes = (
+            ("status", "created_at"),
+            ("order_updated_at",),
+        )
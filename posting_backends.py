@@ -0,0 +1,737 @@
+# posting_backends.py
+"""
+Storage backends behind the recall and rerank stages of the v2 endpoints,
+selected by POSTING_BACKEND.
+
+main.py talks to a backend through three calls:
+- recall_shard(shard, fps) -> {fp: {order_id: postings}} for one shard (the
+  shards run as concurrent tasks);
+- recall_orders(shard, fps) -> {order_id: postings} summed over fps, for a
+  single file when the recall cache is off (no per-fp summaries needed);
+- fetch_postings(jobs) -> one {order_id: PostingList} per job, a job being
+  (rerank_ids, fps_by_shard) of one file.
+
+rows    code_postings_XX, one row per posting, kept current by the indexer
+        and the rebuild scripts (posting_writer).
+blocks  code_posting_blocks_XX (one compressed posting list per fingerprint)
+        plus code_order_lines (per-order pos -> line map), see posting_blocks.
+        A snapshot converted from the row tables by convert_posting_blocks.py:
+        recall reads one row per fingerprint instead of one per posting, and
+        rerank reuses the same rows plus one line map per candidate. Orders
+        indexed, re-indexed or deleted since the conversion are served from
+        an in-memory overlay read from the row tables (see BlockPostingBackend).
+mmap    a local index file exported by export_posting_index.py (format in
+        posting_index), memory-mapped and probed with binary search, so
+        recall and rerank make no database round trips. Orders indexed,
+        re-indexed or deleted since the export are served from an in-memory
+        overlay read from the row tables (see MmapPostingBackend).
+
+Backends also implement sync(generation), called with the postings
+generation whenever the service sees it advance (rows ignores it).
+"""
+import asyncio
+import bisect
+import datetime
+import os
+import pathlib
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from tortoise import timezone
+from tortoise.transactions import in_transaction
+
+from alignment import PostingList
+from config import settings
+from index_generation import bump_generation, read_generation
+from metrics import current_trace
+from models import CodeDocStat, IndexState
+from posting_blocks import decode_block, decode_block_summary, decode_line_map, np
+from posting_index import META, PostingArrays, PostingIndex, as_uint64, require_numpy
+from posting_writer import load_shard_masks
+from shard_router import router as default_router
+
+RECALL_BATCH = 300
+RERANK_ORDER_BATCH = 100  # rerank 时每条查询最多带多少个 order_id（TOP_N 以内通常一批）
+BLOCK_TABLE_PREFIX = "code_posting_blocks"
+LINES_TABLE = "code_order_lines"
+BLOCKS_STATE = "posting_blocks"  # index_state 行：转换开始时 postings 的索引版本号
+BLOCKS_WATERMARK = "posting_blocks_watermark"  # index_state 行：转换开始时 code_doc_stats.updated_at 的最大值（微秒）
+OVERLAY_ORDER_BATCH = 500  # 覆盖层按 order_id IN (...) 读取分片表时每批的订单数
+LOAD_PAGE = 50000
+
+Job = Tuple[Sequence[int], Dict[int, List[int]]]  # (rerank_ids, fps_by_shard)
+
+def chunked(lst, n):
+    for i in range(0, len(lst), n):
+        yield lst[i:i+n]
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+async def record_blocks_snapshot(generation: int, watermark: Optional[datetime.datetime]) -> None:
+    """convert_posting_blocks.py 转换完成：记下快照的版本号与 watermark，并递增索引版本号让服务刷新覆盖层"""
+    if watermark is not None and timezone.is_naive(watermark):
+        watermark = timezone.make_aware(watermark)
+    micros = (watermark - _EPOCH) // datetime.timedelta(microseconds=1) if watermark is not None else -1
+    async with in_transaction() as conn:
+        await IndexState.update_or_create(name=BLOCKS_STATE, defaults={"generation": generation}, using_db=conn)
+        await IndexState.update_or_create(name=BLOCKS_WATERMARK, defaults={"generation": micros}, using_db=conn)
+        await bump_generation(conn=conn)
+
+async def read_blocks_snapshot() -> Tuple[int, Optional[datetime.datetime]]:
+    """(快照版本号, watermark)；watermark 为 None 表示转换时没有 code_doc_stats 行或由旧版脚本转换"""
+    generation = await read_generation(BLOCKS_STATE)
+    micros = await read_generation(BLOCKS_WATERMARK)
+    if micros <= 0:
+        return generation, None
+    return generation, _EPOCH + datetime.timedelta(microseconds=micros)
+
+async def scan_changed_orders(since, seen: Dict[int, object]) -> Tuple[List[int], object]:
+    """
+    updated_at >= since - CHANGE_SCAN_LAG_SECONDS 的订单中版本（updated_at）与 seen 记录不同的，
+    以及扫到的最新 updated_at。回退一段时间重扫：时间戳较早、但在上次扫描之后才提交的行不会漏；
+    seen（order_id -> 已读到的 updated_at，就地更新）让回退窗口内没变的订单不必每次重读。
+    """
+    lag = datetime.timedelta(seconds=settings.CHANGE_SCAN_LAG_SECONDS)
+    changed, last_id, latest = [], 0, since
+    while True:
+        qs = CodeDocStat.filter(order_id__gt=last_id)
+        if since is not None:
+            qs = qs.filter(updated_at__gte=since - lag)
+        rows = await qs.order_by("order_id").limit(LOAD_PAGE).values_list("order_id", "updated_at")
+        if not rows:
+            break
+        for oid, updated_at in rows:
+            if seen.get(oid) != updated_at:
+                changed.append(oid)
+                seen[oid] = updated_at
+            if latest is None or updated_at > latest:
+                latest = updated_at
+        last_id = rows[-1][0]
+    if latest is not None:
+        for oid in [oid for oid, updated_at in seen.items() if updated_at < latest - lag]:
+            del seen[oid]
+    return changed, latest
+
+async def doc_stat_order_ids() -> List[int]:
+    ids_all, last_id = [], 0
+    while True:
+        ids = await CodeDocStat.filter(order_id__gt=last_id).order_by("order_id").limit(LOAD_PAGE).values_list(
+            "order_id", flat=True
+        )
+        if not ids:
+            return ids_all
+        ids_all.extend(ids)
+        last_id = ids[-1]
+
+async def read_order_postings(router, order_ids: List[int]) -> Dict[int, List[tuple]]:
+    """订单在分片表中的当前 postings [(fp, pos, start_line, end_line)]（按清单里的分片读，没有清单的读全部分片）"""
+    masks = await load_shard_masks(order_ids)
+    by_shard = defaultdict(list)
+    for oid in order_ids:
+        mask = masks.get(oid)
+        for shard in (router.shards_of_mask(mask) if mask else router.shards):
+            by_shard[shard].append(oid)
+    rows_by_order = {oid: [] for oid in order_ids}
+    async with in_transaction() as conn:
+        for shard, ids in by_shard.items():
+            for sub in chunked(ids, OVERLAY_ORDER_BATCH):
+                ph = ",".join(["%s"] * len(sub))
+                rows = await conn.execute_query_dict(
+                    f"SELECT fp, order_id, pos, start_line, end_line FROM {router.table(shard)} "
+                    f"WHERE order_id IN ({ph})",
+                    sub,
+                )
+                for r in rows:
+                    rows_by_order[int(r["order_id"])].append(
+                        (int(r["fp"]), int(r["pos"]), int(r["start_line"]), int(r["end_line"]))
+                    )
+    return rows_by_order
+
+def job_shards(jobs: Sequence[Job]) -> List[int]:
+    return list(dict.fromkeys(s for oids, fps_by_shard in jobs if oids for s in fps_by_shard))
+
+def order_totals(shard_summaries: Dict[int, Dict[int, int]]) -> Dict[int, int]:
+    """recall_shard 的结果按 order_id 汇总"""
+    totals = defaultdict(int)
+    for counts in shard_summaries.values():
+        for oid, c in counts.items():
+            totals[oid] += c
+    return totals
+
+class RowPostingBackend:
+    name = "rows"
+    needs_sync = False
+
+    def __init__(self, router=default_router):
+        self.router = router
+
+    async def load(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": self.name}
+
+    async def sync(self, generation: int) -> None:
+        pass
+
+    async def recall_shard(self, shard: int, fps: List[int]) -> Dict[int, Dict[int, int]]:
+        t0 = time.perf_counter()
+        n_rows = 0
+        tbl = self.router.table(shard)
+        shard_summaries = {fp: {} for fp in fps}
+        async with in_transaction() as conn:
+            for sub in chunked(fps, RECALL_BATCH):
+                ph = ",".join(["%s"] * len(sub))
+                sql = f"SELECT fp, order_id, COUNT(*) AS hit FROM {tbl} WHERE fp IN ({ph}) GROUP BY fp, order_id"
+                rows = await conn.execute_query_dict(sql, sub)
+                n_rows += len(rows)
+                for r in rows:
+                    shard_summaries[int(r["fp"])][int(r["order_id"])] = int(r["hit"])
+        current_trace().shard_query("recall", shard, time.perf_counter() - t0, n_rows)
+        return shard_summaries
+
+    async def recall_orders(self, shard: int, fps: List[int]) -> Dict[int, int]:
+        """按 order_id 聚合的命中数：只需要总数时不取回逐指纹的行"""
+        t0 = time.perf_counter()
+        n_rows = 0
+        tbl = self.router.table(shard)
+        hits = defaultdict(int)
+        async with in_transaction() as conn:
+            for sub in chunked(fps, RECALL_BATCH):
+                ph = ",".join(["%s"] * len(sub))
+                sql = f"SELECT order_id, COUNT(*) AS hit FROM {tbl} WHERE fp IN ({ph}) GROUP BY order_id"
+                rows = await conn.execute_query_dict(sql, sub)
+                n_rows += len(rows)
+                for r in rows:
+                    hits[int(r["order_id"])] += int(r["hit"])
+        current_trace().shard_query("recall", shard, time.perf_counter() - t0, n_rows)
+        return hits
+
+    async def fetch_postings(self, jobs: Sequence[Job]) -> List[Dict[int, PostingList]]:
+        """
+        每个分片上，相邻 job 的 order_id / fp 并集不超过 RERANK_ORDER_BATCH / RECALL_BATCH 时
+        合并成一组 order_id IN (...) AND fp IN (...) 查询（同一项目的小文件通常共用一条），
+        取回的行再按各 job 自己的 order_id 与 fp 分回去。
+        """
+        shards = job_shards(jobs)
+
+        async def query_shard_postings(shard):
+            groups = []  # [order_ids, fps, job 下标]
+            for j, (oids, fps_by_shard) in enumerate(jobs):
+                shard_fps = fps_by_shard.get(shard)
+                if not oids or not shard_fps:
+                    continue
+                if groups:
+                    g_oids, g_fps, members = groups[-1]
+                    u_oids = list(dict.fromkeys(g_oids + oids))
+                    u_fps = list(dict.fromkeys(g_fps + shard_fps))
+                    if len(u_oids) <= RERANK_ORDER_BATCH and len(u_fps) <= RECALL_BATCH:
+                        groups[-1] = [u_oids, u_fps, members + [j]]
+                        continue
+                groups.append([list(oids), list(shard_fps), [j]])
+
+            t0 = time.perf_counter()
+            n_rows = 0
+            tbl = self.router.table(shard)
+            rows_by_job = defaultdict(list)
+            async with in_transaction() as conn:
+                for g_oids, g_fps, members in groups:
+                    rows = []
+                    for oid_sub in chunked(g_oids, RERANK_ORDER_BATCH):
+                        oid_ph = ",".join(["%s"] * len(oid_sub))
+                        for sub in chunked(g_fps, RECALL_BATCH):
+                            ph = ",".join(["%s"] * len(sub))
+                            sql = (
+                                f"SELECT order_id, fp, pos, start_line, end_line FROM {tbl} "
+                                f"WHERE order_id IN ({oid_ph}) AND fp IN ({ph})"
+                            )
+                            rows.extend(await conn.execute_query_dict(sql, list(oid_sub) + sub))
+                    n_rows += len(rows)
+                    if len(members) == 1:
+                        rows_by_job[members[0]].extend(rows)
+                        continue
+                    for j in members:
+                        oid_set = set(jobs[j][0])
+                        fp_set = set(jobs[j][1][shard])
+                        rows_by_job[j].extend(
+                            r for r in rows if int(r["order_id"]) in oid_set and int(r["fp"]) in fp_set
+                        )
+            current_trace().shard_query("rerank", shard, time.perf_counter() - t0, n_rows)
+            return rows_by_job
+
+        by_shard = dict(zip(shards, await asyncio.gather(*[query_shard_postings(s) for s in shards])))
+
+        results = []
+        for j, (oids, fps_by_shard) in enumerate(jobs):
+            postings_by_order = defaultdict(PostingList)
+            if oids:
+                for shard in fps_by_shard:
+                    for p in by_shard[shard].get(j, ()):
+                        postings_by_order[int(p["order_id"])].append(
+                            int(p["fp"]), int(p["pos"]), int(p["start_line"]), int(p["end_line"])
+                        )
+            results.append(postings_by_order)
+        return results
+
+def _select_orders(order_ids, counts, pos, wanted: set) -> Dict[int, list]:
+    """order_id -> positions, only for orders in `wanted`."""
+    out = {}
+    if not isinstance(order_ids, list):
+        starts = np.cumsum(counts) - counts
+        for i in np.flatnonzero(np.isin(order_ids, np.fromiter(wanted, dtype=np.int64, count=len(wanted)))):
+            out[int(order_ids[i])] = pos[starts[i]:starts[i] + counts[i]].tolist()
+        return out
+    start = 0
+    for oid, c in zip(order_ids, counts):
+        if oid in wanted:
+            out[oid] = pos[start:start + c]
+        start += c
+    return out
+
+def _lines_at(line_map, positions: List[int]) -> List[Optional[Tuple[int, int]]]:
+    """
+    (start_line, end_line) of each position, looked up in an order's line map;
+    None where the map has no such position (the order was re-indexed between
+    the conversion of its blocks and of its line map).
+    """
+    lp, ls, le = line_map
+    if not isinstance(lp, list):
+        if not len(lp):
+            return [None] * len(positions)
+        idx = np.minimum(np.searchsorted(lp, positions), len(lp) - 1)
+        found = (lp[idx] == np.asarray(positions, dtype=lp.dtype)).tolist()
+        return [(s, e) if f else None for s, e, f in zip(ls[idx].tolist(), le[idx].tolist(), found)]
+    out = []
+    for p in positions:
+        i = bisect.bisect_left(lp, p)
+        out.append((ls[i], le[i]) if i < len(lp) and lp[i] == p else None)
+    return out
+
+class BlockPostingBackend:
+    """
+    快照：convert_posting_blocks.py 转换出的块表与行号表。
+    覆盖层：code_doc_stats.updated_at 不早于转换开始时刻（watermark）的订单（转换之后新索引或重新索引的）
+    从分片表读进内存；这些订单以及之后删除的订单在块里的 postings 查询时被屏蔽。删除靠计数发现：
+    code_doc_stats 的行数与已知订单数不一致时才全量扫一遍 order_id。
+
+    sync(generation) 在版本号前进时刷新覆盖层；转换完成时会递增版本号，这时按新快照的 watermark
+    重新开始（已删除的订单继续屏蔽：转换期间删除的订单可能还留在较早转换的分片里）。
+    """
+    name = "blocks"
+    needs_sync = True
+
+    def __init__(self, router=default_router):
+        self.router = router
+        self.snapshot_generation = None
+        self.watermark = None
+        self._snapshot = None  # index_state 里记录的 (快照版本号, watermark)
+        self.generation = -1  # 覆盖层对应的 postings 版本号
+        self._lock = asyncio.Lock()
+        self._known = set()  # 已知有 code_doc_stats 行的订单
+        self._deleted = set()
+        self._reset_overlay()
+
+    def _reset_overlay(self) -> None:
+        self._since = self.watermark  # 覆盖层已扫到的 updated_at
+        self._seen = {}  # 回退窗口内已读过的订单版本，见 scan_changed_orders
+        self._changed: Dict[int, List[tuple]] = {}  # order_id -> [(fp, pos, start_line, end_line)]
+        self.overlay: Dict[int, Dict[int, List[tuple]]] = {}  # fp -> order_id -> [(pos, start_line, end_line)]
+        self.dirty = set(self._deleted)  # 块里要屏蔽的订单
+
+    async def load(self) -> None:
+        await self.sync(await read_generation())
+        print(f"压缩块快照: {self.stats()}")
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.name,
+            "snapshot_generation": self.snapshot_generation,
+            "watermark": self.watermark.isoformat() if self.watermark else None,
+            "generation": self.generation,
+            "overlay_orders": len(self._changed),
+            "overlay_postings": sum(len(rows) for rows in self._changed.values()),
+            "deleted_orders": len(self._deleted),
+        }
+
+    async def sync(self, generation: int) -> None:
+        if generation <= self.generation:
+            return
+        async with self._lock:
+            if generation <= self.generation:
+                return
+            generation = max(generation, await read_generation())
+            snapshot = await read_blocks_snapshot()
+            if snapshot != self._snapshot:
+                self._snapshot = snapshot
+                self.snapshot_generation, self.watermark = snapshot
+                if self.watermark is None:
+                    # 没有 watermark（旧版脚本转换）：只能从现在开始跟踪，请重新运行 convert_posting_blocks.py
+                    self.watermark = await CodeDocStat.all().order_by("-updated_at").first().values_list(
+                        "updated_at", flat=True
+                    )
+                    print("压缩块快照没有记录 watermark，转换之后、启动之前的变更不可见，请重新转换")
+                self._reset_overlay()
+            await self._refresh_overlay()
+            self.generation = generation
+
+    async def _scan_deleted(self) -> set:
+        if await CodeDocStat.all().count() == len(self._known):
+            return set()
+        alive = set(await doc_stat_order_ids())
+        gone = self._known - alive
+        self._known = alive
+        return gone
+
+    async def _refresh_overlay(self) -> None:
+        t0 = time.perf_counter()
+        changed, self._since = await scan_changed_orders(self._since, self._seen)
+        if changed:
+            self._changed.update(await read_order_postings(self.router, changed))
+            self._known.update(changed)
+            self._deleted.difference_update(changed)
+        gone = await self._scan_deleted()
+        for oid in gone:
+            self._changed.pop(oid, None)
+        self._deleted.update(gone)
+        if changed or gone:
+            self._rebuild_overlay()
+            print(
+                f"压缩块覆盖层: 读取 {len(changed)} 个订单, 删除 {len(gone)} 个, "
+                f"共 {len(self._changed)} 个订单, 耗时 {time.perf_counter() - t0:.2f}s"
+            )
+
+    def _rebuild_overlay(self) -> None:
+        overlay = {}
+        for oid, rows in self._changed.items():
+            for fp, pos, start_line, end_line in rows:
+                overlay.setdefault(fp, {}).setdefault(oid, []).append((pos, start_line, end_line))
+        for by_order in overlay.values():
+            for entries in by_order.values():
+                entries.sort()
+        self.overlay = overlay
+        self.dirty = set(self._changed) | self._deleted
+
+    async def _fetch_blocks(self, shard: int, fps: List[int]) -> List[Tuple[int, bytes]]:
+        tbl = self.router.table(shard, BLOCK_TABLE_PREFIX)
+        blocks = []
+        async with in_transaction() as conn:
+            for sub in chunked(fps, RECALL_BATCH):
+                ph = ",".join(["%s"] * len(sub))
+                rows = await conn.execute_query_dict(f"SELECT fp, data FROM {tbl} WHERE fp IN ({ph})", sub)
+                blocks.extend((int(r["fp"]), bytes(r["data"])) for r in rows)
+        return blocks
+
+    async def recall_shard(self, shard: int, fps: List[int]) -> Dict[int, Dict[int, int]]:
+        t0 = time.perf_counter()
+        shard_summaries = {fp: {} for fp in fps}
+        dirty = self.dirty
+        for fp, data in await self._fetch_blocks(shard, fps):
+            order_ids, counts = decode_block_summary(data)
+            if dirty:
+                shard_summaries[fp] = {oid: c for oid, c in zip(order_ids, counts) if oid not in dirty}
+            else:
+                shard_summaries[fp] = dict(zip(order_ids, counts))
+        for fp in fps:
+            by_order = self.overlay.get(fp)
+            if by_order:
+                shard_summaries[fp].update((oid, len(entries)) for oid, entries in by_order.items())
+        n_pairs = sum(len(summary) for summary in shard_summaries.values())
+        # rows 与行存储的 GROUP BY 结果同口径：(fp, order_id) 对数
+        current_trace().shard_query("recall", shard, time.perf_counter() - t0, n_pairs)
+        return shard_summaries
+
+    async def recall_orders(self, shard: int, fps: List[int]) -> Dict[int, int]:
+        return order_totals(await self.recall_shard(shard, fps))
+
+    async def _fetch_line_maps(self, order_ids: List[int]) -> dict:
+        line_maps = {}
+        async with in_transaction() as conn:
+            for sub in chunked(order_ids, RERANK_ORDER_BATCH):
+                ph = ",".join(["%s"] * len(sub))
+                rows = await conn.execute_query_dict(
+                    f"SELECT order_id, data FROM {LINES_TABLE} WHERE order_id IN ({ph})", sub
+                )
+                for r in rows:
+                    line_maps[int(r["order_id"])] = decode_line_map(bytes(r["data"]))
+        current_trace().count("line_maps", len(line_maps))
+        return line_maps
+
+    async def fetch_postings(self, jobs: Sequence[Job]) -> List[Dict[int, PostingList]]:
+        """
+        每个分片一组 fp IN (...) 取所有 job 的指纹块（每个块只解码一次），只保留候选订单的位置；
+        候选订单的行号表一条 order_id IN (...) 查询，与分片查询并发。覆盖层里的订单直接取内存中的 postings。
+        """
+        shards = job_shards(jobs)
+        wanted = set(oid for oids, _ in jobs for oid in oids) - self.dirty
+
+        async def shard_positions(shard):
+            fps = list(dict.fromkeys(fp for oids, by_shard in jobs if oids for fp in by_shard.get(shard, ())))
+            t0 = time.perf_counter()
+            positions = {}  # fp -> order_id -> [pos]
+            n_rows = 0
+            for fp, data in await self._fetch_blocks(shard, fps) if wanted else ():
+                selected = _select_orders(*decode_block(data), wanted)
+                if selected:
+                    positions[fp] = selected
+                    n_rows += sum(len(p) for p in selected.values())
+            current_trace().shard_query("rerank", shard, time.perf_counter() - t0, n_rows)
+            return positions
+
+        line_maps, *by_shard = await asyncio.gather(
+            self._fetch_line_maps(list(wanted)), *[shard_positions(s) for s in shards]
+        )
+        by_shard = dict(zip(shards, by_shard))
+
+        results = []
+        overlay = self.overlay
+        for oids, fps_by_shard in jobs:
+            hits = defaultdict(lambda: ([], []))  # order_id -> (fps, positions)
+            overlay_hits = defaultdict(list)  # order_id -> [(fp, pos, start_line, end_line)]
+            if oids:
+                oid_set = set(oids)
+                for shard, shard_fps in fps_by_shard.items():
+                    positions = by_shard[shard]
+                    for fp in dict.fromkeys(shard_fps):
+                        for oid, pos in positions.get(fp, {}).items():
+                            if oid in oid_set:
+                                hits[oid][0].extend([fp] * len(pos))
+                                hits[oid][1].extend(pos)
+                        for oid, entries in overlay.get(fp, {}).items():
+                            if oid in oid_set:
+                                overlay_hits[oid].extend((fp, *e) for e in entries)
+            postings_by_order = defaultdict(PostingList)
+            for oid, (fps, pos) in hits.items():
+                line_map = line_maps.get(oid)
+                if line_map is None:
+                    continue
+                postings = postings_by_order[oid]
+                for fp, p, lines in zip(fps, pos, _lines_at(line_map, pos)):
+                    if lines is not None:
+                        postings.append(fp, p, *lines)
+            for oid, entries in overlay_hits.items():
+                postings = postings_by_order[oid]
+                for fp, p, start_line, end_line in entries:
+                    postings.append(fp, p, start_line, end_line)
+            results.append(postings_by_order)
+        return results
+
+def _runs(owner, order_ids):
+    """Start index and length of each run of equal (owner, order_id) in two aligned arrays."""
+    if not len(owner):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(np.r_[True, (owner[1:] != owner[:-1]) | (order_ids[1:] != order_ids[:-1])])
+    return starts, np.diff(np.append(starts, len(owner)))
+
+class MmapPostingBackend:
+    """
+    快照：export_posting_index.py 导出的本地索引，启动时内存映射。
+    覆盖层：code_doc_stats.updated_at 不早于快照 watermark 的订单（导出之后新索引或重新索引的）
+    从分片表读进内存，按同样的格式排好；这些订单以及导出之后删除的订单在快照里的 postings
+    查询时被屏蔽。删除靠计数发现：code_doc_stats 的行数与"快照订单 - 已屏蔽 + 覆盖层订单"
+    不一致时才全量扫一遍 order_id。
+
+    sync(generation) 在版本号前进时刷新覆盖层，发现新导出的快照时重新映射并清空覆盖层。
+    没有 code_doc_stats 行的旧订单不受覆盖层跟踪，按快照内容返回。
+    """
+    name = "mmap"
+    needs_sync = True
+
+    def __init__(self, router=default_router, path=None):
+        self.router = router
+        self.path = pathlib.Path(path or settings.POSTING_INDEX_DIR)
+        self.index = None
+        self.generation = -1  # 覆盖层对应的 postings 版本号
+        self._meta_stat = None
+        self._lock = asyncio.Lock()
+        self._reset_overlay()
+
+    def _reset_overlay(self) -> None:
+        self._since = None  # 覆盖层已扫到的 updated_at
+        self._seen = {}  # 回退窗口内已读过的订单版本，见 scan_changed_orders
+        self._changed: Dict[int, tuple] = {}  # order_id -> (fps, order_id, pos, start_line, end_line) 数组
+        self._deleted = set()
+        self._dirty_base = set()  # 被屏蔽的快照订单
+        self.overlay = None
+        self.dirty = None
+
+    async def load(self) -> None:
+        require_numpy()
+        await self.sync(await read_generation())
+        print(f"本地倒排索引已映射: {self.stats()}")
+
+    def stats(self) -> dict:
+        out = {"backend": self.name, "path": str(self.path), "generation": self.generation}
+        if self.index is not None:
+            meta = self.index.meta
+            out.update({
+                "snapshot_generation": meta.get("generation"),
+                "snapshot_created_at": meta.get("created_at"),
+                "watermark": meta.get("watermark"),
+                "fps": meta["n_fps"],
+                "postings": meta["n_postings"],
+                "overlay_orders": len(self._changed),
+                "overlay_postings": self.overlay.n_postings,
+                "deleted_orders": len(self._deleted),
+            })
+        return out
+
+    def _stat_meta(self):
+        """快照 meta 文件的 (inode, mtime)；文件不存在时为 None"""
+        try:
+            st = os.stat(self.path / META)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns
+
+    def _snapshot_changed(self, meta_stat) -> bool:
+        if self.index is None:
+            return True
+        # publish 换目录的间隙里目录不存在：保持当前映射，下次同步再看
+        return meta_stat is not None and meta_stat != self._meta_stat
+
+    async def sync(self, generation: int) -> None:
+        if generation <= self.generation and not self._snapshot_changed(self._stat_meta()):
+            return
+        async with self._lock:
+            meta_stat = self._stat_meta()
+            if self._snapshot_changed(meta_stat):
+                index = PostingIndex(self.path)
+                if index.meta.get("hash_scheme") != settings.FP_HASH_SCHEME:
+                    raise ValueError(
+                        f"{self.path}: 导出时 FP_HASH_SCHEME={index.meta.get('hash_scheme')}，"
+                        f"当前为 {settings.FP_HASH_SCHEME}"
+                    )
+                self.index, self._meta_stat = index, meta_stat
+                self._reset_overlay()
+                self._since = index.watermark
+                self.generation = -1
+                self._rebuild_overlay()
+            elif generation <= self.generation:
+                return
+            generation = max(generation, await read_generation())
+            await self._refresh_overlay()
+            self.generation = generation
+
+    async def _scan_deleted(self) -> set:
+        """已跟踪（快照里未屏蔽的 + 覆盖层中的）但 code_doc_stats 行已不存在的订单"""
+        expected = len(self.index.orders) - len(self._dirty_base) + len(self._changed)
+        if await CodeDocStat.all().count() == expected:
+            return set()
+        alive = np.asarray(await doc_stat_order_ids(), dtype=np.int64)
+        gone = set(np.setdiff1d(np.asarray(self.index.orders, dtype=np.int64), alive).tolist()) - self._dirty_base
+        gone.update(set(self._changed) - set(alive.tolist()))
+        return gone
+
+    async def _read_orders(self, order_ids: List[int]) -> Dict[int, tuple]:
+        """read_order_postings 的结果转成 (fps, order_id, pos, start_line, end_line) 数组"""
+        out = {}
+        for oid, rows in (await read_order_postings(self.router, order_ids)).items():
+            fps, pos, start_line, end_line = zip(*rows) if rows else ((), (), (), ())
+            out[oid] = (
+                as_uint64(fps),
+                np.full(len(rows), oid, dtype=np.int32),
+                *[np.asarray(c, dtype=np.int32) for c in (pos, start_line, end_line)],
+            )
+        return out
+
+    async def _refresh_overlay(self) -> None:
+        t0 = time.perf_counter()
+        changed, self._since = await scan_changed_orders(self._since, self._seen)
+        if changed:
+            self._changed.update(await self._read_orders(changed))
+            self._deleted.difference_update(changed)
+            self._dirty_base.update(self._in_base(changed))
+        gone = await self._scan_deleted()
+        for oid in gone:
+            self._changed.pop(oid, None)
+        self._deleted.update(gone)
+        self._dirty_base.update(self._in_base(gone))
+        if changed or gone:
+            self._rebuild_overlay()
+            print(
+                f"本地倒排索引覆盖层: 读取 {len(changed)} 个订单, 删除 {len(gone)} 个, "
+                f"共 {len(self._changed)} 个订单 / {self.overlay.n_postings} postings, "
+                f"耗时 {time.perf_counter() - t0:.2f}s"
+            )
+
+    def _rebuild_overlay(self) -> None:
+        if self._changed:
+            self.overlay = PostingArrays.from_postings(*[np.concatenate(c) for c in zip(*self._changed.values())])
+        else:
+            self.overlay = PostingArrays.empty()
+        self.dirty = np.asarray(sorted(set(self._changed) | self._deleted), dtype=np.int64)
+
+    def _in_base(self, order_ids) -> List[int]:
+        ids = np.asarray(list(order_ids), dtype=np.int64)
+        return ids[np.isin(ids, self.index.orders)].tolist()
+
+    def _hits(self, fps: List[int]):
+        """[(owner, rows, source)]：快照（去掉被屏蔽的订单）与覆盖层中 fps 的 postings"""
+        q = as_uint64(fps)
+        owner, rows = self.index.lookup(q)
+        if len(self.dirty) and len(rows):
+            keep = ~np.isin(self.index.order_id[rows], self.dirty)
+            owner, rows = owner[keep], rows[keep]
+        return [(owner, rows, self.index), (*self.overlay.lookup(q), self.overlay)]
+
+    async def recall_shard(self, shard: int, fps: List[int]) -> Dict[int, Dict[int, int]]:
+        t0 = time.perf_counter()
+        shard_summaries = {fp: {} for fp in fps}
+        n_pairs = 0
+        for owner, rows, src in self._hits(fps):
+            order_ids = src.order_id[rows]
+            starts, counts = _runs(owner, order_ids)
+            for o, oid, c in zip(owner[starts].tolist(), order_ids[starts].tolist(), counts.tolist()):
+                shard_summaries[fps[o]][oid] = c
+            n_pairs += len(starts)
+        current_trace().shard_query("recall", shard, time.perf_counter() - t0, n_pairs)
+        return shard_summaries
+
+    async def recall_orders(self, shard: int, fps: List[int]) -> Dict[int, int]:
+        return order_totals(await self.recall_shard(shard, fps))
+
+    async def fetch_postings(self, jobs: Sequence[Job]) -> List[Dict[int, PostingList]]:
+        """每个分片对所有 job 的指纹并集查一次，只保留候选订单的 postings，再按 job 分回去"""
+        shards = job_shards(jobs)
+        wanted = np.asarray(sorted({oid for oids, _ in jobs for oid in oids}), dtype=np.int64)
+        by_shard = {}
+        for shard in shards:
+            t0 = time.perf_counter()
+            fps = list(dict.fromkeys(fp for oids, fps_by_shard in jobs if oids for fp in fps_by_shard.get(shard, ())))
+            positions = defaultdict(lambda: defaultdict(list))  # fp -> order_id -> [(pos, start_line, end_line)]
+            n_rows = 0
+            for owner, rows, src in self._hits(fps):
+                keep = np.isin(src.order_id[rows], wanted)
+                owner, rows = owner[keep], rows[keep]
+                n_rows += len(rows)
+                for o, oid, p, s, e in zip(
+                    owner.tolist(), src.order_id[rows].tolist(), src.pos[rows].tolist(),
+                    src.start_line[rows].tolist(), src.end_line[rows].tolist(),
+                ):
+                    positions[fps[o]][oid].append((p, s, e))
+            by_shard[shard] = positions
+            current_trace().shard_query("rerank", shard, time.perf_counter() - t0, n_rows)
+
+        results = []
+        for oids, fps_by_shard in jobs:
+            postings_by_order = defaultdict(PostingList)
+            if oids:
+                oid_set = set(oids)
+                for shard, shard_fps in fps_by_shard.items():
+                    positions = by_shard[shard]
+                    for fp in dict.fromkeys(shard_fps):
+                        for oid, entries in positions.get(fp, {}).items():
+                            if oid in oid_set:
+                                postings = postings_by_order[oid]
+                                for p, s, e in entries:
+                                    postings.append(fp, p, s, e)
+            results.append(postings_by_order)
+        return results
+
+BACKENDS = {"rows": RowPostingBackend, "blocks": BlockPostingBackend, "mmap": MmapPostingBackend}
+
+def make_backend(name: str, router=default_router):
+    if name not in BACKENDS:
+        raise ValueError(f"unknown POSTING_BACKEND {name!r}, expected one of {', '.join(BACKENDS)}")
+    return BACKENDS[name](router)
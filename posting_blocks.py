@@ -0,0 +1,171 @@
+# posting_blocks.py
+"""
+Compressed posting storage: one blob per fingerprint instead of one row per
+posting, and the line numbers in a separate per-order map.
+
+Block (code_posting_blocks_XX.data), the postings of one fp sorted by
+(order_id, pos), as unsigned LEB128 varints:
+
+    n_orders
+    order_id deltas   x n_orders   (first one absolute)
+    posting counts    x n_orders
+    pos deltas        x sum(counts) (per order; first one absolute)
+
+Recall only needs the first 1 + 2 * n_orders values (order ids and hit
+counts); rerank decodes the positions of the candidate orders.
+
+Line map (code_order_lines.data), every fingerprint position of one order:
+
+    n
+    pos deltas               x n
+    zigzag start_line deltas x n
+    end_line - start_line    x n
+
+With numpy a blob is decoded in a handful of array operations; small blobs
+(most fingerprints hit a few orders) and installs without numpy use a plain
+Python loop, which returns lists instead of arrays (same values).
+"""
+from typing import List, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # numpy 是可选依赖，缺失时退回纯 Python 实现
+    np = None
+
+NUMPY_MIN_BYTES = 128  # 更小的 blob 用纯 Python 解码更快（numpy 每次调用有固定开销）
+
+def _use_numpy(data: bytes) -> bool:
+    return np is not None and len(data) >= NUMPY_MIN_BYTES
+
+def encode_varints(values) -> bytes:
+    out = bytearray()
+    for v in values:
+        v = int(v)
+        while v >= 0x80:
+            out.append((v & 0x7F) | 0x80)
+            v >>= 7
+        out.append(v)
+    return bytes(out)
+
+def _decode_varints_python(data: bytes, limit: int = -1) -> List[int]:
+    out = []
+    v = shift = 0
+    for byte in data:
+        v |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            out.append(v)
+            if len(out) == limit:
+                break
+            v = shift = 0
+        else:
+            shift += 7
+    return out
+
+def decode_varints(data: bytes):
+    """All varints of `data`, as an int64 array with numpy (for blobs of NUMPY_MIN_BYTES and up), else a list."""
+    if not _use_numpy(data):
+        return _decode_varints_python(data)
+    b = np.frombuffer(data, dtype=np.uint8)
+    if not len(b):
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(b < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    shifts = (np.arange(len(b)) - np.repeat(starts, ends - starts + 1)) * 7
+    return np.add.reduceat((b & 0x7F).astype(np.int64) << shifts, starts)
+
+def _zigzag(v: int) -> int:
+    return v * 2 if v >= 0 else -v * 2 - 1
+
+def _unzigzag(v):
+    return (v >> 1) ^ -(v & 1)
+
+def encode_block(postings: Sequence[Tuple[int, int]]) -> bytes:
+    """(order_id, pos) pairs of one fingerprint -> block."""
+    postings = sorted(postings)
+    order_ids, counts, pos_deltas = [], [], []
+    prev_oid = prev_pos = 0
+    for oid, pos in postings:
+        if not order_ids or oid != order_ids[-1]:
+            order_ids.append(oid)
+            counts.append(0)
+            prev_pos = 0
+        counts[-1] += 1
+        pos_deltas.append(pos - prev_pos)
+        prev_pos = pos
+    oid_deltas = []
+    for oid in order_ids:
+        oid_deltas.append(oid - prev_oid)
+        prev_oid = oid
+    return encode_varints([len(order_ids)] + oid_deltas + counts + pos_deltas)
+
+def decode_block_summary(data: bytes) -> Tuple[List[int], List[int]]:
+    """(order_ids, counts) of a block, without the positions."""
+    if not _use_numpy(data):
+        n = _decode_varints_python(data, 1)[0]
+        vals = _decode_varints_python(data, 1 + 2 * n)
+        order_ids, acc = [], 0
+        for d in vals[1:1 + n]:
+            acc += d
+            order_ids.append(acc)
+        return order_ids, vals[1 + n:1 + 2 * n]
+    vals = decode_varints(data)
+    n = int(vals[0])
+    return np.cumsum(vals[1:1 + n]).tolist(), vals[1 + n:1 + 2 * n].tolist()
+
+def decode_block(data: bytes):
+    """(order_ids, counts, pos) of a block; pos is flat, grouped by order in order_ids order."""
+    vals = decode_varints(data)
+    n = int(vals[0])
+    if isinstance(vals, list):
+        order_ids, acc = [], 0
+        for d in vals[1:1 + n]:
+            acc += d
+            order_ids.append(acc)
+        counts = vals[1 + n:1 + 2 * n]
+        pos, i = [], 1 + 2 * n
+        for c in counts:
+            acc = 0
+            for d in vals[i:i + c]:
+                acc += d
+                pos.append(acc)
+            i += c
+        return order_ids, counts, pos
+    order_ids = np.cumsum(vals[1:1 + n])
+    counts = vals[1 + n:1 + 2 * n]
+    total = np.cumsum(vals[1 + 2 * n:])
+    # 每个订单内部的前缀和：总前缀和减去该订单之前的部分
+    group_start = np.cumsum(counts) - counts
+    base = np.where(group_start > 0, total[np.maximum(group_start - 1, 0)], 0)
+    return order_ids, counts, total - np.repeat(base, counts)
+
+def encode_line_map(rows: Sequence[Tuple[int, int, int]]) -> bytes:
+    """(pos, start_line, end_line) of one order's fingerprints -> line map."""
+    rows = sorted(set(rows))
+    pos_deltas, start_deltas, spans = [], [], []
+    prev_pos = prev_start = 0
+    for pos, start_line, end_line in rows:
+        pos_deltas.append(pos - prev_pos)
+        start_deltas.append(_zigzag(start_line - prev_start))
+        spans.append(end_line - start_line)
+        prev_pos, prev_start = pos, start_line
+    return encode_varints([len(rows)] + pos_deltas + start_deltas + spans)
+
+def decode_line_map(data: bytes):
+    """(pos, start_line, end_line), sorted by pos."""
+    vals = decode_varints(data)
+    n = int(vals[0])
+    if isinstance(vals, list):
+        pos, start, end = [], [], []
+        p = s = 0
+        for i in range(n):
+            p += vals[1 + i]
+            s += _unzigzag(vals[1 + n + i])
+            pos.append(p)
+            start.append(s)
+            end.append(s + vals[1 + 2 * n + i])
+        return pos, start, end
+    pos = np.cumsum(vals[1:1 + n])
+    start = np.cumsum(_unzigzag(vals[1 + n:1 + 2 * n]))
+    return pos, start, start + vals[1 + 2 * n:1 + 3 * n]
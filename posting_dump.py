@@ -0,0 +1,491 @@
+# posting_dump.py
+"""
+查重索引的二进制导出 / 导入：换服务器或恢复时不必重新分词、重建。
+
+    python posting_dump.py export --out /backup/dump-20261017 [--tables postings,fingerprints,doc_stats,stop]
+    python posting_dump.py verify --src /backup/dump-20261017
+    python posting_dump.py import --src /backup/dump-20261017 [--concurrency 4] [--truncate]
+
+导出内容（--tables 选择，默认全部）：
+  postings      全部 code_postings_XX 分片表
+  fingerprints  code_fingerprints（SimHash 分块指纹，part_1..part_4 导入时由指纹重新计算）
+  doc_stats     code_doc_stats（指纹数、token 数、分片清单）
+  stop          stop_fingerprints
+
+目录格式：manifest.json 记录参数（K、WINDOW、FP_HASH_SCHEME、分片数）、每张表的行数，以及每个列文件的
+字节数和 sha256；<表名>/<列名>.col 是按列存储的数据，由若干块组成，每块为
+  uint32 行数 | uint32 压缩后字节数 | zlib(小端定长数组)
+各列的块一一对应（同一批行）。按主键排序的指纹列、id 列存相邻差值，压缩得更小。
+
+各表分别在自己的事务里读取，服务和增量索引照常运行，所以导出期间变化的订单在各表里可能新旧不一。
+manifest.json 的 index_start / index_end 记录导出开始和结束时的索引版本号与 code_doc_stats.updated_at
+最大值：两次版本号相同说明导出期间没有写入；不同时按 REBUILD_README.md 3.3 节把 updated_at 不早于
+index_start 的订单在新服务器上重新索引，并删除导出期间被删除的订单。
+
+导入前先校验全部文件的 sha256，以及 K / WINDOW / FP_HASH_SCHEME 与当前配置一致（--force 跳过参数检查）。
+目标表必须为空（--truncate 先清空）。MySQL 上先去掉二级索引（分片表的 idx_order_pos、code_fingerprints 的
+part_1..part_4 等，外键用到的索引保留），会话内关闭 unique_checks / foreign_key_checks，按主键顺序用
+--insert-rows 行一条的多行 INSERT 写入，每块一个事务，--concurrency 张表并行，全部写完后一次 ALTER TABLE
+把索引加回去。分片数与导出时不同也可以导入（按当前 POSTING_SHARDS 重新路由）。恢复到新服务器时先导入
+订单表（code_fingerprints / code_doc_stats 引用 code_orders）并执行 posting_schema.sql。导入完成后记录分片布局
+并把索引版本号 +1。
+"""
+import argparse
+import asyncio
+import datetime
+import hashlib
+import json
+import pathlib
+import struct
+import sys
+import time
+import zlib
+from array import array
+from collections import defaultdict
+from itertools import accumulate
+from typing import Dict, List, Optional, Sequence
+
+from tortoise import Tortoise, connections, run_async
+from tortoise.functions import Max
+from tortoise.transactions import in_transaction
+
+from config import settings
+from fingerprint_utils import SimHashEngine
+from index_generation import bump_generation, read_generation
+from models import CodeDocStat
+from posting_writer import chunked
+from shard_router import ShardRouter, check_layout, record_layout, router
+from winnowing_utils import K, MASK64, WINDOW, to_int64, to_uint64
+
+FORMAT = 1
+MANIFEST = "manifest.json"
+BATCH_ROWS = 50000
+INSERT_ROWS = 2000
+ZLIB_LEVEL = 6
+CHUNK_HEADER = struct.Struct("<II")
+TABLE_GROUPS = ("postings", "fingerprints", "doc_stats", "stop")
+# 外键依赖的索引不能删，导入时保留
+KEEP_INDEX_COLUMNS = {"code_fingerprints": {"order_id"}}
+
+engine = SimHashEngine()
+
+class Column:
+    """一列：数组类型码（Q 无符号 64 位，q 有符号 64 位，i 32 位），是否存相邻差值"""
+
+    def __init__(self, name: str, typecode: str, delta: bool = False):
+        self.name = name
+        self.typecode = typecode
+        self.delta = delta
+
+    def encode(self, values: List[int]) -> bytes:
+        if self.delta and values:
+            values = [values[0]] + [b - a for a, b in zip(values, values[1:])]
+            if self.typecode == "Q":
+                values = [v & MASK64 for v in values]
+        arr = array(self.typecode, values)
+        if sys.byteorder == "big":
+            arr.byteswap()
+        return arr.tobytes()
+
+    def decode(self, data: bytes) -> List[int]:
+        arr = array(self.typecode)
+        arr.frombytes(data)
+        if sys.byteorder == "big":
+            arr.byteswap()
+        values = arr.tolist()
+        if self.delta:
+            values = list(accumulate(values))
+            if self.typecode == "Q":
+                values = [v & MASK64 for v in values]
+        return values
+
+class TableSpec:
+    """
+    key 是导出时 keyset 分页的主键列；read / write 把数据库中的值与文件中的值互相转换
+    （指纹统一存 uint64；写回时按各写入方的习惯：分片表与 posting_writer 一样写 int64，
+    stop_fingerprints 与 build_stop_fingerprints.py 一样写 uint64）。
+    """
+
+    def __init__(self, group: str, columns: Sequence[Column], key: Sequence[str], read=None, write=None):
+        self.group = group
+        self.columns = list(columns)
+        self.key = list(key)
+        self.read = read or {}
+        self.write = write or {}
+
+    @property
+    def names(self) -> List[str]:
+        return [c.name for c in self.columns]
+
+POSTINGS = TableSpec(
+    "postings",
+    [Column("fp", "Q", delta=True), Column("order_id", "i"), Column("pos", "i"),
+     Column("start_line", "i"), Column("end_line", "i")],
+    key=["fp", "order_id", "pos"],
+    read={"fp": to_uint64},
+    write={"fp": to_int64},
+)
+FINGERPRINTS = TableSpec(
+    "fingerprints",
+    [Column("id", "i", delta=True), Column("order_id", "i"), Column("fingerprint", "Q"),
+     Column("start_line", "i"), Column("end_line", "i")],
+    key=["id"],
+    read={"fingerprint": lambda s: int(s, 2)},
+    write={"fingerprint": engine.to_binary},
+)
+DOC_STATS = TableSpec(
+    "doc_stats",
+    [Column("order_id", "i", delta=True), Column("fp_count", "i"), Column("token_count", "i"),
+     Column("shard_mask", "q")],
+    key=["order_id"],
+    read={"shard_mask": to_int64},
+)
+STOP = TableSpec(
+    "stop",
+    [Column("fp", "Q", delta=True), Column("df", "i")],
+    key=["fp"],
+    read={"fp": to_uint64},
+    write={"fp": to_uint64},
+)
+
+def dump_tables(groups: Sequence[str], posting_router: ShardRouter) -> Dict[str, TableSpec]:
+    tables = {}
+    for group in groups:
+        if group == "postings":
+            tables.update({tbl: POSTINGS for tbl in posting_router.tables()})
+        elif group == "fingerprints":
+            tables["code_fingerprints"] = FINGERPRINTS
+        elif group == "doc_stats":
+            tables["code_doc_stats"] = DOC_STATS
+        elif group == "stop":
+            tables["stop_fingerprints"] = STOP
+    return tables
+
+async def init():
+    await Tortoise.init(db_url=settings.DATABASE_URL, modules={"model": ["models"]})
+    await Tortoise.generate_schemas(safe=True)
+
+def dialect() -> str:
+    return connections.get("default").capabilities.dialect
+
+def parse_groups(value: str) -> List[str]:
+    groups = [g.strip() for g in value.split(",") if g.strip()]
+    unknown = set(groups) - set(TABLE_GROUPS)
+    if unknown:
+        raise SystemExit(f"未知的 --tables: {', '.join(sorted(unknown))}（可选 {', '.join(TABLE_GROUPS)}）")
+    return groups
+
+def file_sha256(path: pathlib.Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+# ---- 导出 ----
+
+class ColumnWriter:
+    def __init__(self, path: pathlib.Path, column: Column):
+        self.column = column
+        self.file = open(path, "wb")
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+
+    def write_chunk(self, values: List[int]) -> None:
+        data = zlib.compress(self.column.encode(values), ZLIB_LEVEL)
+        for part in (CHUNK_HEADER.pack(len(values), len(data)), data):
+            self.file.write(part)
+            self.sha256.update(part)
+            self.bytes += len(part)
+
+    def close(self) -> dict:
+        self.file.close()
+        return {"typecode": self.column.typecode, "delta": self.column.delta,
+                "bytes": self.bytes, "sha256": self.sha256.hexdigest()}
+
+async def export_table(table: str, spec: TableSpec, out: pathlib.Path, batch_rows: int) -> dict:
+    (out / table).mkdir()
+    writers = [ColumnWriter(out / table / f"{c.name}.col", c) for c in spec.columns]
+    key = ", ".join(spec.key)
+    rows_total = 0
+    last: Optional[list] = None
+    while True:
+        where, params = "", []
+        if last is not None:
+            ph = ", ".join(["%s"] * len(spec.key))
+            where, params = (f"WHERE ({key}) > ({ph}) " if len(spec.key) > 1 else f"WHERE {key} > %s "), last
+        async with in_transaction() as conn:
+            rows = await conn.execute_query_dict(
+                f"SELECT {', '.join(spec.names)} FROM {table} {where}ORDER BY {key} LIMIT {int(batch_rows)}", params
+            )
+        if rows:
+            for w in writers:
+                conv = spec.read.get(w.column.name, int)
+                w.write_chunk([conv(r[w.column.name]) for r in rows])
+            # 分页条件用数据库里的原值（MySQL 的无符号列读出来就是无符号）
+            last = [rows[-1][k] for k in spec.key]
+            rows_total += len(rows)
+        if len(rows) < batch_rows:
+            break
+    return {"group": spec.group, "rows": rows_total, "columns": {w.column.name: w.close() for w in writers}}
+
+async def index_position() -> dict:
+    """当前的索引版本号和 code_doc_stats.updated_at 最大值"""
+    watermark = await CodeDocStat.all().annotate(m=Max("updated_at")).first().values_list("m", flat=True)
+    return {
+        "generation": await read_generation(),
+        "doc_stats_updated_at": watermark.isoformat() if watermark else None,
+    }
+
+async def export(out: pathlib.Path, groups: Sequence[str], batch_rows: int, concurrency: int) -> dict:
+    out.mkdir(parents=True, exist_ok=False)
+    tables = dump_tables(groups, router)
+    sem = asyncio.Semaphore(concurrency)
+    t0 = time.time()
+    start = await index_position()
+
+    async def one(table, spec):
+        async with sem:
+            info = await export_table(table, spec, out, batch_rows)
+        size = sum(c["bytes"] for c in info["columns"].values())
+        print(f"{table}: {info['rows']} rows, {size} bytes ({time.time() - t0:.1f}s)")
+        return table, info
+
+    manifest = {
+        "format": FORMAT,
+        "k": K,
+        "window": WINDOW,
+        "hash_scheme": settings.FP_HASH_SCHEME,
+        "posting_shards": router.count,
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "index_start": start,
+        "tables": dict(await asyncio.gather(*[one(t, s) for t, s in tables.items()])),
+    }
+    manifest["index_end"] = end = await index_position()
+    with open(out / MANIFEST, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    rows = sum(t["rows"] for t in manifest["tables"].values())
+    size = sum(c["bytes"] for t in manifest["tables"].values() for c in t["columns"].values())
+    print(f"export done in {time.time() - t0:.1f}s: {len(tables)} tables, {rows} rows, {size} bytes -> {out}")
+    if end["generation"] != start["generation"]:
+        since = start["doc_stats_updated_at"]
+        print(
+            f"index changed during the export (generation {start['generation']} -> {end['generation']}): "
+            f"after importing, re-index the orders of\n"
+            f"  SELECT order_id FROM code_doc_stats" + (f" WHERE updated_at >= '{since}'" if since else "") + "\n"
+            f"and purge the orders deleted meanwhile (see REBUILD_README.md 3.3)"
+        )
+    return manifest
+
+# ---- 校验 / 导入 ----
+
+def read_manifest(src: pathlib.Path) -> dict:
+    with open(src / MANIFEST, encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format") != FORMAT:
+        raise SystemExit(f"{src}: 不支持的导出格式 {manifest.get('format')!r}")
+    return manifest
+
+def verify(src: pathlib.Path, manifest: dict) -> None:
+    bad = []
+    for table, info in manifest["tables"].items():
+        for name, col in info["columns"].items():
+            path = src / table / f"{name}.col"
+            if not path.exists() or path.stat().st_size != col["bytes"] or file_sha256(path) != col["sha256"]:
+                bad.append(str(path))
+    if bad:
+        raise SystemExit("校验失败（文件缺失、大小或 sha256 不符）:\n  " + "\n  ".join(bad))
+    print(f"verify ok: {sum(len(t['columns']) for t in manifest['tables'].values())} files")
+
+def check_params(manifest: dict, force: bool) -> None:
+    current = {"k": K, "window": WINDOW, "hash_scheme": settings.FP_HASH_SCHEME}
+    diff = {k: (manifest.get(k), v) for k, v in current.items() if manifest.get(k) != v}
+    if diff and not force:
+        raise SystemExit(
+            "导出时的指纹参数与当前不同（导出值, 当前值）: "
+            + ", ".join(f"{k}={a!r}/{b!r}" for k, (a, b) in diff.items())
+            + "；导入后查重结果会不正确，确认无误可加 --force"
+        )
+
+def read_chunks(path: pathlib.Path, column: Column):
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(CHUNK_HEADER.size)
+            if not header:
+                return
+            n, size = CHUNK_HEADER.unpack(header)
+            values = column.decode(zlib.decompress(f.read(size)))
+            if len(values) != n:
+                raise ValueError(f"{path}: chunk has {len(values)} values, header says {n}")
+            yield values
+
+def table_chunks(src: pathlib.Path, table: str, spec: TableSpec, info: dict):
+    """按块产出 {列名: 值列表}（已转换成写回数据库的值）"""
+    columns = [Column(c.name, info["columns"][c.name]["typecode"], info["columns"][c.name]["delta"]) for c in spec.columns]
+    readers = [read_chunks(src / table / f"{c.name}.col", c) for c in columns]
+    for parts in zip(*readers):
+        yield {c.name: ([spec.write[c.name](v) for v in vals] if c.name in spec.write else vals)
+               for c, vals in zip(columns, parts)}
+
+async def secondary_indexes(table: str) -> List[tuple]:
+    """(索引名, 列, 是否唯一)：MySQL 上除主键和外键所需索引以外的二级索引"""
+    async with in_transaction() as conn:
+        rows = await conn.execute_query_dict(f"SHOW INDEX FROM {table}")
+    cols, unique = defaultdict(list), {}
+    for r in rows:
+        if r["Key_name"] == "PRIMARY":
+            continue
+        cols[r["Key_name"]].append((int(r["Seq_in_index"]), r["Column_name"]))
+        unique[r["Key_name"]] = not int(r["Non_unique"])
+    keep = KEEP_INDEX_COLUMNS.get(table, set())
+    return [
+        (name, [c for _, c in sorted(parts)], unique[name])
+        for name, parts in cols.items()
+        if not keep & {c for _, c in parts}
+    ]
+
+def add_index_sql(table: str, indexes: Sequence[tuple]) -> str:
+    return f"ALTER TABLE {table} " + ", ".join(
+        f"ADD {'UNIQUE ' if uniq else ''}INDEX {name} ({', '.join(cols)})" for name, cols, uniq in indexes
+    )
+
+async def prepare_targets(tables: Sequence[str], truncate: bool) -> None:
+    for table in tables:
+        async with in_transaction() as conn:
+            if truncate:
+                await conn.execute_query(f"TRUNCATE TABLE {table}" if dialect() == "mysql" else f"DELETE FROM {table}")
+            elif await conn.execute_query_dict(f"SELECT 1 FROM {table} LIMIT 1"):
+                raise SystemExit(f"{table} 不为空，加 --truncate 先清空")
+
+async def insert_rows(conn, table: str, names: Sequence[str], rows: List[tuple], insert_rows: int) -> None:
+    for part in chunked(rows, insert_rows):
+        values = [v for row in part for v in row]
+        ph = "(" + ",".join(["%s"] * len(names)) + ")"
+        await conn.execute_query(f"INSERT INTO {table} ({', '.join(names)}) VALUES " + ",".join([ph] * len(part)), values)
+
+async def import_table(src: pathlib.Path, table: str, spec: TableSpec, info: dict, insert_rows_n: int) -> int:
+    """逐块写入，一块一个事务；分片表的行按当前布局路由到目标分片"""
+    mysql = dialect() == "mysql"
+    written = 0
+    for cols in table_chunks(src, table, spec, info):
+        if spec is DOC_STATS:
+            # updated_at 由 ORM 填当前时间
+            await CodeDocStat.bulk_create(
+                [CodeDocStat(order_id=oid, fp_count=c, token_count=t, shard_mask=m)
+                 for oid, c, t, m in zip(cols["order_id"], cols["fp_count"], cols["token_count"], cols["shard_mask"])],
+                batch_size=insert_rows_n,
+            )
+            written += len(cols["order_id"])
+            continue
+        names = spec.names
+        rows = list(zip(*[cols[n] for n in names]))
+        if spec is FINGERPRINTS:
+            names = names + ["part_1", "part_2", "part_3", "part_4"]
+            rows = [row + tuple(engine.split_fingerprint_to_parts(row[2])) for row in rows]
+        if spec is POSTINGS:
+            by_table = defaultdict(list)
+            for row in rows:
+                by_table[router.table(router.shard_of(row[0]))].append(row)
+        else:
+            by_table = {table: rows}
+        async with in_transaction() as conn:
+            if mysql:
+                await conn.execute_query("SET SESSION unique_checks = 0, foreign_key_checks = 0")
+            for target, target_rows in by_table.items():
+                await insert_rows(conn, target, names, target_rows, insert_rows_n)
+            if mysql:
+                await conn.execute_query("SET SESSION unique_checks = 1, foreign_key_checks = 1")
+        written += len(rows)
+    return written
+
+async def import_dump(src: pathlib.Path, truncate: bool, force: bool, concurrency: int, insert_rows_n: int,
+                      defer_indexes: bool) -> None:
+    manifest = read_manifest(src)
+    check_params(manifest, force)
+    verify(src, manifest)
+    specs = {"postings": POSTINGS, "fingerprints": FINGERPRINTS, "doc_stats": DOC_STATS, "stop": STOP}
+    groups = list(dict.fromkeys(info["group"] for info in manifest["tables"].values()))
+    targets = list(dump_tables(groups, router))
+    if manifest["posting_shards"] != router.count:
+        print(f"导出时 {manifest['posting_shards']} 个分片，按当前 POSTING_SHARDS={router.count} 重新路由")
+    await prepare_targets(targets, truncate)
+
+    deferred = {}
+    if defer_indexes and dialect() == "mysql":
+        for table in targets:
+            indexes = await secondary_indexes(table)
+            if indexes:
+                deferred[table] = indexes
+        if deferred:
+            print("导入期间去掉的二级索引；如果导入中断，执行以下语句加回：")
+            for table, indexes in deferred.items():
+                print(f"  {add_index_sql(table, indexes)};")
+            async with in_transaction() as conn:
+                for table, indexes in deferred.items():
+                    await conn.execute_query(
+                        f"ALTER TABLE {table} " + ", ".join(f"DROP INDEX {name}" for name, _, _ in indexes)
+                    )
+
+    t0 = time.time()
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(table, info):
+        async with sem:
+            n = await import_table(src, table, specs[info["group"]], info, insert_rows_n)
+        if n != info["rows"]:
+            raise RuntimeError(f"{table}: wrote {n} rows, manifest says {info['rows']}")
+        print(f"{table}: {n} rows ({time.time() - t0:.1f}s)")
+        return n
+
+    total = sum(await asyncio.gather(*[one(t, info) for t, info in manifest["tables"].items()]))
+
+    for table, indexes in deferred.items():
+        t1 = time.time()
+        async with in_transaction() as conn:
+            await conn.execute_query(add_index_sql(table, indexes))
+        print(f"{table}: indexes restored ({time.time() - t1:.1f}s)")
+
+    async with in_transaction() as conn:
+        if "postings" in groups:
+            await record_layout(router.count, conn=conn)
+        generation = await bump_generation(conn=conn)
+    print(f"import done in {time.time() - t0:.1f}s: {total} rows, generation {generation}")
+
+async def main(args):
+    await init()
+    try:
+        if args.command == "export":
+            await check_layout()
+            await export(pathlib.Path(args.out), parse_groups(args.tables), args.batch_rows, args.concurrency)
+        else:
+            await import_dump(
+                pathlib.Path(args.src), args.truncate, args.force, args.concurrency, args.insert_rows,
+                not args.no_defer_indexes,
+            )
+    finally:
+        await Tortoise.close_connections()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="查重索引的二进制导出 / 导入")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("export")
+    p.add_argument("--out", required=True, help="导出目录（不能已存在）")
+    p.add_argument("--tables", default=",".join(TABLE_GROUPS), help=f"逗号分隔，可选 {', '.join(TABLE_GROUPS)}")
+    p.add_argument("--batch-rows", type=int, default=BATCH_ROWS, help="每批读取的行数（也是文件中每块的行数）")
+    p.add_argument("--concurrency", type=int, default=4, help="同时导出的表数")
+    p = sub.add_parser("verify")
+    p.add_argument("--src", required=True)
+    p = sub.add_parser("import")
+    p.add_argument("--src", required=True)
+    p.add_argument("--truncate", action="store_true", help="先清空目标表")
+    p.add_argument("--force", action="store_true", help="K / WINDOW / FP_HASH_SCHEME 与当前不同也导入")
+    p.add_argument("--concurrency", type=int, default=4, help="同时导入的表数")
+    p.add_argument("--insert-rows", type=int, default=INSERT_ROWS, help="每条 INSERT 的行数")
+    p.add_argument("--no-defer-indexes", action="store_true", help="不在导入期间去掉二级索引")
+    args = parser.parse_args()
+
+    if args.command == "verify":
+        src = pathlib.Path(args.src)
+        verify(src, read_manifest(src))
+    else:
+        run_async(main(args))
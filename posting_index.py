@@ -0,0 +1,215 @@
+# posting_index.py
+"""
+Immutable on-disk posting index behind POSTING_BACKEND=mmap: written by
+export_posting_index.py from the shard tables, memory-mapped by the service.
+
+A directory of flat little-endian arrays plus meta.json:
+
+    fps.u64         distinct fingerprints as uint64, one section per shard
+                    (fp & (shards - 1)), sorted within the section
+    offsets.u64     len(fps) + 1 entries: the postings of fps[i] are rows
+                    offsets[i] .. offsets[i + 1] - 1 of the arrays below
+    order_id.i32    \
+    pos.i32          | one row per posting, sorted by (order_id, pos)
+    start_line.i32   | within a fingerprint
+    end_line.i32    /
+    orders.i32      sorted ids of the orders whose code_doc_stats row was
+                    older than meta["watermark"] when the export started
+                    (the overlay watches them for deletions)
+    meta.json       format, shards, shard_offsets (shards + 1 entries into
+                    fps), counts, watermark, generation, hash_scheme, k,
+                    window, created_at
+
+A lookup is a searchsorted per section; the posting ranges of the hits are
+gathered with a few array operations, nothing is copied out of the mapping
+except the postings themselves. Requires numpy.
+"""
+import datetime
+import json
+import os
+import pathlib
+import shutil
+from typing import List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # 只有 mmap 后端和导出脚本需要 numpy
+    np = None
+
+FORMAT = 1
+META = "meta.json"
+FP_FILE = "fps.u64"
+OFFSETS_FILE = "offsets.u64"
+ORDERS_FILE = "orders.i32"
+COLUMNS = ("order_id", "pos", "start_line", "end_line")
+FP_DTYPE = "<u8"
+COL_DTYPE = "<i4"
+
+def require_numpy() -> None:
+    if np is None:
+        raise RuntimeError("POSTING_BACKEND=mmap / export_posting_index.py 需要安装 numpy")
+
+def as_uint64(fps: Sequence[int]):
+    """Fingerprints (signed int64 as fingerprinted, or unsigned as MySQL returns them) -> uint64 array."""
+    return np.fromiter((fp & 0xFFFFFFFFFFFFFFFF for fp in fps), dtype=np.uint64, count=len(fps))
+
+class PostingArrays:
+    """A sorted fingerprint array and the postings it points into (one section, or the overlay)."""
+
+    def __init__(self, fps, offsets, order_id, pos, start_line, end_line):
+        self.fps = fps
+        self.offsets = offsets
+        self.order_id = order_id
+        self.pos = pos
+        self.start_line = start_line
+        self.end_line = end_line
+
+    @classmethod
+    def empty(cls) -> "PostingArrays":
+        cols = [np.zeros(0, dtype=np.int32) for _ in COLUMNS]
+        return cls(np.zeros(0, dtype=np.uint64), np.zeros(1, dtype=np.uint64), *cols)
+
+    @classmethod
+    def from_postings(cls, fps, order_id, pos, start_line, end_line) -> "PostingArrays":
+        """Unsorted postings (fps as uint64) -> sorted by (fp, order_id, pos), offsets from 0."""
+        order = np.lexsort((pos, order_id, fps))
+        fps = fps[order]
+        cols = [np.asarray(c, dtype=np.int32)[order] for c in (order_id, pos, start_line, end_line)]
+        starts = np.flatnonzero(np.r_[True, fps[1:] != fps[:-1]]) if len(fps) else np.zeros(0, dtype=np.int64)
+        offsets = np.append(starts, len(fps)).astype(np.uint64)
+        return cls(fps[starts], offsets, *cols)
+
+    @property
+    def n_postings(self) -> int:
+        return len(self.order_id)
+
+    def lookup(self, q) -> Tuple["np.ndarray", "np.ndarray"]:
+        """
+        (owner, rows) for every posting of the fingerprints in q (uint64):
+        q[owner[i]] is the fingerprint of posting row rows[i]. Rows of one
+        fingerprint are contiguous and in (order_id, pos) order.
+        """
+        n = len(self.fps)
+        if not n or not len(q):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        idx = np.minimum(np.searchsorted(self.fps, q), n - 1)
+        hit = np.flatnonzero(self.fps[idx] == q)
+        starts = self.offsets[idx[hit]].astype(np.int64)
+        lens = self.offsets[idx[hit] + 1].astype(np.int64) - starts
+        owner = np.repeat(hit, lens)
+        # 每段 [start, start + len) 展开成行号
+        rows = np.arange(int(lens.sum()), dtype=np.int64) + np.repeat(starts - (np.cumsum(lens) - lens), lens)
+        return owner, rows
+
+def _map(path: pathlib.Path, dtype, count: int):
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    arr = np.memmap(path, dtype=dtype, mode="r")
+    if len(arr) != count:
+        raise ValueError(f"{path}: {len(arr)} entries, meta.json says {count}")
+    return arr
+
+def read_meta(path) -> dict:
+    with open(pathlib.Path(path) / META, encoding="utf-8") as f:
+        return json.load(f)
+
+class PostingIndex:
+    """An exported index directory, memory-mapped read-only."""
+
+    def __init__(self, path):
+        require_numpy()
+        self.path = pathlib.Path(path)
+        self.meta = read_meta(self.path)
+        if self.meta.get("format") != FORMAT:
+            raise ValueError(f"{self.path}: unsupported posting index format {self.meta.get('format')!r}")
+        n_fps, n_postings = self.meta["n_fps"], self.meta["n_postings"]
+        self.shards = int(self.meta["shards"])
+        self.mask = self.shards - 1
+        self.fps = _map(self.path / FP_FILE, FP_DTYPE, n_fps)
+        self.offsets = _map(self.path / OFFSETS_FILE, FP_DTYPE, n_fps + 1)
+        cols = [_map(self.path / f"{c}.i32", COL_DTYPE, n_postings) for c in COLUMNS]
+        self.order_id, self.pos, self.start_line, self.end_line = cols
+        self.orders = _map(self.path / ORDERS_FILE, COL_DTYPE, self.meta["n_orders"])
+        bounds = self.meta["shard_offsets"]
+        self.sections = [
+            PostingArrays(self.fps[lo:hi], self.offsets[lo:hi + 1], *cols) for lo, hi in zip(bounds, bounds[1:])
+        ]
+
+    @property
+    def watermark(self) -> Optional[datetime.datetime]:
+        w = self.meta.get("watermark")
+        return datetime.datetime.fromisoformat(w) if w else None
+
+    def lookup(self, q) -> Tuple["np.ndarray", "np.ndarray"]:
+        """PostingArrays.lookup over all sections; rows index the index-wide posting arrays."""
+        if self.shards == 1:
+            return self.sections[0].lookup(q)
+        section_of = (q & np.uint64(self.mask)).astype(np.int64)
+        owners, rows = [], []
+        for s in np.unique(section_of).tolist():
+            sel = np.flatnonzero(section_of == s)
+            owner, r = self.sections[s].lookup(q[sel])
+            owners.append(sel[owner])
+            rows.append(r)
+        if not owners:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(owners), np.concatenate(rows)
+
+class PostingIndexWriter:
+    """Writes an index directory section by section (shards in ascending order)."""
+
+    def __init__(self, path, shards: int):
+        require_numpy()
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=False)
+        self.shards = shards
+        self.shard_offsets: List[int] = [0]
+        self.n_postings = 0
+        self._files = {name: open(self.path / name, "wb") for name in (FP_FILE, OFFSETS_FILE)}
+        self._files.update({c: open(self.path / f"{c}.i32", "wb") for c in COLUMNS})
+
+    def write_section(self, shard: int, arrays: PostingArrays) -> None:
+        if shard != len(self.shard_offsets) - 1:
+            raise ValueError(f"sections must be written in shard order, expected {len(self.shard_offsets) - 1}")
+        self._files[FP_FILE].write(arrays.fps.astype(FP_DTYPE).tobytes())
+        offsets = arrays.offsets[:-1].astype(np.uint64) + np.uint64(self.n_postings)
+        self._files[OFFSETS_FILE].write(offsets.astype(FP_DTYPE).tobytes())
+        for c in COLUMNS:
+            self._files[c].write(getattr(arrays, c).astype(COL_DTYPE).tobytes())
+        self.shard_offsets.append(self.shard_offsets[-1] + len(arrays.fps))
+        self.n_postings += arrays.n_postings
+
+    def close(self, orders, **meta) -> dict:
+        if len(self.shard_offsets) != self.shards + 1:
+            raise ValueError(f"{len(self.shard_offsets) - 1} of {self.shards} sections written")
+        self._files[OFFSETS_FILE].write(np.array([self.n_postings], dtype=FP_DTYPE).tobytes())
+        for f in self._files.values():
+            f.close()
+        orders = np.unique(np.asarray(orders, dtype=np.int64)).astype(COL_DTYPE)
+        (self.path / ORDERS_FILE).write_bytes(orders.tobytes())
+        meta = {
+            "format": FORMAT,
+            "shards": self.shards,
+            "shard_offsets": self.shard_offsets,
+            "n_fps": self.shard_offsets[-1],
+            "n_postings": self.n_postings,
+            "n_orders": len(orders),
+            "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            **meta,
+        }
+        with open(self.path / META, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        return meta
+
+def publish(tmp_path, path) -> None:
+    """Replace the index at `path` with the finished one at `tmp_path` (the service re-maps it on its next refresh)."""
+    tmp_path, path = pathlib.Path(tmp_path), pathlib.Path(path)
+    old = path.with_name(path.name + ".old")
+    if old.exists():
+        shutil.rmtree(old)
+    if path.exists():
+        os.rename(path, old)
+    os.rename(tmp_path, path)
+    if old.exists():
+        # 已映射的旧文件在服务重新映射之前仍然可读（文件删除后 inode 保留到 munmap）
+        shutil.rmtree(old)
@@ -0,0 +1,163 @@
+# posting_writer.py
+"""
+Buffered writer for the sharded posting tables (layout: shard_router.router).
+
+Orders are added whole: their rows are routed into per-shard buffers and the
+order id is queued for deletion on the shards that may hold its old
+postings. Those shards come from the order's manifest (code_doc_stats.shard_mask)
+plus the shards about to be written; orders without a manifest are deleted
+from every shard. A shard flush runs one transaction:
+
+    DELETE FROM code_postings_XX WHERE order_id IN (...pending orders...)
+    INSERT INTO code_postings_XX (...) VALUES (...), (...), ...   -- INSERT_BATCH rows each
+
+Flushes of different shards run concurrently on separate connections,
+bounded by `concurrency`. Re-adding an order is idempotent (delete + insert),
+so callers can checkpoint after flush_all() + save_doc_stats() and simply
+replay from the last checkpoint after a crash.
+"""
+import asyncio
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from tortoise.transactions import in_transaction
+
+from models import CodeDocStat
+from shard_router import ALL_SHARDS_MASK, router
+from winnowing_utils import to_int64, to_uint64
+
+INSERT_BATCH = 1000
+DELETE_BATCH = 1000
+
+PostingRow = Tuple[int, int, int, int]  # (fp, pos, start_line, end_line)
+
+def chunked(lst, n):
+    for i in range(0, len(lst), n):
+        yield lst[i:i+n]
+
+async def load_shard_masks(order_ids: Sequence[int]) -> Dict[int, int]:
+    """order_id -> shard mask for orders that have a manifest (code_doc_stats row)."""
+    masks = {}
+    for sub in chunked(list(order_ids), DELETE_BATCH):
+        rows = await CodeDocStat.filter(order_id__in=sub).values_list("order_id", "shard_mask")
+        masks.update({oid: to_uint64(mask) for oid, mask in rows})
+    return masks
+
+class ShardedPostingWriter:
+    def __init__(self, flush_rows: int = 5000, concurrency: int = 8):
+        self.flush_rows = flush_rows
+        self.concurrency = concurrency
+        self._rows: List[List[tuple]] = [[] for _ in router.shards]
+        self._deletes: List[Set[int]] = [set() for _ in router.shards]
+        self._doc_stats: Dict[int, Tuple[int, int, int]] = {}  # order_id -> (fp_count, token_count, shard_mask)
+        self._sem = asyncio.Semaphore(concurrency)
+        self._locks = [asyncio.Lock() for _ in router.shards]
+        self.rows_written = 0
+
+    @property
+    def buffered_rows(self) -> int:
+        return sum(len(r) for r in self._rows)
+
+    def add_order(
+        self, order_id: int, rows: Sequence[PostingRow], token_count: int = 0, old_mask: Optional[int] = None
+    ) -> None:
+        """
+        Replace all postings of `order_id` with `rows` (applied on flush).
+        `old_mask` is the order's current manifest; None means unknown (delete on every shard).
+        """
+        mask = 0
+        for fp, pos, start_line, end_line in rows:
+            shard = router.shard_of(fp)
+            mask |= router.manifest_bit(fp)
+            self._rows[shard].append((fp, order_id, pos, start_line, end_line))
+        # 要写入的分片也要先删，保证断点重放时不会主键冲突
+        delete_mask = ALL_SHARDS_MASK if old_mask is None else old_mask | mask
+        for shard in router.shards_of_mask(delete_mask):
+            self._deletes[shard].add(order_id)
+        self._doc_stats[order_id] = (len(rows), token_count, mask)
+
+    async def _flush_shard(self, shard: int) -> int:
+        # 同一分片的 flush 串行执行，保证先加入的订单先落库（delete/insert 顺序不乱）
+        async with self._locks[shard]:
+            rows, self._rows[shard] = self._rows[shard], []
+            deletes, self._deletes[shard] = sorted(self._deletes[shard]), set()
+            if not rows and not deletes:
+                return 0
+            async with self._sem:
+                await self._write_shard(shard, deletes, rows)
+        self.rows_written += len(rows)
+        return len(rows)
+
+    async def _write_shard(self, shard: int, deletes: List[int], rows: List[tuple]) -> None:
+        tbl = router.table(shard)
+        async with in_transaction() as conn:
+            for sub in chunked(deletes, DELETE_BATCH):
+                ph = ",".join(["%s"] * len(sub))
+                await conn.execute_query(f"DELETE FROM {tbl} WHERE order_id IN ({ph})", sub)
+            for part in chunked(rows, INSERT_BATCH):
+                values = [v for row in part for v in row]
+                sql = f"INSERT INTO {tbl} (fp, order_id, pos, start_line, end_line) VALUES " + ",".join(
+                    ["(%s,%s,%s,%s,%s)"] * len(part)
+                )
+                await conn.execute_query(sql, values)
+
+    async def _flush_shards(self, shards: Sequence[int]) -> int:
+        return sum(await asyncio.gather(*[self._flush_shard(s) for s in shards]))
+
+    async def flush_full(self) -> int:
+        """Flush only shards whose buffer reached flush_rows (keeps statements large)."""
+        return await self._flush_shards([s for s in router.shards if len(self._rows[s]) >= self.flush_rows])
+
+    async def flush_all(self) -> int:
+        """Flush every shard; afterwards every added order is fully on disk."""
+        return await self._flush_shards(router.shards)
+
+    async def save_doc_stats(self, conn=None) -> int:
+        """Write the manifests of orders added since the last call (call after flush_all)."""
+        stats, self._doc_stats = self._doc_stats, {}
+        if not stats:
+            return 0
+        order_ids = list(stats)
+        for sub in chunked(order_ids, DELETE_BATCH):
+            await CodeDocStat.filter(order_id__in=sub).using_db(conn).delete()
+        await CodeDocStat.bulk_create(
+            [
+                CodeDocStat(order_id=oid, fp_count=fp_count, token_count=token_count, shard_mask=to_int64(mask))
+                for oid, (fp_count, token_count, mask) in stats.items()
+            ],
+            batch_size=500,
+            using_db=conn,
+        )
+        return len(stats)
+
+async def delete_orders(order_ids: Iterable[int], concurrency: int = 8) -> Dict[str, int]:
+    """
+    Bulk purge: one `order_id IN (...)` DELETE per shard, only on shards the
+    orders' manifests point at (orders without a manifest hit every shard).
+    Manifests are removed afterwards.
+    """
+    order_ids = sorted(set(order_ids))
+    masks = await load_shard_masks(order_ids)
+    by_shard: List[List[int]] = [[] for _ in router.shards]
+    for oid in order_ids:
+        for shard in router.shards_of_mask(masks.get(oid, ALL_SHARDS_MASK)):
+            by_shard[shard].append(oid)
+
+    sem = asyncio.Semaphore(concurrency)
+
+    async def delete_shard(shard: int, ids: List[int]) -> None:
+        async with sem:
+            async with in_transaction() as conn:
+                for sub in chunked(ids, DELETE_BATCH):
+                    ph = ",".join(["%s"] * len(sub))
+                    await conn.execute_query(f"DELETE FROM {router.table(shard)} WHERE order_id IN ({ph})", sub)
+
+    touched = [s for s in router.shards if by_shard[s]]
+    await asyncio.gather(*[delete_shard(s, by_shard[s]) for s in touched])
+    for sub in chunked(order_ids, DELETE_BATCH):
+        await CodeDocStat.filter(order_id__in=sub).delete()
+    return {
+        "orders": len(order_ids),
+        "without_manifest": len(order_ids) - len(masks),
+        "shards_touched": len(touched),
+        "statements": sum((len(by_shard[s]) + DELETE_BATCH - 1) // DELETE_BATCH for s in touched),
+    }
@@ -65,8 +65,8 @@ async def rebuild_fast():
             # 这里的业务逻辑不变
             chunks = split_code_into_chunks(order.generated_code, window_size=10, step=5)
             
-            for chunk in chunks:
-                f_val = engine.compute_simhash(chunk['content'])
+            for chunk, f_int in zip(chunks, engine.compute_simhash_many(chunks)):
+                f_val = engine.to_binary(f_int)
                 parts = engine.split_fingerprint_to_parts(f_val)
                 
                 fp = CodeFingerprint(
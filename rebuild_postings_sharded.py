@@ -1,96 +1,151 @@
 # rebuild_postings_sharded.py
+"""
+全量/断点续跑重建 v2 分片倒排索引 (code_postings_XX，分片数见 POSTING_SHARDS)。
+
+流水线：
+  1. 按 id 做 keyset 分页读取 COMPLETED 订单（每页 --page-size 个）；
+  2. 进程池并行分词 + winnowing（读下一页、算指纹与写库互相重叠）；
+  3. 指纹行按分片累积在 ShardedPostingWriter 中，攒够 --flush-rows 行的分片
+     用大批量多行 INSERT 落库，不同分片并发写（--concurrency 个连接）；
+  4. 每处理 --checkpoint-orders 个订单全量 flush 一次，并把最后一个订单 id 写入
+     rebuild_progress 表；中断后重新运行会从断点继续。
+
+    python rebuild_postings_sharded.py [--restart] [--max-id 50000] [--workers 4]
+"""
+import argparse
 import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 from tortoise import Tortoise, run_async
 from tortoise.transactions import in_transaction
 from config import settings
-from models import CodeOrder, OrderStatus
-from winnowing_utils import normalize_to_tokens_with_lines, winnow, group_fps_by_shard
-from winnowing_utils import normalize_to_tokens_with_lines, winnow, shard_of_fp
-BATCH_SIZE = 10
+from models import CodeOrder, OrderStatus, RebuildProgress
+from index_generation import bump_generation
+from fingerprint_pool import posting_rows
+from posting_writer import ShardedPostingWriter, load_shard_masks
+from shard_router import check_layout
+from winnowing_utils import K, WINDOW
+
+PAGE_SIZE = 200
 MAX_FPS_PER_DOC = 10000
-INSERT_BATCH = 300
-K = 20
-WINDOW = 5
-
-def table_for_shard(shard: int) -> str:
-    return f"code_postings_{shard:02x}"
+FLUSH_ROWS = 5000
+CHECKPOINT_ORDERS = 2000
+PROGRESS_NAME = "postings"
 
 async def init():
     await Tortoise.init(db_url=settings.DATABASE_URL, modules={"model": ["models"]})
+    # rebuild_progress / index_state 表可能还没被服务端建出来
+    await Tortoise.generate_schemas(safe=True)
+    await check_layout()
 
 async def get_last_order_id():
-    # Use max(order_id) across shards is expensive; keep a progress table in production.
-    # Minimal version: just start from 0.
-    return 0
-
-async def delete_existing_postings(conn, order_id: int):
-    # Delete from all shards. This is 64 statements; acceptable for rebuild, but you
-    # can optimize by only deleting shards you are about to touch (we do that below).
-    for shard in range(64):
-        await conn.execute_query(f"DELETE FROM {table_for_shard(shard)} WHERE order_id=%s", [order_id])
-
-async def rebuild():
-    await init()
-    last_id = await get_last_order_id()
-
+    progress = await RebuildProgress.get_or_none(name=PROGRESS_NAME)
+    return progress.last_order_id if progress else 0
+
+async def save_checkpoint(writer: ShardedPostingWriter, last_order_id: int):
+    async with in_transaction() as conn:
+        # 分片清单 (code_doc_stats.shard_mask) 与断点一起提交
+        await writer.save_doc_stats(conn=conn)
+        await RebuildProgress.update_or_create(
+            name=PROGRESS_NAME, defaults={"last_order_id": last_order_id}, using_db=conn
+        )
+        # 索引版本号 +1，查重服务的结果缓存随之失效
+        await bump_generation(conn=conn)
+
+async def read_pages(start_id: int, max_id, page_size: int):
+    last_id = start_id
     while True:
-        orders = await CodeOrder.filter(
-            id__gt=last_id,
-            id__lte=50000,          # 先跑 5w
-            status=OrderStatus.COMPLETED,
-        ).order_by("id").limit(BATCH_SIZE)
-
-        if not orders:
-            print("All done.")
-            break
-
-        for order in orders:
-            last_id = order.id
-            code = order.generated_code or ""
-            if not code.strip():
-                continue
-
-            tokens, token_lines = normalize_to_tokens_with_lines(code)
-            fps = winnow(tokens, token_lines, k=K, window=WINDOW)
-
-            if not fps:
-                continue
-
-            # Cap fingerprints to control storage / query cost (uniform sampling).
-            if len(fps) > MAX_FPS_PER_DOC:
-                step = max(1, len(fps) // MAX_FPS_PER_DOC)
-                fps = fps[::step][:MAX_FPS_PER_DOC]
-
-            fps_by_shard = {}
-            for f in fps:
-                fps_by_shard.setdefault(shard_of_fp(f.fp), []).append(f)
-
-            async with in_transaction() as conn:
-                # Delete only shards we will write into.
-                for shard in fps_by_shard.keys():
-                    await conn.execute_query(
-                        f"DELETE FROM {table_for_shard(shard)} WHERE order_id=%s",
-                        [order.id],
-                    )
-                def chunked(lst, n):
-                    for i in range(0, len(lst), n):
-                        yield lst[i:i+n]
-                # Insert per shard in bulk.
-                for shard, fplist in fps_by_shard.items():
-                    tbl = table_for_shard(shard)
-
-                    for part in chunked(fplist, INSERT_BATCH):
-                        values = []
-                        for f in part:
-                            values.extend([f.fp, order.id, f.pos, f.start_line, f.end_line])
-
-                        row_ph = "(%s,%s,%s,%s,%s)"
-                        sql = f"INSERT INTO {tbl} (fp, order_id, pos, start_line, end_line) VALUES " + ",".join(
-                            [row_ph] * len(part)
-                        )
-                        await conn.execute_query(sql, values)
-
-            print(f"order {order.id}: inserted {len(fps)} fingerprints into {len(fps_by_shard)} shards")
+        qs = CodeOrder.filter(id__gt=last_id, status=OrderStatus.COMPLETED)
+        if max_id is not None:
+            qs = qs.filter(id__lte=max_id)
+        page = await qs.order_by("id").limit(page_size).values_list("id", "generated_code")
+        if not page:
+            return
+        last_id = page[-1][0]
+        yield page
+
+async def produce(queue: asyncio.Queue, pool, start_id: int, max_id, page_size: int):
+    """读页 + 进程池算指纹；结果按页放入队列，与写库阶段重叠执行。"""
+    loop = asyncio.get_running_loop()
+    try:
+        async for page in read_pages(start_id, max_id, page_size):
+            futures = [
+                loop.run_in_executor(
+                    pool, posting_rows, code or "", K, WINDOW, settings.FP_HASH_SCHEME, MAX_FPS_PER_DOC
+                )
+                for _, code in page
+            ]
+            results = await asyncio.gather(*futures)
+            await queue.put([(oid, rows) for (oid, _), rows in zip(page, results)])
+    except Exception:
+        await queue.put(None)  # 让写库阶段结束，异常由 await producer 抛出
+        raise
+    await queue.put(None)
+
+async def rebuild(args):
+    await init()
+    start_id = 0 if args.restart else (args.start_id if args.start_id is not None else await get_last_order_id())
+    print(f"rebuild from order id > {start_id}" + (f" up to {args.max_id}" if args.max_id else ""))
+
+    writer = ShardedPostingWriter(flush_rows=args.flush_rows, concurrency=args.concurrency)
+    queue = asyncio.Queue(maxsize=2)
+    pool = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn"))
+    producer = asyncio.create_task(produce(queue, pool, start_id, args.max_id, args.page_size))
+
+    t0 = time.time()
+    orders_done = 0
+    since_checkpoint = 0
+    last_id = start_id
+    try:
+        while True:
+            page = await queue.get()
+            if page is None:
+                break
+            masks = await load_shard_masks([oid for oid, _ in page])
+            for oid, (rows, token_count) in page:
+                # 空代码 / 无指纹的订单也要清掉旧 postings；有分片清单的只删清单里的分片
+                writer.add_order(oid, rows, token_count, old_mask=masks.get(oid))
+                last_id = oid
+            orders_done += len(page)
+            since_checkpoint += len(page)
+            await writer.flush_full()
+
+            if since_checkpoint >= args.checkpoint_orders:
+                await writer.flush_all()
+                await save_checkpoint(writer, last_id)
+                since_checkpoint = 0
+                elapsed = time.time() - t0
+                print(
+                    f"checkpoint order {last_id}: {orders_done} orders, {writer.rows_written} rows, "
+                    f"{orders_done / elapsed:.1f} orders/s, {writer.rows_written / elapsed:.0f} rows/s"
+                )
+
+        await producer  # 读页/算指纹阶段的异常在这里抛出
+        await writer.flush_all()
+        if orders_done:
+            await save_checkpoint(writer, last_id)
+    finally:
+        producer.cancel()
+        pool.shutdown(cancel_futures=True)
+        await Tortoise.close_connections()
+
+    elapsed = max(time.time() - t0, 1e-9)
+    print(
+        f"All done. last order {last_id}: {orders_done} orders, {writer.rows_written} rows in {elapsed:.1f}s "
+        f"({orders_done / elapsed:.1f} orders/s, {writer.rows_written / elapsed:.0f} rows/s)"
+    )
 
 if __name__ == "__main__":
-    run_async(rebuild())
\ No newline at end of file
+    ap = argparse.ArgumentParser(description="Rebuild the sharded winnowing posting tables")
+    ap.add_argument("--restart", action="store_true", help="ignore the checkpoint and start from the first order")
+    ap.add_argument("--start-id", type=int, default=None, help="start after this order id instead of the checkpoint")
+    ap.add_argument("--max-id", type=int, default=None, help="stop after this order id")
+    ap.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="fingerprinting processes")
+    ap.add_argument("--flush-rows", type=int, default=FLUSH_ROWS, help="rows buffered per shard before a flush")
+    ap.add_argument("--concurrency", type=int, default=8, help="shards flushed concurrently (DB connections)")
+    ap.add_argument("--checkpoint-orders", type=int, default=CHECKPOINT_ORDERS)
+    run_async(rebuild(ap.parse_args()))
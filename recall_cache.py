@@ -0,0 +1,116 @@
+# recall_cache.py
+"""
+In-process cache of per-fingerprint posting summaries for the v2 recall stage:
+fp -> (order_ids, hit counts), i.e. the per-fp rows of
+`SELECT fp, order_id, COUNT(*) ... GROUP BY fp, order_id`.
+
+Popular fingerprints (shared helpers, common idioms) recur across unrelated
+uploads; with their summaries cached the recall stage only queries shards
+for fingerprints it has not seen. Fingerprints without postings are cached
+too (empty summary), which is the common case for novel code.
+
+Summaries are stored as two array('i') columns. The size budget counts
+order entries (+1 per fp), and the least recently used fps are evicted
+first when it is exceeded.
+
+Invalidation:
+- in-process writers call advance(generation, fps) with the fps they touched;
+- out-of-process writers bump the index generation, and sync() drops the
+  whole cache when it observes a new generation.
+"""
+from array import array
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+Summary = Tuple[array, array]  # (order_ids, counts)
+
+class RecallCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.generation = 0
+        self._entries: "OrderedDict[int, Summary]" = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _cost(summary: Summary) -> int:
+        return len(summary[0]) + 1
+
+    def sync(self, generation: int) -> None:
+        """Drop everything if the index changed since the cache was filled."""
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+
+    def advance(self, generation: int, fps: Iterable[int]) -> None:
+        """
+        An in-process writer moved the index to `generation` and only changed
+        postings of `fps`: drop just those entries instead of the whole cache.
+        """
+        if generation == self.generation + 1:
+            self.invalidate(fps)
+            self.generation = generation
+        else:
+            self.sync(generation)
+
+    def get(self, fp: int) -> Optional[Summary]:
+        summary = self._entries.get(fp)
+        if summary is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(fp)
+        self.hits += 1
+        return summary
+
+    def put_many(self, summaries: Dict[int, Dict[int, int]], generation: int) -> None:
+        """
+        Store {fp: {order_id: count}} fetched under `generation`. Results fetched
+        before the cache moved to a newer generation are discarded.
+        """
+        if not self.enabled or generation != self.generation:
+            return
+        for fp, counts in summaries.items():
+            summary = (array("i", counts.keys()), array("i", counts.values()))
+            cost = self._cost(summary)
+            if cost > self.max_entries:
+                continue
+            old = self._entries.pop(fp, None)
+            if old is not None:
+                self._size -= self._cost(old)
+            self._entries[fp] = summary
+            self._size += cost
+        while self._size > self.max_entries:
+            _, old = self._entries.popitem(last=False)
+            self._size -= self._cost(old)
+            self.evictions += 1
+
+    def invalidate(self, fps: Iterable[int]) -> None:
+        for fp in fps:
+            old = self._entries.pop(fp, None)
+            if old is not None:
+                self._size -= self._cost(old)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._size = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "fingerprints": len(self._entries),
+            "entries": self._size,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": f"{(self.hits / lookups if lookups else 0.0)*100:.2f}%",
+        }
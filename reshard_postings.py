@@ -0,0 +1,224 @@
+# reshard_postings.py
+"""
+把分片倒排索引从 N 个分片拆成 M 个（M 是 N 的倍数，都是 2 的幂，最多 256）。
+
+分片按指纹低位路由，旧分片 p 的行在新布局下只会落到 p, p+N, p+2N, ...：留下的行就在
+p 原来的表里，其余子分片建新表。整个过程中查重服务一直按旧布局 (POSTING_SHARDS=N) 查询，
+旧表在 cleanup 之前始终完整。
+
+    python reshard_postings.py copy --from 64 --to 128       # 在线拷贝，可重复运行 / 断点续跑
+    # 暂停写入：服务设 INDEXER_ENABLED=false 重启，停掉重建 / 删除脚本
+    python reshard_postings.py cutover --from 64 --to 128    # 再同步一遍差异，记录新布局，版本号 +1
+    # .env 中改为 POSTING_SHARDS=128，重启所有服务进程（恢复增量索引）
+    python reshard_postings.py cleanup --from 64 --to 128    # 删除旧表中已迁走的行
+    python reshard_postings.py schema --shards 128 > posting_schema.sql
+
+copy / cutover 对每个旧分片按主键 (fp, order_id, pos) 顺序分批读取要迁走的行
+（--batch-rows 行一批，一批一个事务），与子分片中同一主键区间的行比对：缺的插入，
+多余或不一致的删除。第一次运行即全量拷贝，之后只补差异。copy 期间服务还在写旧表，
+所以 cutover 必须在暂停写入之后执行。cleanup 之前不要运行 build_stop_fingerprints.py
+（迁走的行在新旧两张表里各有一份）。
+"""
+import argparse
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from tortoise import Tortoise, run_async
+from tortoise.transactions import in_transaction
+
+from config import settings
+from index_generation import bump_generation
+from models import RebuildProgress
+from posting_writer import INSERT_BATCH, chunked
+from shard_router import ShardRouter, read_layout, record_layout, schema_sql
+
+BATCH_ROWS = 5000
+COLUMNS = "fp, order_id, pos, start_line, end_line"
+
+Row = Tuple[int, int, int, int, int]  # (fp, order_id, pos, start_line, end_line)
+
+async def init():
+    await Tortoise.init(db_url=settings.DATABASE_URL, modules={"model": ["models"]})
+    # rebuild_progress / index_state 表可能还没被服务端建出来
+    await Tortoise.generate_schemas(safe=True)
+
+def progress_name(old: ShardRouter, new: ShardRouter) -> str:
+    return f"reshard-{old.count}-{new.count}"
+
+def key_range(after: Optional[Row], upto: Optional[Row]) -> Tuple[List[str], list]:
+    """主键区间 (after, upto]，None 表示不限"""
+    conds, params = [], []
+    if after is not None:
+        conds.append("(fp, order_id, pos) > (%s, %s, %s)")
+        params += after[:3]
+    if upto is not None:
+        conds.append("(fp, order_id, pos) <= (%s, %s, %s)")
+        params += upto[:3]
+    return conds, params
+
+def as_rows(rows: Sequence[dict]) -> List[Row]:
+    return [
+        (int(r["fp"]), int(r["order_id"]), int(r["pos"]), int(r["start_line"]), int(r["end_line"])) for r in rows
+    ]
+
+async def create_child_tables(old: ShardRouter, new: ShardRouter) -> None:
+    async with in_transaction() as conn:
+        for shard in new.shards:
+            if shard >= old.count:
+                await conn.execute_query(f"CREATE TABLE IF NOT EXISTS {new.table(shard)} LIKE {old.table(0)}")
+
+async def sync_shard(parent: int, old: ShardRouter, new: ShardRouter, batch_rows: int) -> Dict[str, int]:
+    """让旧分片 parent 的子分片与它要迁走的行一致，返回读取/插入/删除的行数"""
+    src = old.table(parent)
+    children = old.children(parent, new)[1:]
+    stats = {"rows": 0, "inserted": 0, "deleted": 0}
+    last: Optional[Row] = None
+    while True:
+        async with in_transaction() as conn:
+            conds, params = key_range(last, None)
+            rows = as_rows(await conn.execute_query_dict(
+                f"SELECT {COLUMNS} FROM {src} WHERE " + " AND ".join(["(fp & %s) <> %s"] + conds)
+                + f" ORDER BY fp, order_id, pos LIMIT {int(batch_rows)}",
+                [new.mask, parent] + params,
+            ))
+            # 不满一批说明读到了末尾，最后一段子分片区间不设上界
+            upto = rows[-1] if len(rows) == batch_rows else None
+            want = defaultdict(set)
+            for row in rows:
+                want[new.shard_of(row[0])].add(row)
+
+            conds, params = key_range(last, upto)
+            where = (" WHERE " + " AND ".join(conds)) if conds else ""
+            for child in children:
+                tbl = new.table(child)
+                have = set(as_rows(await conn.execute_query_dict(f"SELECT {COLUMNS} FROM {tbl}{where}", params)))
+                stale = sorted(have - want[child])
+                missing = sorted(want[child] - have)
+                if stale:
+                    await conn.execute_many(
+                        f"DELETE FROM {tbl} WHERE fp = %s AND order_id = %s AND pos = %s", [list(r[:3]) for r in stale]
+                    )
+                for part in chunked(missing, INSERT_BATCH):
+                    values = [v for row in part for v in row]
+                    sql = f"INSERT INTO {tbl} ({COLUMNS}) VALUES " + ",".join(["(%s,%s,%s,%s,%s)"] * len(part))
+                    await conn.execute_query(sql, values)
+                stats["inserted"] += len(missing)
+                stats["deleted"] += len(stale)
+        stats["rows"] += len(rows)
+        if upto is None:
+            return stats
+        last = upto
+
+async def sync_all(old: ShardRouter, new: ShardRouter, batch_rows: int, start: int = 0, checkpoint: bool = False):
+    totals = defaultdict(int)
+    t0 = time.time()
+    for parent in range(start, old.count):
+        stats = await sync_shard(parent, old, new, batch_rows)
+        for k, v in stats.items():
+            totals[k] += v
+        if checkpoint:
+            # last_order_id 在这里记的是下一个要处理的旧分片
+            await RebuildProgress.update_or_create(
+                name=progress_name(old, new), defaults={"last_order_id": parent + 1}
+            )
+        print(
+            f"shard {old.table(parent)} -> {', '.join(new.table(c) for c in old.children(parent, new)[1:])}: "
+            f"{stats['rows']} rows, +{stats['inserted']} -{stats['deleted']} ({time.time() - t0:.1f}s)"
+        )
+    return dict(totals)
+
+async def check_from(old: ShardRouter) -> None:
+    recorded = await read_layout()
+    if recorded and recorded != old.count:
+        raise SystemExit(f"分片表当前布局为 {recorded} 个分片，与 --from {old.count} 不符")
+
+async def copy(old: ShardRouter, new: ShardRouter, batch_rows: int, restart: bool):
+    await check_from(old)
+    await create_child_tables(old, new)
+    start = 0
+    if not restart:
+        progress = await RebuildProgress.get_or_none(name=progress_name(old, new))
+        start = progress.last_order_id if progress else 0
+    if start >= old.count:
+        print("拷贝已完成（--restart 重新比对一遍）")
+        return
+    totals = await sync_all(old, new, batch_rows, start=start, checkpoint=True)
+    print(f"copy done: {totals}")
+
+async def cutover(old: ShardRouter, new: ShardRouter, batch_rows: int):
+    await check_from(old)
+    await create_child_tables(old, new)
+    totals = await sync_all(old, new, batch_rows)
+    async with in_transaction() as conn:
+        await record_layout(new.count, conn=conn)
+        # 结果缓存随之失效
+        await bump_generation(conn=conn)
+    print(f"cutover done: {totals}")
+    print(f"现在把 POSTING_SHARDS 改为 {new.count} 并重启所有服务进程，然后运行 cleanup")
+
+async def cleanup(old: ShardRouter, new: ShardRouter, batch_rows: int):
+    recorded = await read_layout()
+    if recorded != new.count:
+        raise SystemExit(f"还没有切换到 {new.count} 个分片（当前记录: {recorded or '无'}），先运行 cutover")
+    total = 0
+    for parent in old.shards:
+        src = old.table(parent)
+        last: Optional[Row] = None
+        deleted = 0
+        while True:
+            conds, params = key_range(last, None)
+            async with in_transaction() as conn:
+                keys = await conn.execute_query_dict(
+                    f"SELECT fp, order_id, pos FROM {src} WHERE " + " AND ".join(["(fp & %s) <> %s"] + conds)
+                    + f" ORDER BY fp, order_id, pos LIMIT {int(batch_rows)}",
+                    [new.mask, parent] + params,
+                )
+                keys = [(int(r["fp"]), int(r["order_id"]), int(r["pos"])) for r in keys]
+                if keys:
+                    await conn.execute_many(
+                        f"DELETE FROM {src} WHERE fp = %s AND order_id = %s AND pos = %s", [list(k) for k in keys]
+                    )
+            deleted += len(keys)
+            if len(keys) < batch_rows:
+                break
+            last = keys[-1]
+        total += deleted
+        print(f"shard {src}: deleted {deleted} moved rows")
+    print(f"cleanup done: {total} rows")
+
+async def main(args):
+    old, new = ShardRouter(args.from_shards), ShardRouter(args.to_shards)
+    if new.count <= old.count:
+        raise SystemExit("--to 必须大于 --from（只支持拆分）")
+    old.children(0, new)  # 校验倍数关系
+    await init()
+    try:
+        if args.command == "copy":
+            await copy(old, new, args.batch_rows, args.restart)
+        elif args.command == "cutover":
+            await cutover(old, new, args.batch_rows)
+        else:
+            await cleanup(old, new, args.batch_rows)
+    finally:
+        await Tortoise.close_connections()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="在线拆分分片倒排索引")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("copy", "cutover", "cleanup"):
+        p = sub.add_parser(name)
+        p.add_argument("--from", dest="from_shards", type=int, required=True, help="当前分片数")
+        p.add_argument("--to", dest="to_shards", type=int, required=True, help="目标分片数")
+        p.add_argument("--batch-rows", type=int, default=BATCH_ROWS, help="每批读取/迁移的行数")
+        if name == "copy":
+            p.add_argument("--restart", action="store_true", help="忽略断点，从第一个分片重新比对")
+    p = sub.add_parser("schema", help="输出 posting_schema.sql")
+    p.add_argument("--shards", type=int, default=settings.POSTING_SHARDS)
+    args = parser.parse_args()
+
+    if args.command == "schema":
+        sys.stdout.write(schema_sql(ShardRouter(args.shards)))
+    else:
+        run_async(main(args))
@@ -0,0 +1,66 @@
+# result_cache.py
+"""
+Bounded LRU + TTL cache for duplicate-check results.
+
+Entries are tagged with the index generation they were computed under
+(see index_generation.py); a lookup under a newer generation is a miss and
+drops the entry, so anything computed before postings were inserted or
+deleted is never served.
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+class ResultCache:
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (generation, expires_at, value)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, generation: int) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        gen, expires_at, value = entry
+        if gen != generation or expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, generation: int, value: Any) -> None:
+        if not self.enabled:
+            return
+        self._entries[key] = (generation, time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": f"{(self.hits / lookups if lookups else 0.0)*100:.2f}%",
+        }
@@ -0,0 +1,149 @@
+# shard_router.py
+"""
+Routing of fingerprints to the sharded posting tables code_postings_XX.
+
+shard = low log2(N) bits of the fingerprint (as uint64), N a power of two,
+configured by POSTING_SHARDS. Table names stay two hex digits, so N is capped
+at 256; with low-bit routing, splitting N -> M (M a multiple of N) keeps
+every row of shard s either in s itself or in one of its children
+s + N, s + 2N, ... (see reshard_postings.py).
+
+Order manifests (code_doc_stats.shard_mask) do not depend on N: bit b means
+"the order has fingerprints with fp & 63 == b". With N <= 64 bit b lives in
+shard b & (N-1), with N > 64 in the shards s with s & 63 == b; manifests
+written before a reshard therefore stay valid after it.
+"""
+from typing import Dict, Iterable, List
+
+from config import settings
+from models import IndexState
+from winnowing_utils import MASK64
+
+MAX_SHARDS = 256
+MANIFEST_BITS = 64
+ALL_SHARDS_MASK = (1 << MANIFEST_BITS) - 1
+TABLE_PREFIX = "code_postings"
+LAYOUT_STATE = "posting_shards"  # index_state 行：generation 列存放切换后的分片数
+
+class ShardRouter:
+    def __init__(self, count: int):
+        count = int(count)
+        if count < 1 or count > MAX_SHARDS or count & (count - 1):
+            raise ValueError(f"shard count must be a power of two in 1..{MAX_SHARDS}, got {count}")
+        self.count = count
+        self.mask = count - 1
+        # shard -> manifest bits whose fingerprints are stored in that shard
+        self._manifest_bits = [0] * count
+        if count <= MANIFEST_BITS:
+            for bit in range(MANIFEST_BITS):
+                self._manifest_bits[bit & self.mask] |= 1 << bit
+        else:
+            for shard in range(count):
+                self._manifest_bits[shard] = 1 << (shard & (MANIFEST_BITS - 1))
+
+    def __repr__(self) -> str:
+        return f"ShardRouter({self.count})"
+
+    @property
+    def shards(self) -> range:
+        return range(self.count)
+
+    def shard_of(self, fp: int) -> int:
+        """fp is stored/transferred as signed int64; routing uses its low bits as uint64."""
+        return (fp & MASK64) & self.mask
+
+    def table(self, shard: int, prefix: str = TABLE_PREFIX) -> str:
+        return f"{prefix}_{shard:02x}"
+
+    def tables(self) -> List[str]:
+        return [self.table(s) for s in self.shards]
+
+    def group(self, fps: Iterable[int]) -> Dict[int, List[int]]:
+        out: Dict[int, List[int]] = {}
+        for fp in fps:
+            out.setdefault(self.shard_of(fp), []).append(fp)
+        return out
+
+    @staticmethod
+    def manifest_bit(fp: int) -> int:
+        return 1 << ((fp & MASK64) & (MANIFEST_BITS - 1))
+
+    def shards_of_mask(self, mask: int) -> List[int]:
+        """Shards that may hold rows of an order with manifest `mask`."""
+        return [s for s in self.shards if mask & self._manifest_bits[s]]
+
+    def children(self, shard: int, target: "ShardRouter") -> List[int]:
+        """Shards of `target` (a split of this layout) that receive rows of `shard`; the first is `shard` itself."""
+        if target.count % self.count:
+            raise ValueError(f"{target.count} shards is not a split of {self.count}")
+        return list(range(shard, target.count, self.count))
+
+def schema_sql(router: ShardRouter) -> str:
+    """MySQL DDL for stop_fingerprints and the router's posting tables (posting_schema.sql)."""
+    lines = [
+        "-- posting_schema.sql (MySQL 8.0)",
+        f"-- {router.count} sharded posting tables: {router.table(0)} .. {router.table(router.mask)}",
+        f"-- shard = fp & 0x{router.mask:02x}  (POSTING_SHARDS={router.count}; regenerate with",
+        f"--   python reshard_postings.py schema --shards {router.count} > posting_schema.sql)",
+        "",
+        "SET sql_notes = 0;",
+        "",
+        "DROP TABLE IF EXISTS stop_fingerprints;",
+        "CREATE TABLE stop_fingerprints (",
+        "  fp BIGINT UNSIGNED NOT NULL,",
+        "  df INT NOT NULL,",
+        "  PRIMARY KEY (fp),",
+        "  KEY idx_df (df)",
+        ") ENGINE=InnoDB;",
+        "",
+        f"-- Create {router.count} tables",
+        "-- Each table uses a compact PK to avoid an extra AUTO_INCREMENT column.",
+        "-- PK(fp, order_id, pos) is typically unique for one doc.",
+        "-- idx_order_pos supports alignment/segment extraction during rerank.",
+        f"DROP TABLE IF EXISTS {router.table(0)};",
+        f"CREATE TABLE {router.table(0)} (",
+        "  fp BIGINT UNSIGNED NOT NULL,",
+        "  order_id INT NOT NULL,",
+        "  pos INT NOT NULL,",
+        "  start_line INT NOT NULL,",
+        "  end_line INT NOT NULL,",
+        "  PRIMARY KEY (fp, order_id, pos),",
+        "  KEY idx_order_pos (order_id, pos)",
+        ") ENGINE=InnoDB;",
+        "",
+    ]
+    for shard in range(1, router.count):
+        if shard % 16 == 0:
+            lines.append("")
+        lines.append(f"DROP TABLE IF EXISTS {router.table(shard)};")
+        lines.append(f"CREATE TABLE {router.table(shard)} LIKE {router.table(0)};")
+    lines += ["", "SET sql_notes = 1;", ""]
+    return "\n".join(lines)
+
+async def read_layout() -> int:
+    """Shard count recorded by the last reshard cut-over; 0 if the tables were never resharded."""
+    row = await IndexState.filter(name=LAYOUT_STATE).first().values_list("generation", flat=True)
+    return int(row) if row is not None else 0
+
+async def record_layout(count: int, conn=None) -> None:
+    await IndexState.update_or_create(name=LAYOUT_STATE, defaults={"generation": count}, using_db=conn)
+
+async def check_layout() -> None:
+    """
+    Refuse to run when POSTING_SHARDS disagrees with the recorded layout: writes
+    would go to another set of shard tables and reads would miss the moved rows.
+    Called at service startup and by every script that touches the shard tables.
+    """
+    try:
+        recorded = await read_layout()
+    except Exception as e:
+        print(f"分片布局读取失败: {e}")
+        return
+    if recorded and recorded != router.count:
+        raise RuntimeError(
+            f"POSTING_SHARDS={router.count}，但分片表已由 reshard_postings.py 切换为 "
+            f"{recorded} 个分片；请改为 {recorded} 后重新运行"
+        )
+
+# 服务端与所有脚本共用的分片布局；切换分片数见 reshard_postings.py
+router = ShardRouter(settings.POSTING_SHARDS)
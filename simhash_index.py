@@ -0,0 +1,223 @@
+# simhash_index.py
+"""
+In-process multi-index hashing (MIH) over the v1 SimHash fingerprints.
+
+The 64-bit fingerprint is split into four 16-bit segments, exactly like
+CodeFingerprint.part_1..part_4 (part_1 = highest 16 bits). Two fingerprints
+within Hamming distance <= 3 must agree on at least one segment, so probing the
+four segment tables returns every true match; the exact distance is then a
+popcount of the XOR.
+
+Rows are only ever appended. An order that is re-indexed or purged has its
+rows tombstoned (skipped by search) instead of removed from the segment
+tables; the space is reclaimed on the next restart.
+"""
+import asyncio
+import time
+from array import array
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from tortoise.functions import Count
+
+from models import CodeFingerprint
+
+SEGMENTS = 4
+SEGMENT_BITS = 16
+SEGMENT_MASK = (1 << SEGMENT_BITS) - 1
+LOAD_PAGE = 50000
+ORDER_BATCH = 1000
+
+@dataclass(frozen=True)
+class SimHashMatch:
+    order_id: int
+    start_line: int
+    end_line: int
+    fingerprint: int
+    distance: int
+
+def segments_of(fp: int) -> Tuple[int, ...]:
+    """fp -> (part_1, part_2, part_3, part_4) as ints, part_1 being the high 16 bits."""
+    return tuple(
+        (fp >> (SEGMENT_BITS * (SEGMENTS - 1 - i))) & SEGMENT_MASK
+        for i in range(SEGMENTS)
+    )
+
+class SimHashIndex:
+    def __init__(self):
+        # 按行存储（行号 = 加载顺序），指纹为 uint64
+        self.fps = array("Q")
+        self.order_ids = array("i")
+        self.start_lines = array("i")
+        self.end_lines = array("i")
+        # 每段一张表：16 位段值 -> 行号列表
+        self._tables: List[Dict[int, array]] = [{} for _ in range(SEGMENTS)]
+        # 订单 -> 行号，以及该订单已加载的最小 code_fingerprints.id（判断是否被重新索引）
+        self._order_rows: Dict[int, array] = {}
+        self._order_first_id: Dict[int, int] = {}
+        self._dead: Set[int] = set()  # 已删除/被替换的行，search 跳过
+        self.last_row_id = 0  # 已加载的最大 code_fingerprints.id，用于增量刷新
+        self.generation: Optional[int] = None  # 上一次检查删除时的索引版本号
+        self.ready = False
+        self._lock = asyncio.Lock()  # 刷新可能同时来自定时任务和增量索引回调
+
+    def __len__(self) -> int:
+        return len(self.fps) - len(self._dead)
+
+    def add(self, fp: int, order_id: int, start_line: int, end_line: int, row_id: int) -> None:
+        row = len(self.fps)
+        self.fps.append(fp)
+        self.order_ids.append(order_id)
+        self.start_lines.append(start_line)
+        self.end_lines.append(end_line)
+        for table, seg in zip(self._tables, segments_of(fp)):
+            bucket = table.get(seg)
+            if bucket is None:
+                bucket = table[seg] = array("I")
+            bucket.append(row)
+        rows = self._order_rows.get(order_id)
+        if rows is None:
+            rows = self._order_rows[order_id] = array("I")
+            self._order_first_id[order_id] = row_id
+        rows.append(row)
+
+    def remove_order(self, order_id: int) -> int:
+        """Tombstone every row of order_id; returns how many."""
+        rows = self._order_rows.pop(order_id, None)
+        self._order_first_id.pop(order_id, None)
+        if not rows:
+            return 0
+        self._dead.update(rows)
+        return len(rows)
+
+    def candidates(self, fp: int) -> set:
+        rows = set()
+        for table, seg in zip(self._tables, segments_of(fp)):
+            bucket = table.get(seg)
+            if bucket is not None:
+                rows.update(bucket)
+        return rows
+
+    def search(self, fp: int, max_distance: int = 3) -> Optional[SimHashMatch]:
+        """Closest fingerprint within max_distance (ties -> earliest indexed row)."""
+        best_row = -1
+        best_dist = max_distance + 1
+        fps = self.fps
+        dead = self._dead
+        for row in sorted(self.candidates(fp)):
+            if row in dead:
+                continue
+            dist = (fps[row] ^ fp).bit_count()
+            if dist < best_dist:
+                best_dist = dist
+                best_row = row
+        if best_row < 0:
+            return None
+        return SimHashMatch(
+            order_id=self.order_ids[best_row],
+            start_line=self.start_lines[best_row],
+            end_line=self.end_lines[best_row],
+            fingerprint=fps[best_row],
+            distance=best_dist,
+        )
+
+    def search_many(self, fps: Sequence[int], max_distance: int = 3) -> List[Optional[SimHashMatch]]:
+        return [self.search(fp, max_distance) for fp in fps]
+
+    async def _replaced_orders(self, order_ids: Iterable[int]) -> List[int]:
+        """Loaded orders whose first loaded row is gone from code_fingerprints (re-indexed or purged)."""
+        first_ids = {self._order_first_id[oid]: oid for oid in order_ids}
+        gone = []
+        keys = list(first_ids)
+        for i in range(0, len(keys), ORDER_BATCH):
+            sub = keys[i:i + ORDER_BATCH]
+            alive = set(await CodeFingerprint.filter(id__in=sub).values_list("id", flat=True))
+            gone.extend(first_ids[k] for k in sub if k not in alive)
+        return gone
+
+    async def _load_orders(self, order_ids: List[int], max_row_id: int) -> int:
+        n = 0
+        for i in range(0, len(order_ids), ORDER_BATCH):
+            rows = await CodeFingerprint.filter(
+                order_id__in=order_ids[i:i + ORDER_BATCH], id__lte=max_row_id
+            ).order_by("id").values_list("id", "fingerprint", "order_id", "start_line", "end_line")
+            for row_id, fp_bin, order_id, start_line, end_line in rows:
+                self.add(int(fp_bin, 2), order_id, start_line, end_line, row_id)
+            n += len(rows)
+        return n
+
+    async def refresh(self) -> int:
+        """
+        Append code_fingerprints rows newer than last_row_id. Used both for the
+        initial load and periodically, so rows written by rebuild_index.py or
+        other processes become visible without a restart. An order that shows
+        up again after its earlier rows were deleted (the indexer re-indexes by
+        delete + insert) has the old rows tombstoned first.
+        """
+        async with self._lock:
+            return await self._refresh()
+
+    async def _refresh(self) -> int:
+        added = 0
+        seen = set()
+        while True:
+            rows = await CodeFingerprint.filter(id__gt=self.last_row_id).order_by("id").limit(LOAD_PAGE).values_list(
+                "id", "fingerprint", "order_id", "start_line", "end_line"
+            )
+            if not rows:
+                break
+            # 本次刷新第一次见到、且内存里已有旧行的订单：旧行还在库里说明只是分批写入（rebuild_index.py），否则是被替换了
+            known = {oid for _, _, oid, _, _ in rows if oid not in seen and oid in self._order_rows}
+            seen.update(oid for _, _, oid, _, _ in rows)
+            for oid in await self._replaced_orders(known):
+                self.remove_order(oid)
+            for row_id, fp_bin, order_id, start_line, end_line in rows:
+                self.add(int(fp_bin, 2), order_id, start_line, end_line, row_id)
+            self.last_row_id = rows[-1][0]
+            added += len(rows)
+            if len(rows) < LOAD_PAGE:
+                break
+        return added
+
+    async def drop_deleted(self) -> int:
+        """
+        Reconcile the rows up to last_row_id with code_fingerprints: a cheap
+        count first, then per-order counts only when it differs. Orders that
+        are gone (delete_order_postings.py) are tombstoned; orders whose
+        row count changed are reloaded. Returns the number of orders fixed.
+        """
+        max_row_id = self.last_row_id
+        total = await CodeFingerprint.filter(id__lte=max_row_id).count()
+        if total == len(self):
+            return 0
+        counts = dict(
+            await CodeFingerprint.filter(id__lte=max_row_id)
+            .annotate(n=Count("id")).group_by("order_id").values_list("order_id", "n")
+        )
+        stale = [oid for oid, rows in self._order_rows.items() if counts.get(oid, 0) != len(rows)]
+        stale.extend(oid for oid in counts if oid not in self._order_rows)
+        reload = []
+        for oid in stale:
+            self.remove_order(oid)
+            if counts.get(oid):
+                reload.append(oid)
+        await self._load_orders(reload, max_row_id)
+        return len(stale)
+
+    async def sync(self, generation: int) -> int:
+        """Periodic refresh: append new rows, and once per index generation drop deleted orders."""
+        async with self._lock:
+            added = await self._refresh()
+            if generation != self.generation:
+                fixed = await self.drop_deleted()
+                if fixed:
+                    print(f"SimHash 内存索引: {fixed} 个订单已删除或重新加载")
+                self.generation = generation
+        return added
+
+    async def load(self, generation: Optional[int] = None) -> None:
+        t0 = time.time()
+        n = await self.refresh()
+        self.generation = generation
+        self.ready = True
+        print(f"SimHash 内存索引加载完成: {n} 条指纹, 耗时 {time.time() - t0:.2f}s")
@@ -0,0 +1,38 @@
+# stop_fingerprints.py
+"""
+Memory-resident set of boilerplate fingerprints (stop_fingerprints table).
+
+The table is filled offline by build_stop_fingerprints.py with every fp whose
+document frequency reaches STOP_FP_MIN_DF. Values are stored as BIGINT UNSIGNED
+there and mapped back to the signed int64 form used everywhere else on load.
+"""
+import time
+from typing import Dict, List, Sequence
+
+from tortoise import connections
+
+from winnowing_utils import Fingerprint, to_int64
+
+STOP_FP_MODES = ("drop", "recall", "off")
+
+class StopFingerprints:
+    def __init__(self):
+        self.df: Dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+    def __contains__(self, fp: int) -> bool:
+        return fp in self.df
+
+    async def load(self) -> None:
+        t0 = time.time()
+        conn = connections.get("default")
+        rows = await conn.execute_query_dict("SELECT fp, df FROM stop_fingerprints")
+        self.df = {to_int64(int(r["fp"])): int(r["df"]) for r in rows}
+        print(f"停用指纹加载完成: {len(self.df)} 个, 耗时 {time.time() - t0:.2f}s")
+
+    def without_stop(self, fps: Sequence[Fingerprint]) -> List[Fingerprint]:
+        if not self.df:
+            return list(fps)
+        return [f for f in fps if f.fp not in self.df]
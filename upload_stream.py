@@ -0,0 +1,211 @@
+# upload_stream.py
+"""
+Streaming fingerprinting of large uploads with bounded memory.
+
+The upload's file object is read in READ_CHUNK_BYTES pieces through an
+incremental decoder; StreamTokenizer and iter_winnow_stream turn the pieces
+into fingerprints without ever holding the whole text, token list or hash
+list. What is kept is O(window + sample size):
+
+- v2: the fingerprints sampled down to max_fps (FingerprintSampler), the token
+  digest (hashlib, updated per piece) and the line count;
+- v1: the (start_line, end_line, simhash) of each chunk, computed in batches
+  of SIMHASH_BATCH chunks.
+
+fingerprint_upload() / simhash_upload() read and decode the file on the event
+loop and run the CPU work on the FingerprintPool (run_stream), so a streamed
+upload holds a pool slot like any other fingerprinting job; the worker-side
+functions take the decoded text pieces. fingerprint_stream() /
+simhash_stream_chunks() do the same synchronously. Results equal
+fingerprint_code() / simhash_code_chunks() on the decoded text, apart from
+the limits documented on StreamTokenizer.
+"""
+import codecs
+import hashlib
+from typing import BinaryIO, Container, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from fingerprint_utils import SimHashEngine, iter_code_chunks
+from winnowing_utils import Fingerprint, StreamTokenizer, iter_winnow_stream
+
+READ_CHUNK_BYTES = 1 << 16
+SIMHASH_BATCH = 256
+
+class FingerprintSampler:
+    """
+    Uniform sample of at most `max_fps` fingerprints from a stream of unknown
+    length. Keeps every `stride`-th fingerprint, up to 2 * max_fps of them; the
+    stride doubles (dropping every other kept fingerprint) when that would
+    overflow. sample() then applies the index-time rule fps[::step][:max_fps]
+    to what was kept, so up to 2 * max_fps fingerprints the result equals
+    posting_rows()' sampling, and it always holds min(n, max_fps)
+    fingerprints. The result depends only on the fingerprint sequence, so the
+    in-memory and streaming paths sample identically. max_fps <= 0 keeps
+    everything.
+    """
+
+    def __init__(self, max_fps: int):
+        self.max_fps = max_fps
+        self.stride = 1
+        self.seen = 0
+        self.fps: List[Fingerprint] = []
+
+    def add(self, fp: Fingerprint) -> None:
+        if self.seen % self.stride == 0:
+            self.fps.append(fp)
+            if 0 < self.max_fps and len(self.fps) > 2 * self.max_fps:
+                self.fps = self.fps[::2]
+                self.stride *= 2
+        self.seen += 1
+
+    def sample(self) -> List[Fingerprint]:
+        if 0 < self.max_fps < len(self.fps):
+            step = max(1, len(self.fps) // self.max_fps)
+            return self.fps[::step][:self.max_fps]
+        return self.fps
+
+def sample_fps(fps: Iterable[Fingerprint], max_fps: int) -> List[Fingerprint]:
+    sampler = FingerprintSampler(max_fps)
+    for f in fps:
+        sampler.add(f)
+    return sampler.sample()
+
+def iter_decoded(fileobj: BinaryIO, encoding: str, chunk_size: int = READ_CHUNK_BYTES) -> Iterator[str]:
+    """Decode a binary file piece by piece; multi-byte sequences may straddle reads."""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    while True:
+        data = fileobj.read(chunk_size)
+        if not data:
+            break
+        text = decoder.decode(data)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+def fingerprint_text_stream(
+    pieces: Iterable[str], k: int, window: int, scheme: str, max_fps: int, stop: Optional[Container[int]]
+) -> Tuple[List[Fingerprint], str, int]:
+    tokenizer = StreamTokenizer()
+    digest = hashlib.blake2b(digest_size=16)
+
+    def token_chunks():
+        for text in pieces:
+            ids, lines = tokenizer.feed(text)
+            digest.update(ids)
+            yield ids, lines
+        ids, lines = tokenizer.close()
+        digest.update(ids)
+        yield ids, lines
+
+    sampler = FingerprintSampler(max_fps)
+    for f in iter_winnow_stream(token_chunks(), k=k, window=window, scheme=scheme):
+        if stop is None or f.fp not in stop:
+            sampler.add(f)
+    return sampler.sample(), digest.hexdigest(), tokenizer.total_lines
+
+def fingerprint_stream(
+    fileobj: BinaryIO,
+    k: int,
+    window: int,
+    scheme: str,
+    max_fps: int,
+    stop: Optional[Container[int]] = None,
+    encodings: Sequence[str] = ("utf-8", "gbk"),
+) -> Tuple[List[Fingerprint], str, int]:
+    """
+    Streaming counterpart of fingerprint_code() + stop-fingerprint drop + query
+    sampling for the v2 endpoint: returns (fps, token_digest, total_lines).
+
+    Encodings are tried in order, rereading the file from the start after a
+    decode error; raises the last UnicodeDecodeError if none fits.
+    """
+    error = None
+    for encoding in encodings:
+        fileobj.seek(0)
+        try:
+            return fingerprint_text_stream(iter_decoded(fileobj, encoding), k, window, scheme, max_fps, stop)
+        except UnicodeDecodeError as e:
+            error = e
+    raise error
+
+async def fingerprint_upload(
+    pool,
+    fileobj: BinaryIO,
+    k: int,
+    window: int,
+    scheme: str,
+    max_fps: int,
+    stop: Optional[Container[int]] = None,
+    encodings: Sequence[str] = ("utf-8", "gbk"),
+) -> Tuple[List[Fingerprint], str, int]:
+    """fingerprint_stream() with the tokenize/winnow work on `pool` (a FingerprintPool)."""
+    error = None
+    for encoding in encodings:
+        fileobj.seek(0)
+        try:
+            return await pool.run_stream(
+                iter_decoded(fileobj, encoding), fingerprint_text_stream, k, window, scheme, max_fps, stop
+            )
+        except UnicodeDecodeError as e:
+            error = e
+    raise error
+
+def iter_lines(pieces: Iterable[str]) -> Iterator[str]:
+    """code.split('\\n') over decoded pieces (always yields the last, possibly empty, line)."""
+    carry: List[str] = []
+    for text in pieces:
+        parts = text.split("\n")
+        if len(parts) == 1:
+            carry.append(text)
+            continue
+        carry.append(parts[0])
+        yield "".join(carry)
+        yield from parts[1:-1]
+        carry = [parts[-1]]
+    yield "".join(carry)
+
+def simhash_stream_chunks(
+    fileobj: BinaryIO, window_size: int = 10, step: int = 5, encoding: str = "utf-8"
+) -> Tuple[List[dict], List[int], int]:
+    """
+    Streaming counterpart of simhash_code_chunks() for the v1 endpoint:
+    returns (chunks without "content", simhashes, total_lines), total_lines
+    counted like len(code.split('\\n')).
+    """
+    fileobj.seek(0)
+    return simhash_text_stream(iter_decoded(fileobj, encoding), window_size, step)
+
+async def simhash_upload(
+    pool, fileobj: BinaryIO, window_size: int = 10, step: int = 5, encoding: str = "utf-8"
+) -> Tuple[List[dict], List[int], int]:
+    """simhash_stream_chunks() with the chunking/SimHash work on `pool` (a FingerprintPool)."""
+    fileobj.seek(0)
+    return await pool.run_stream(iter_decoded(fileobj, encoding), simhash_text_stream, window_size, step)
+
+def simhash_text_stream(pieces: Iterable[str], window_size: int = 10, step: int = 5) -> Tuple[List[dict], List[int], int]:
+    engine = SimHashEngine()
+    line_count = 0
+
+    def counted(lines: Iterable[str]) -> Iterator[str]:
+        nonlocal line_count
+        for line in lines:
+            line_count += 1
+            yield line
+
+    chunks: List[dict] = []
+    chunk_fps: List[int] = []
+    batch: List[dict] = []
+    for chunk in iter_code_chunks(counted(iter_lines(pieces)), window_size, step):
+        batch.append(chunk)
+        if len(batch) >= SIMHASH_BATCH:
+            _flush_simhash_batch(engine, batch, chunks, chunk_fps)
+    _flush_simhash_batch(engine, batch, chunks, chunk_fps)
+    return chunks, chunk_fps, line_count
+
+def _flush_simhash_batch(engine: SimHashEngine, batch: List[dict], chunks: List[dict], chunk_fps: List[int]) -> None:
+    if not batch:
+        return
+    chunk_fps.extend(engine.compute_simhash_many(batch))
+    chunks.extend({"start_line": c["start_line"], "end_line": c["end_line"]} for c in batch)
+    batch.clear()
@@ -1,12 +1,18 @@
 # winnowing_utils.py
 import re
 import hashlib
+from array import array
+from collections import deque
 from dataclasses import dataclass
-from typing import Dict, Iterable, List, Tuple
+from typing import Deque, Dict, Iterable, Iterator, List, Sequence, Tuple, Union
 
 MASK64 = (1 << 64) - 1
 SIGN_BIT = 1 << 63
 
+# k-gram 长度与 winnowing 窗口：索引（分片表、块、导出文件）与查询必须一致，改动后要全量重建索引
+K = 20
+WINDOW = 5
+
 def to_uint64(x: int) -> int:
     return x & MASK64
 
@@ -17,13 +23,6 @@ def to_int64(x: int) -> int:
     u = x & MASK64
     return u - (1 << 64) if (u & SIGN_BIT) else u
 
-def shard_of_fp(fp_int64: int) -> int:
-    """
-    fp is stored/transferred as signed int64.
-    For sharding we interpret it as uint64 and take low 6 bits.
-    """
-    return (fp_int64 & MASK64) & 0x3F  # 0..63
-
 @dataclass(frozen=True)
 class Fingerprint:
     fp: int          # signed int64
@@ -43,6 +42,14 @@ _KEYWORDS = {
     "true","false","null","none",
 }
 
+# 固定词表：归一化后只会出现 ID/NUM/STR、关键字和运算符，token id 即其下标
+_OPERATORS = (
+    "==", "!=", "<=", ">=", "++", "--", "+=", "-=", "*=", "/=", "&&", "||",
+    "+", "-", "*", "/", "%", "<", ">", "=", "!", "(", ")", "{", "}", "[", "]", ".", ",", ";", ":",
+)
+TOKEN_VOCAB: Tuple[str, ...] = ("ID", "NUM", "STR") + tuple(sorted(_KEYWORDS)) + _OPERATORS
+TOKEN_ID: Dict[str, int] = {tok: i for i, tok in enumerate(TOKEN_VOCAB)}
+
 _STR_RE = re.compile(r"""('([^'\\]|\\.)*'|"([^"\\]|\\.)*"|`([^`\\]|\\.)*`)""")
 _NUM_RE = re.compile(r"\b\d+(\.\d+)?\b")
 _ID_RE = re.compile(r"\b[a-zA-Z_]\w*\b")
@@ -92,6 +99,227 @@ def normalize_to_tokens_with_lines(code: str) -> Tuple[List[str], List[int]]:
 
     return tokens, lines
 
+# ---- single-pass tokenizer ----
+# 一次 finditer 完成去注释、字符串/数字替换、运算符与标识符切分，输出 token id。
+# 注释/字符串的判定顺序与 normalize_to_tokens_with_lines 的多遍处理保持一致：
+# 可闭合的块注释最优先（哪怕出现在字符串或行注释里），其次 // 与 # 行注释，最后才是字符串。
+_NL_CHARS = "\\n\\r\\v\\f\\x1c-\\x1e\\x85\\u2028\\u2029"  # str.splitlines() 的换行符
+_BLOCK = r"/\*(?s:.*?)\*/"
+_OPENS_BLOCK = r"\*(?s:.*?)\*/"
+_LINE_SLASHES = rf"//(?!{_OPENS_BLOCK})"
+# 字符串里的 '/'：既不是块注释开头，也不是 // 行注释开头
+_LIT_SLASH = rf"/(?!{_OPENS_BLOCK})(?!/(?!{_OPENS_BLOCK}))"
+
+def _atomic_block(name: str) -> str:
+    # 字符串需要闭合引号，失败回溯时 .*? 会越过第一个 */ 去找后面的 */；
+    # 先行断言 + 反向引用让块注释只能在第一个 */ 处结束（等价于原子组）
+    return rf"(?=(?P<{name}>{_BLOCK}))(?P={name})"
+
+def _str_pattern(q: str, name: str) -> str:
+    body = rf"{_atomic_block(name + '_b')}|{_LIT_SLASH}|[^{q}\\{_NL_CHARS}#/]"
+    escape = rf"\\(?:{_atomic_block(name + '_e')}|{_LIT_SLASH}|[^{_NL_CHARS}#/])"
+    return rf"{q}(?:{body}|{escape})*{q}"
+
+# 前导的空格/制表符并入匹配，避免缩进逐字符试探所有分支；分支顺序只在 '/' 和 '#' 上有讲究
+_TOKEN_RE = re.compile(
+    rf"""
+    [ \t]*
+    (?:
+     (?P<id>\b[a-zA-Z_]\w*)
+    |(?P<op>[=!<>]=|\+[+=]|-[-=]|\*=|&&|\|\||{_LIT_SLASH}=?|[+\-*%<>=!(){{}}\[\].,;:])
+    |(?P<nl>\r\n|[{_NL_CHARS}])
+    |(?P<num>\b\d+(?:\.\d+)?\b)
+    |(?P<str>{_str_pattern("'", "sq")}|{_str_pattern('"', "dq")}|{_str_pattern("`", "bq")})
+    |(?P<block>{_BLOCK})
+    |(?P<comment>(?:{_LINE_SLASHES}|\#)(?:{_BLOCK}|\r(?!\n)|[^\r\n])*)
+    |(?P<other>\S)
+    )
+    """,
+    re.VERBOSE,
+)
+_NEWLINE_RE = re.compile(rf"\r\n|[{_NL_CHARS}]")
+# 行首 import/from/include 之后要求是空格；被替换成空格的注释同样算
+_SKIP_LINE_WORDS = frozenset(("import", "from", "include"))
+_AFTER_SKIP_WORD_RE = re.compile(rf" |{_BLOCK}|{_LINE_SLASHES}|\#")
+
+_ID = TOKEN_ID["ID"]
+_OP_IDS: Dict[str, int] = {op: TOKEN_ID[op] for op in _OPERATORS}
+_LINE_BREAKS = frozenset("\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029")
+
+# StreamTokenizer 的待处理文本上限（字符）。超过后不再等待未闭合的 /* 或换行
+STREAM_MAX_CARRY = 1 << 20
+
+class StreamTokenizer:
+    """
+    tokenize_to_ids() over text that arrives in pieces (e.g. an upload decoded
+    chunk by chunk). feed() returns the tokens that can no longer change,
+    close() the rest; concatenated they equal tokenize_to_ids(whole text).
+
+    Text is only consumed up to a newline token that a scan of everything
+    buffered so far produced, and never past a "/*" that has no "*/" after it:
+    a later "*/" can still turn that "/*" into a block comment (also inside
+    strings and // comments), so the newline after it is not final yet. At a
+    newline the per-line state resets, so the rest can be rescanned with the
+    next piece.
+
+    The carry is bounded by max_carry: beyond it the pending "/*" is treated
+    as unterminated, and a line without newline is cut at a token boundary in
+    the middle of the buffer. Only inputs with block comments or single lines
+    longer than that can tokenize differently from tokenize_to_ids().
+    """
+
+    def __init__(self, max_carry: int = STREAM_MAX_CARRY):
+        self.max_carry = max_carry
+        self.line = 1  # 当前行号；close() 之后等于换行数 + 1
+        self._line_start = True
+        self._pending_skip = -1
+        self._skipping = False
+        self._lookup = dict(_OP_IDS)
+        # 未处理的文本；_start 之前保留一个已处理的字符，让 \b 看得到前文
+        self._buf = ""
+        self._start = 0
+        self._last_char = ""
+
+    @property
+    def total_lines(self) -> int:
+        """len(text.splitlines()) of everything fed so far (exact after close())."""
+        if not self._last_char:
+            return 0
+        return self.line - (self._last_char in _LINE_BREAKS)
+
+    def feed(self, text: str) -> Tuple[array, array]:
+        ids = array("B")
+        lines = array("I")
+        if text:
+            self._last_char = text[-1]
+        buf = self._buf + text
+        start = self._start
+
+        # 最后一个未闭合的 /*（其后再没有 */）之后的内容都还可能变化
+        close_at = buf.rfind("*/", start)
+        open_at = buf.find("/*", max(start, close_at - 1))
+        forced = len(buf) - start > self.max_carry
+        limit = len(buf) - 1 if open_at < 0 or forced else open_at
+
+        end = self._consume(_TOKEN_RE.finditer(buf, start), buf, ids, lines, limit)
+        if end < 0 and forced:
+            # 超长的单行：在缓冲区中间的 token 边界处截断
+            end = self._consume(_TOKEN_RE.finditer(buf, start), buf, ids, lines, start + (len(buf) - start) // 2, True)
+        if end < 0:
+            self._buf = buf
+        else:
+            self._buf = buf[end - 1:]
+            self._start = 1
+        return ids, lines
+
+    def close(self, text: str = "") -> Tuple[array, array]:
+        ids = array("B")
+        lines = array("I")
+        if text:
+            self._last_char = text[-1]
+        buf = self._buf + text
+        self._consume(_TOKEN_RE.finditer(buf, self._start), buf, ids, lines, len(buf))
+        if self._pending_skip >= 0:
+            ids.append(self._pending_skip)
+            lines.append(self.line)
+            self._pending_skip = -1
+        self._buf = ""
+        self._start = 0
+        return ids, lines
+
+    def _consume(
+        self, matches: Iterable["re.Match"], code: str, ids: array, lines: array, limit: int, any_token: bool = False
+    ) -> int:
+        """
+        Tokenize `matches`, then roll back to the last newline ending at or
+        before `limit` (the last token, if any_token). Returns the text
+        position consumed up to, -1 if nothing; limit >= len(code) keeps all.
+        """
+        push_id = ids.append
+        push_line = lines.append
+        lookup = self._lookup  # operator/identifier text -> token id; identifiers are added on first sight
+        ln = self.line
+        line_start = self._line_start  # only whitespace/comments seen since the last newline
+        pending_skip = self._pending_skip  # token id of a line-leading import/from/include, until the line shows more content
+        skipping = self._skipping  # inside an import/from/include line
+
+        # 回滚点：(文本位置, 已输出 token 数, 行号, 行首/import 状态)
+        saved = (-1, 0, ln, line_start, pending_skip, skipping)
+        for m in matches:
+            kind = m.lastgroup
+            text = m.group(kind)
+            if kind == "id" or kind == "op":
+                tid = lookup.get(text)
+                if tid is None:
+                    lw = text.lower()
+                    tid = lookup[text] = TOKEN_ID[lw] if lw in _KEYWORDS else _ID
+            elif kind == "nl":
+                if pending_skip >= 0:
+                    # "import" 后面只剩空白：legacy 的 strip() 后不再以 "import " 开头，照常保留
+                    push_id(pending_skip)
+                    push_line(ln)
+                    pending_skip = -1
+                ln += 1
+                line_start = True
+                skipping = False
+                if m.end() <= limit:
+                    saved = (m.end(), len(ids), ln, True, -1, False)
+                continue
+            elif kind == "block" or kind == "comment":
+                # 块注释（含行注释里吞掉的块注释）可能跨行
+                ln += len(_NEWLINE_RE.findall(text))
+                continue
+            elif kind == "other":
+                tid = -1
+            else:
+                # str / num: the legacy path rewrites them to "STR"/"NUM", which then tokenize as ID
+                if "*/" in text:
+                    ln += len(_NEWLINE_RE.findall(text))
+                tid = _ID
+
+            if skipping:
+                continue
+            if pending_skip >= 0:
+                pending_skip = -1
+                skipping = True
+                continue
+            if line_start:
+                line_start = False
+                if kind == "id" and text in _SKIP_LINE_WORDS and _AFTER_SKIP_WORD_RE.match(code, m.end()):
+                    pending_skip = tid
+                    continue
+            if tid >= 0:
+                push_id(tid)
+                push_line(ln)
+            if any_token and m.end() <= limit:
+                saved = (m.end(), len(ids), ln, line_start, pending_skip, skipping)
+        if limit >= len(code):
+            saved = (len(code), len(ids), ln, line_start, pending_skip, skipping)
+
+        end, count, ln, line_start, pending_skip, skipping = saved
+        del ids[count:]
+        del lines[count:]
+        self.line = ln
+        self._line_start = line_start
+        self._pending_skip = pending_skip
+        self._skipping = skipping
+        return end
+
+def tokenize_to_ids(code: str) -> Tuple[array, array]:
+    """
+    Single-pass replacement for normalize_to_tokens_with_lines().
+
+    Returns (token_ids, token_lines) as compact arrays: token_ids holds
+    TOKEN_VOCAB indices ('B'), token_lines the 1-based source line of each
+    token ('I'). Both can be passed straight to winnow().
+
+    The token stream is the same as the legacy function's (string and number
+    literals still come out as ID, as they always have). Line numbers are the
+    physical source lines; the legacy function numbers lines after collapsing
+    block comments, so its lines drift below multi-line comments.
+    """
+    return StreamTokenizer().close(code)
+
 def _hash64_signed(s: str) -> int:
     """
     stable 64-bit hash, returned as signed int64 (fits MySQL BIGINT and asyncmy)
@@ -103,32 +331,170 @@ def _hash64_signed(s: str) -> int:
 def _kgram_hash(tokens: List[str], start: int, k: int) -> int:
     return _hash64_signed("\x1f".join(tokens[start:start + k]))
 
-def winnow(tokens: List[str], token_lines: List[int], k: int = 20, window: int = 5) -> List[Fingerprint]:
+# ---- k-gram hash schemes ----
+# 指纹库里存的是 k-gram 哈希，换算法 = 换索引。scheme 名带版本号，
+# 服务端与重建脚本必须用同一个 scheme（见 config.FP_HASH_SCHEME）。
+HASH_SCHEME_BLAKE2B = "blake2b-v1"   # 旧方案：每个 k-gram 拼接字符串后 blake2b，O(n*k)
+HASH_SCHEME_ROLLING = "rk64-v2"      # Karp-Rabin 64 位滚动哈希，基于 token id，O(n)
+HASH_SCHEMES = (HASH_SCHEME_BLAKE2B, HASH_SCHEME_ROLLING)
+DEFAULT_HASH_SCHEME = HASH_SCHEME_BLAKE2B
+
+Tokens = Union[Sequence[str], Sequence[int]]
+
+_RK_BASE = 0x9E3779B97F4A7C15  # odd, so multiplication is invertible mod 2^64
+
+def _token_value(tok: str) -> int:
+    # 由 token 文本派生，词表顺序变化不影响已入库的哈希
+    return int.from_bytes(hashlib.blake2b(tok.encode("utf-8"), digest_size=8).digest(), "big")
+
+_RK_TOKEN_VALUES: Tuple[int, ...] = tuple(_token_value(tok) for tok in TOKEN_VOCAB)
+
+def _mix64(x: int) -> int:
+    """
+    splitmix64 finalizer. Polynomial hashes have weak low bits, and ShardRouter
+    routes on the low bits, so every rolling hash is passed through this bijection.
+    """
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+def token_ids(tokens: Tokens) -> List[int]:
+    """Map normalized token strings to vocabulary ids (ids pass through unchanged)."""
+    if tokens and isinstance(tokens[0], str):
+        return [TOKEN_ID[t] for t in tokens]
+    return list(tokens)
+
+def token_strings(tokens: Tokens) -> List[str]:
+    """Inverse of token_ids()."""
+    if tokens and not isinstance(tokens[0], str):
+        return [TOKEN_VOCAB[t] for t in tokens]
+    return list(tokens)
+
+def _rolling_hashes(ids: Sequence[int], k: int) -> Iterator[int]:
+    values = _RK_TOKEN_VALUES
+    top = pow(_RK_BASE, k - 1, 1 << 64)  # weight of the token leaving the window
+
+    h = 0
+    for i in range(k):
+        h = (h * _RK_BASE + values[ids[i]]) & MASK64
+    yield to_int64(_mix64(h))
+
+    for i in range(k, len(ids)):
+        h = ((h - values[ids[i - k]] * top) * _RK_BASE + values[ids[i]]) & MASK64
+        yield to_int64(_mix64(h))
+
+def iter_kgram_hashes(tokens: Tokens, k: int, scheme: str = DEFAULT_HASH_SCHEME) -> Iterator[int]:
+    """
+    Yield the signed int64 hash of every k-gram of `tokens`, in position order.
+    """
+    if scheme not in HASH_SCHEMES:
+        raise ValueError(f"unknown fingerprint hash scheme: {scheme!r}")
     if len(tokens) < k:
-        return []
+        return iter(())
+    if scheme == HASH_SCHEME_ROLLING:
+        return _rolling_hashes(token_ids(tokens), k)
+    strs = token_strings(tokens)
+    return (_kgram_hash(strs, i, k) for i in range(0, len(strs) - k + 1))
 
-    hashes = [_kgram_hash(tokens, i, k) for i in range(0, len(tokens) - k + 1)]
-    fps: List[Fingerprint] = []
+def select_window_minima(hashes: Iterable[int], window: int) -> Iterator[Tuple[int, int]]:
+    """
+    Streaming winnowing selection over a hash stream.
 
+    Yields (idx, value) for the minimum of every full window of `window` hashes,
+    taking the leftmost one on ties and skipping a window whose pick equals the
+    previous pick -- the same selection as slicing hashes[i:i+window] and using
+    min()/.index(), but O(n) overall and without holding the whole stream.
+    """
+    # (idx, value) with non-decreasing values; equal values keep the older entry
+    # in front, which gives leftmost tie-breaking.
+    dq: Deque[Tuple[int, int]] = deque()
     last_idx = -1
     last_val = None
 
-    for i in range(0, len(hashes) - window + 1):
-        w = hashes[i:i + window]
-        min_val = min(w)  # signed compare OK; stable as long as both sides use same function
-        j = i + w.index(min_val)
+    for idx, h in enumerate(hashes):
+        while dq and dq[-1][1] > h:
+            dq.pop()
+        dq.append((idx, h))
+
+        start = idx - window + 1
+        if dq[0][0] < start:
+            dq.popleft()
+        if start < 0:
+            continue
 
+        j, min_val = dq[0]
         if j != last_idx or min_val != last_val:
-            start_line = token_lines[j]
-            end_line = token_lines[min(j + k - 1, len(token_lines) - 1)]
-            fps.append(Fingerprint(fp=min_val, pos=j, start_line=start_line, end_line=end_line))
+            yield j, min_val
             last_idx = j
             last_val = min_val
 
-    return fps
+def iter_winnow(
+    tokens: Tokens,
+    token_lines: Sequence[int],
+    k: int = K,
+    window: int = WINDOW,
+    scheme: str = DEFAULT_HASH_SCHEME,
+) -> Iterator[Fingerprint]:
+    """Generator form of winnow(); k-gram hashes are never materialized."""
+    last_line = len(token_lines) - 1
+    for j, min_val in select_window_minima(iter_kgram_hashes(tokens, k, scheme), window):
+        start_line = token_lines[j]
+        end_line = token_lines[min(j + k - 1, last_line)]
+        yield Fingerprint(fp=min_val, pos=j, start_line=start_line, end_line=end_line)
 
-def group_fps_by_shard(fps: Iterable[int]) -> Dict[int, List[int]]:
-    out: Dict[int, List[int]] = {}
-    for fp in fps:
-        out.setdefault(shard_of_fp(fp), []).append(fp)
-    return out
\ No newline at end of file
+def iter_winnow_stream(
+    token_chunks: Iterable[Tuple[Sequence[int], Sequence[int]]],
+    k: int = K,
+    window: int = WINDOW,
+    scheme: str = DEFAULT_HASH_SCHEME,
+) -> Iterator[Fingerprint]:
+    """
+    iter_winnow() over (token_ids, token_lines) pieces as StreamTokenizer
+    produces them. Yields the same fingerprints while holding only the last
+    k + window tokens.
+    """
+    if scheme not in HASH_SCHEMES:
+        raise ValueError(f"unknown fingerprint hash scheme: {scheme!r}")
+    recent_lines: Deque[int] = deque(maxlen=k + window)
+    consumed = 0
+
+    def kgram_hashes() -> Iterator[int]:
+        nonlocal consumed
+        rolling = scheme == HASH_SCHEME_ROLLING
+        values = _RK_TOKEN_VALUES
+        top = pow(_RK_BASE, k - 1, 1 << 64)
+        gram: Deque[int] = deque(maxlen=k)
+        h = 0
+        for ids, lines in token_chunks:
+            for tid, line in zip(ids, lines):
+                consumed += 1
+                recent_lines.append(line)
+                if rolling:
+                    if consumed > k:
+                        h = ((h - values[gram[0]] * top) * _RK_BASE + values[tid]) & MASK64
+                    else:
+                        h = (h * _RK_BASE + values[tid]) & MASK64
+                gram.append(tid)
+                if consumed < k:
+                    continue
+                if rolling:
+                    yield to_int64(_mix64(h))
+                else:
+                    yield _hash64_signed("\x1f".join([TOKEN_VOCAB[t] for t in gram]))
+
+    for j, min_val in select_window_minima(kgram_hashes(), window):
+        base = consumed - len(recent_lines)  # recent_lines[0] 对应的 token 下标
+        yield Fingerprint(
+            fp=min_val, pos=j, start_line=recent_lines[j - base], end_line=recent_lines[j + k - 1 - base]
+        )
+
+def winnow(
+    tokens: Tokens,
+    token_lines: Sequence[int],
+    k: int = K,
+    window: int = WINDOW,
+    scheme: str = DEFAULT_HASH_SCHEME,
+) -> List[Fingerprint]:
+    if len(tokens) < k:
+        return []
+    return list(iter_winnow(tokens, token_lines, k=k, window=window, scheme=scheme))